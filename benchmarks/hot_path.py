@@ -0,0 +1,278 @@
+"""
+Benchmarks of the hot path of a session: stepping the models, extracting
+their state, encoding the state frame and checkpointing the models
+(in full and incrementally).
+
+A `ModelRunner` is driven directly, with a stand-in for the websocket that
+only counts the bytes written to it. The bundled Game of Life, Schelling and
+Turtle models are run at several sizes and numbers of simulations, each with
+JSON frames and with columnar delta frames.
+
+Results are written as JSON, so runs can be compared::
+
+    python benchmarks/hot_path.py --output baseline.json
+    # ... change things ...
+    python benchmarks/hot_path.py --compare baseline.json
+
+Comparing exits with status 1 if any timing got slower by more than
+`--threshold` (relative, of the median) and more than `--min-ms`.
+"""
+import argparse
+import importlib.util
+import itertools
+import json
+import os
+import pickle
+import platform
+import statistics
+import sys
+import time
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "src"))
+sys.path.insert(0, os.path.join(ROOT, "examples", "conways_game_of_life"))
+sys.path.insert(0, os.path.join(ROOT, "examples", "schelling_side_by_side"))
+
+import mesa_viz  # noqa: E402
+from mesa_viz.Checkpoints import CheckpointStore  # noqa: E402
+from mesa_viz.VegaSpec import GridChart  # noqa: E402
+from mesa_viz.VegaVisualization import ModelRunner, VegaServer  # noqa: E402
+
+# Timings are reported in milliseconds per step, sizes in bytes per step
+TIMINGS = ("step_ms", "state_ms", "encode_ms", "checkpoint_ms", "incremental_ms")
+SIZES = ("frame_bytes", "checkpoint_bytes", "incremental_bytes")
+
+
+def game_of_life(size: int, n_simulations: int) -> VegaServer:
+    from conways_game_of_life.model import ConwaysGameOfLife
+
+    return VegaServer(
+        ConwaysGameOfLife,
+        [GridChart(color="isAlive")],
+        "Game of Life",
+        {"size": size},
+        n_simulations,
+    )
+
+
+def schelling(size: int, n_simulations: int) -> VegaServer:
+    from model import Schelling
+
+    return VegaServer(
+        Schelling,
+        [GridChart(color="agent_type")],
+        "Schelling",
+        {"height": size, "width": size},
+        n_simulations,
+    )
+
+
+def turtle(size: int, n_simulations: int) -> VegaServer:
+    # Loaded from its path, `turtle` is also a module of the standard library.
+    # It is registered, so its models can be pickled for checkpoints.
+    module = sys.modules.get("tutorial_turtle")
+    if module is None:
+        path = os.path.join(ROOT, "tutorial", "turtle.py")
+        spec = importlib.util.spec_from_file_location("tutorial_turtle", path)
+        module = sys.modules["tutorial_turtle"] = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)  # type: ignore
+    return VegaServer(
+        module.TurtleModel,
+        [GridChart(color="active")],
+        "Turtles",
+        {"width": size, "height": size},
+        n_simulations,
+    )
+
+
+# Model configurations and the sizes they are run at (full, quick)
+MODELS: Dict[str, Tuple[Callable[[int, int], VegaServer], List[int], List[int]]] = {
+    "gol": (game_of_life, [25, 100], [25]),
+    "schelling": (schelling, [20, 100], [20]),
+    "turtle": (turtle, [5, 50], [5]),
+}
+
+# Protocol and whether delta updates are used
+ENCODINGS = [("json", False), ("columnar", True)]
+
+
+class BenchmarkSocket:
+    """Stands in for a `SocketHandler`, counting the bytes of written frames."""
+
+    lagging = False
+    skipped_step = None
+
+    def __init__(self) -> None:
+        self.last_step = 0
+        self.viewports: Dict[int, Dict[str, float]] = {}
+        self.written: List[int] = []
+
+    def write_frame(self, data: bytes, binary: bool) -> None:
+        self.written.append(len(data))
+
+
+def run_case(server: VegaServer, steps: int, warmup: int) -> Dict[str, float]:
+    """Step a runner of `server` and return the median of every measure."""
+    socket = BenchmarkSocket()
+    runner = ModelRunner(server, socket)  # type: ignore
+    measures: Dict[str, List[float]] = {name: [] for name in TIMINGS + SIZES}
+    # Incremental checkpoints of every step, after a full one at the first
+    stores = [
+        CheckpointStore(interval=1, base_interval=warmup + steps)
+        for _ in runner.simulations
+    ]
+    try:
+        for step in range(warmup + steps):
+            start = time.perf_counter()
+            results = runner.model_states(runner.current_step)
+            extracted = time.perf_counter()
+            frame = runner.current_state(
+                runner.current_step, [state for state, _ in results]
+            )
+            encoded = time.perf_counter()
+            runner.send(frame, step=runner.current_step)
+
+            start_checkpoint = time.perf_counter()
+            checkpoint = pickle.dumps(
+                [simulation.model for simulation in runner.simulations],
+                pickle.HIGHEST_PROTOCOL,
+            )
+            checkpointed = time.perf_counter()
+            incremental_bytes = 0
+            for store, simulation in zip(stores, runner.simulations):
+                usage = store.memory_usage
+                store.save(runner.current_step, simulation.model)
+                incremental_bytes += store.memory_usage - usage
+            saved = time.perf_counter()
+            runner.step_ahead()
+            stepped = time.perf_counter()
+
+            if step < warmup:
+                continue
+            measures["state_ms"].append((extracted - start) * 1000)
+            measures["encode_ms"].append((encoded - extracted) * 1000)
+            measures["checkpoint_ms"].append((checkpointed - start_checkpoint) * 1000)
+            measures["incremental_ms"].append((saved - checkpointed) * 1000)
+            measures["step_ms"].append((stepped - saved) * 1000)
+            measures["frame_bytes"].append(socket.written[-1])
+            measures["checkpoint_bytes"].append(len(checkpoint))
+            measures["incremental_bytes"].append(incremental_bytes)
+    finally:
+        runner.close()
+        for store in stores:
+            store.clear()
+    return {name: statistics.median(values) for name, values in measures.items()}
+
+
+def cases(
+    models: List[str], n_simulations: List[int], quick: bool
+) -> Iterator[Tuple[str, Dict[str, Any]]]:
+    for model in models:
+        _, sizes, quick_sizes = MODELS[model]
+        for size, n, (protocol, delta) in itertools.product(
+            quick_sizes if quick else sizes, n_simulations, ENCODINGS
+        ):
+            name = f"{model}-{size}-n{n}-{protocol}{'-delta' if delta else ''}"
+            yield name, {
+                "model": model,
+                "size": size,
+                "n_simulations": n,
+                "protocol": protocol,
+                "delta_updates": delta,
+            }
+
+
+def run(args: argparse.Namespace) -> Dict[str, Any]:
+    results = []
+    for name, case in cases(args.models, args.n_simulations, args.quick):
+        create, _, _ = MODELS[case["model"]]
+        server = create(case["size"], case["n_simulations"])
+        server.verbose = False
+        # Work is measured on the calling thread, without worker processes
+        server.execution = "inline"
+        server.protocol = case["protocol"]
+        server.delta_updates = case["delta_updates"]
+        metrics = run_case(server, args.steps, args.warmup)
+        results.append({"name": name, **case, "metrics": metrics})
+        print(
+            f"{name:40}"
+            + " ".join(f"{key}={value:.3f}" for key, value in metrics.items()),
+            file=sys.stderr,
+        )
+    return {
+        "meta": {
+            "version": mesa_viz.__version__,
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "steps": args.steps,
+            "warmup": args.warmup,
+        },
+        "results": results,
+    }
+
+
+def compare(
+    report: Dict[str, Any],
+    baseline: Dict[str, Any],
+    threshold: float,
+    min_ms: float = 0.05,
+) -> List[str]:
+    """Describe the timings that got slower by more than `threshold`.
+
+    Timings that changed by less than `min_ms` are within the noise and not
+    counted as slower.
+    """
+    previous = {result["name"]: result["metrics"] for result in baseline["results"]}
+    regressions = []
+    for result in report["results"]:
+        old = previous.get(result["name"])
+        if old is None:
+            continue
+        for key, value in result["metrics"].items():
+            if key not in old or not old[key]:
+                continue
+            change = value / old[key] - 1
+            print(f"{result['name']:40}{key:18}{change:+8.1%}", file=sys.stderr)
+            if key in TIMINGS and change > threshold and value - old[key] > min_ms:
+                regressions.append(f"{result['name']} {key}: {change:+.1%}")
+    return regressions
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "--models", nargs="+", choices=list(MODELS), default=list(MODELS)
+    )
+    parser.add_argument("--n-simulations", nargs="+", type=int, default=[1, 4])
+    parser.add_argument("--steps", type=int, default=20, help="measured steps")
+    parser.add_argument("--warmup", type=int, default=2)
+    parser.add_argument("--quick", action="store_true", help="only the small sizes")
+    parser.add_argument("--output", help="file to write the results to")
+    parser.add_argument("--compare", help="results of an earlier run")
+    parser.add_argument("--threshold", type=float, default=0.1)
+    parser.add_argument("--min-ms", type=float, default=0.05)
+    args = parser.parse_args(argv)
+
+    report = run(args)
+    data = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as file:
+            file.write(data)
+    else:
+        print(data)
+
+    if args.compare:
+        with open(args.compare) as file:
+            regressions = compare(
+                report, json.load(file), args.threshold, args.min_ms
+            )
+        for regression in regressions:
+            print("Slower:", regression, file=sys.stderr)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -4,7 +4,10 @@ from mesa_viz.UserParam import UserSettableParameter
 
 from .model import ConwaysGameOfLife
 
-grid_spec = GridChart(color="isAlive")
+# Drawn as an image, so large boards can be shown as well
+grid_spec = GridChart(
+    color="isAlive", raster=True, colors={True: "black", False: "white"}
+)
 
 
 server = VegaServer(
@@ -13,7 +16,7 @@ server = VegaServer(
     "Game of Life",
     {
         "size": UserSettableParameter(
-            "slider", "Size", value=25, min_value=10, max_value=100, step=5
+            "slider", "Size", value=25, min_value=10, max_value=1000, step=10
         )
     },
     n_simulations=2,
@@ -42,7 +42,13 @@ class Schelling(Model):
     """
 
     def __init__(
-        self, height=20, width=20, density=0.8, schedule="RandomActivation", **kwargs
+        self,
+        height=20,
+        width=20,
+        density=0.8,
+        schedule="RandomActivation",
+        homophily=3,
+        **kwargs
     ):
         """"""
 
@@ -50,7 +56,7 @@ class Schelling(Model):
         self.width = width
         self.density = density
         self.minority_pc = 0.4
-        self.homophily = 3
+        self.homophily = homophily
 
         self.schedule = getattr(time, schedule)(self)
         self.grid = SingleGrid(height, width, torus=True)
@@ -1,11 +1,14 @@
 from mesa_viz.VegaVisualization import VegaServer
-from mesa_viz.VegaSpec import GridChart
+from mesa_viz.VegaSpec import GridChart, SweepChart
 from mesa_viz.UserParam import UserSettableParameter
 import json
 from model import Schelling
 
 grid_spec = GridChart(color="agent_type")
 
+# Share of happy agents for every combination of density and homophily
+sweep_spec = SweepChart(x="density", y="homophily", color="happy")
+
 line_spec = json.loads(
     """
 {
@@ -27,6 +30,7 @@ model_params = {
     "height": 20,
     "width": 20,
     "density": UserSettableParameter("slider", "Agent density", 0.8, 0.1, 1.0, 0.1),
+    "homophily": UserSettableParameter("slider", "Homophily", 3, 0, 8, 1),
     "schedule": UserSettableParameter(
         "choice",
         "Activation",
@@ -35,5 +39,7 @@ model_params = {
     ),
 }
 
-server = VegaServer(Schelling, [grid_spec, line_spec], "Schelling", model_params, 3)
-server.launch()
+server = VegaServer(
+    Schelling, [grid_spec, line_spec, sweep_spec], "Schelling", model_params, 3
+)
+server.sweep_params = ("density", "homophily")
@@ -0,0 +1,664 @@
+"""
+Checkpoints
+===========
+
+Bounded storage of model checkpoints, used to rewind simulations.
+
+Instead of pickling the models at every step, a `CheckpointStore` only keeps
+every `interval`-th step (plus explicit keyframes, e.g. after the user
+interacted with a model). Earlier states are recreated by restoring the
+nearest checkpoint and stepping forward again.
+
+Checkpoints are held in memory up to `memory_budget` bytes. Beyond that the
+least recently used ones are moved to a temporary file, which is memory-mapped
+for reading, or dropped if spilling is disabled. The space of discarded
+checkpoints in the file is reused. Pickling a store leaves out the file, it is
+copied separately by `write_spilled` and `read_spilled`.
+
+Stepping forward from a checkpoint only repeats the original steps if the
+random number generators of the model are restored with it. Mesa (0.9) keeps
+the generator of a model on its class, where pickling leaves it out and all
+models of the class share it, so `own_generators` moves it onto the model.
+Models drawing from the global generators of `random` or numpy are not
+restored exactly.
+
+With a `base_interval` checkpoints are incremental: the full model is only
+pickled every `base_interval` steps (and for keyframes). The checkpoints in
+between only hold what changed since the previous one: the attributes of the
+model itself, those of the agents, the schedule and the grids of the model
+that were assigned, the agents added to or removed from the schedule and the
+changed cells of the grids. Changes are tracked by wrapping `__setattr__` and
+the methods changing schedules and grids of their classes, and recorded in
+the `Changes` of the store that last checkpointed the object (other instances
+of the classes are not recorded). These objects are pickled as references,
+so loading a checkpoint applies all checkpoints since the full one in order.
+This assumes that agents only change by assigning their attributes, not by
+e.g. appending to a list attribute.
+"""
+import bisect
+import functools
+import io
+import mmap
+import pickle
+import random
+import sys
+import tempfile
+import threading
+import weakref
+import zlib
+from collections import OrderedDict
+from typing import (
+    IO,
+    Any,
+    Callable,
+    Dict,
+    Iterable,
+    List,
+    Optional,
+    Set,
+    Tuple,
+    Union,
+)
+
+import numpy as np
+from mesa.space import Grid
+from mesa.time import BaseScheduler
+
+# Changes recording those of the tracked objects, by id of the object
+_tracking: Dict[int, "Changes"] = {}
+_tracked_classes: Set[type] = set()
+_tracking_lock = threading.Lock()
+
+# Flag of classes defined in Python
+HEAPTYPE = 1 << 9
+
+# Bytes copied at once by `write_spilled` and `read_spilled`
+COPY_CHUNK = 2 ** 20
+
+
+class Changes:
+    """The changes of the objects of a model since its last checkpoint.
+
+    The objects are registered in `_tracking` while they are tracked, and kept
+    alive, so no other object can have the id of a tracked one.
+    """
+
+    def __init__(self) -> None:
+        self.objects: List[Any] = []
+        # Names of the attributes assigned, by id of the object (None if the
+        # object changed otherwise, like a schedule adding an agent)
+        self.written: Dict[int, Optional[Set[str]]] = {}
+        # Positions of the changed cells, by id of the grid
+        self.cells: Dict[int, Set[Tuple[int, int]]] = {}
+
+    def track(self, objects: Iterable[Any]) -> None:
+        """Record the changes of `objects` from now on, instead of those of
+        the objects tracked so far."""
+        objects = list(objects)
+        with _tracking_lock:
+            for obj in self.objects:
+                if _tracking.get(id(obj)) is self:
+                    del _tracking[id(obj)]
+            for obj in objects:
+                _tracking[id(obj)] = self
+        self.objects = objects
+        self.take()
+
+    def take(self) -> Tuple[Dict[int, Optional[Set[str]]], Dict[int, Set[Any]]]:
+        """The changes so far, which are forgotten."""
+        changes = self.written, self.cells
+        self.written = {}
+        self.cells = {}
+        return changes
+
+
+def track_changes(cls: type) -> None:
+    """Record changes of tracked instances of `cls` in their `Changes`."""
+    with _tracking_lock:
+        if cls not in _tracked_classes:
+            _wrap_changing_methods(cls)
+            _tracked_classes.add(cls)
+
+
+def _wrap_changing_methods(cls: type) -> None:
+    setattr_: Callable[[Any, str, Any], None] = cls.__setattr__
+    delattr_: Callable[[Any, str], None] = cls.__delattr__
+
+    def __setattr__(self: Any, name: str, value: Any) -> None:
+        setattr_(self, name, value)
+        changes = _tracking.get(id(self))
+        if changes is None:
+            return
+        names = changes.written.get(id(self), ())
+        if names == ():
+            changes.written[id(self)] = {name}
+        elif names is not None:
+            names.add(name)
+
+    def __delattr__(self: Any, name: str) -> None:
+        delattr_(self, name)
+        changes = _tracking.get(id(self))
+        if changes is not None:
+            changes.written[id(self)] = None
+
+    cls.__setattr__ = __setattr__  # type: ignore
+    cls.__delattr__ = __delattr__  # type: ignore
+    if issubclass(cls, BaseScheduler):
+        for name in ("add", "remove"):
+            setattr(cls, name, _marking_written(getattr(cls, name)))
+    if issubclass(cls, Grid):
+        for name in ("_place_agent", "_remove_agent"):
+            setattr(cls, name, _marking_cell(getattr(cls, name)))
+
+
+def _marking_written(method: Callable[..., Any]) -> Callable[..., Any]:
+    @functools.wraps(method)
+    def wrapper(self: Any, *args: Any, **kwargs: Any) -> Any:
+        changes = _tracking.get(id(self))
+        if changes is not None:
+            changes.written[id(self)] = None
+        return method(self, *args, **kwargs)
+
+    return wrapper
+
+
+def _marking_cell(method: Callable[..., Any]) -> Callable[..., Any]:
+    @functools.wraps(method)
+    def wrapper(self: Any, pos: Tuple[int, int], *args: Any, **kwargs: Any) -> Any:
+        changes = _tracking.get(id(self))
+        if changes is not None:
+            changes.cells.setdefault(id(self), set()).add(tuple(pos))
+        return method(self, pos, *args, **kwargs)
+
+    return wrapper
+
+
+def is_generator(value: Any) -> bool:
+    """Whether a value is a random number generator."""
+    return isinstance(
+        value, (random.Random, np.random.RandomState, np.random.Generator)
+    )
+
+
+def own_generators(model: Any) -> None:
+    """Make the random number generators on the class of a model attributes
+    of the model, so they are pickled with it."""
+    attributes = getattr(model, "__dict__", None)
+    if attributes is None:
+        return
+    seen = set(attributes)
+    for cls in type(model).__mro__:
+        for name, value in vars(cls).items():
+            if name not in seen:
+                seen.add(name)
+                if is_generator(value):
+                    setattr(model, name, value)
+
+
+def has_plain_state(cls: type) -> bool:
+    """Whether the state of instances of `cls` is just their `__dict__`, so
+    they can be recreated by `object.__new__` (without the side effects of a
+    `__new__` like that of mesa models)."""
+    return (
+        all(base is object or base.__flags__ & HEAPTYPE for base in cls.__mro__)
+        and "__slots__" not in dir(cls)
+        and cls.__reduce_ex__ is object.__reduce_ex__
+        and cls.__reduce__ is object.__reduce__
+        # `object.__getstate__` was added in Python 3.11
+        and getattr(cls, "__getstate__", None) is getattr(object, "__getstate__", None)
+        and not hasattr(cls, "__setstate__")
+    )
+
+
+class Baseline:
+    """The tracked objects of the model of the latest incremental checkpoint:
+    its parts (see `tracked_parts`) followed by the scheduled agents."""
+
+    def __init__(self, step: int, parts: List[Any]):
+        self.step = step
+        self.parts = len(parts)
+        self.objects = [*parts, *parts[1].agents]
+        self.slots = {id(obj): slot for slot, obj in enumerate(self.objects)}
+        self.grids = list(range(2, self.parts))
+
+
+def tracked_object(slot: int) -> Any:
+    """Stand-in for the tracked object in `slot` (see `ReferenceUnpickler`)."""
+    raise pickle.UnpicklingError("Tracked objects need a ReferenceUnpickler")
+
+
+class ReferencePickler(pickle.Pickler):
+    """Pickles the tracked objects as references to their slot."""
+
+    def __init__(self, file: IO[bytes], slots: Dict[int, int]):
+        super().__init__(file, pickle.HIGHEST_PROTOCOL)
+        self.slots = slots
+
+    if sys.version_info >= (3, 8):
+
+        def reducer_override(self, obj: Any) -> Any:
+            # Unlike `persistent_id` this isn't called for objects of builtin
+            # types
+            slot = self.slots.get(id(obj))
+            if slot is None:
+                return NotImplemented
+            return tracked_object, (slot,)
+
+    else:
+
+        def persistent_id(self, obj: Any) -> Optional[int]:
+            return self.slots.get(id(obj))
+
+
+class ReferenceUnpickler(pickle.Unpickler):
+    """Resolves the references of a `ReferencePickler` to `objects`."""
+
+    def __init__(self, file: IO[bytes], objects: List[Any]):
+        super().__init__(file)
+        self.objects = objects
+
+    def find_class(self, module: str, name: str) -> Any:
+        if module == __name__ and name == tracked_object.__name__:
+            return self.objects.__getitem__
+        return super().find_class(module, name)
+
+    def persistent_load(self, slot: int) -> Any:
+        return self.objects[slot]
+
+
+def tracked_parts(model: Any) -> Optional[List[Any]]:
+    """The model, its schedule and its grids, if it has a schedule."""
+    schedule = getattr(model, "schedule", None)
+    if not isinstance(schedule, BaseScheduler):
+        return None
+    return [
+        model,
+        schedule,
+        *(value for value in vars(model).values() if isinstance(value, Grid)),
+    ]
+
+
+class CheckpointStore:
+    """Pickled checkpoints of a list of models, by step."""
+
+    def __init__(
+        self,
+        interval: int = 10,
+        memory_budget: int = 256 * 2 ** 20,
+        compression: int = 0,
+        spill: bool = True,
+        base_interval: int = 0,
+    ):
+        self.interval = max(interval, 1)
+        self.memory_budget = memory_budget
+        self.compression = compression
+        self.spill = spill
+        self.base_interval = base_interval
+
+        # Steps of the incremental checkpoints and the step of the full one
+        # they build on (which maps to itself)
+        self._bases: Dict[int, int] = {}
+        self._baseline: Optional[Baseline] = None
+        self._changes = Changes()
+        # Stop tracking the objects when the store is gone
+        weakref.finalize(self, self._changes.track, [])
+
+        # Steps of all checkpoints, in order
+        self._steps: List[int] = []
+
+        # In-memory checkpoints, least recently used first
+        self._memory: "OrderedDict[int, bytes]" = OrderedDict()
+        self.memory_usage = 0
+
+        # Offset and length of checkpoints in the spill file, and of its
+        # unused space (by offset, adjacent space merged)
+        self._spilled: Dict[int, Tuple[int, int]] = {}
+        self._free: List[Tuple[int, int]] = []
+        self._size = 0
+        self._file: Optional[IO[bytes]] = None
+        self._map: Optional[mmap.mmap] = None
+        self.disk_usage = 0
+
+    def __contains__(self, step: int) -> bool:
+        return step in self._memory or step in self._spilled
+
+    def __len__(self) -> int:
+        return len(self._memory) + len(self._spilled)
+
+    def __getstate__(self) -> Dict[str, Any]:
+        """The spill file is left out, see `write_spilled`. An incremental
+        store writes a full checkpoint next."""
+        state = self.__dict__.copy()
+        state.update(_file=None, _map=None, _baseline=None, _changes=None)
+        return state
+
+    def __setstate__(self, state: Dict[str, Any]) -> None:
+        self.__dict__.update(state)
+        self._changes = Changes()
+        weakref.finalize(self, self._changes.track, [])
+
+    def write_spilled(self, file: IO[bytes]) -> None:
+        """Copy the spill file to `file`, e.g. after the pickled store."""
+        if self._file is not None:
+            self._file.seek(0)
+            _copy(self._file, file, self._size)
+
+    def read_spilled(self, file: IO[bytes]) -> None:
+        """Read the spill file written by `write_spilled`, after unpickling
+        the store."""
+        if self._size:
+            self._file = tempfile.TemporaryFile(prefix="mesa_viz_checkpoints_")
+            _copy(file, self._file, self._size)
+            self._file.flush()
+
+    def save(self, step: int, models: Any, keyframe: bool = False) -> bool:
+        """Store a checkpoint, if `step` is a multiple of the interval.
+
+        Keyframes are always stored and replace an existing checkpoint.
+        Returns whether a checkpoint was stored.
+        """
+        if not keyframe and (step % self.interval or step in self):
+            return False
+
+        self._discard(step)
+        if self.base_interval > 0:
+            data = self._dump_incremental(step, models, keyframe)
+        else:
+            data = pickle.dumps(models, pickle.HIGHEST_PROTOCOL)
+        if self.compression:
+            data = zlib.compress(data, self.compression)
+        self._memory[step] = data
+        self.memory_usage += len(data)
+        bisect.insort(self._steps, step)
+        self._evict()
+        return True
+
+    def nearest(self, step: int) -> Optional[int]:
+        """The latest step with a checkpoint at or before `step`."""
+        index = bisect.bisect_right(self._steps, step)
+        return self._steps[index - 1] if index else None
+
+    def load(self, step: int) -> Any:
+        """Unpickle the checkpoint of a step.
+
+        Incremental checkpoints are applied to the full one they build on,
+        in order.
+        """
+        base = self._bases.get(step)
+        if base is None:
+            return pickle.loads(self._data(step))
+        objects: List[Any] = []
+        for part in sorted(s for s, b in self._bases.items() if b == base <= s <= step):
+            objects = self._apply(self._data(part), objects)
+        model = objects[0]
+        parts = tracked_parts(model)
+        assert parts is not None
+        self._set_baseline(Baseline(step, parts))
+        return model
+
+    def truncate(self, step: int) -> None:
+        """Remove all checkpoints after `step`."""
+        for later in self._steps[bisect.bisect_right(self._steps, step) :]:
+            self._discard(later)
+        if self._baseline is not None and self._baseline.step > step:
+            self._set_baseline(None)
+
+    def clear(self) -> None:
+        self._steps.clear()
+        self._memory.clear()
+        self._spilled.clear()
+        self._free.clear()
+        self._size = 0
+        self._bases.clear()
+        self._set_baseline(None)
+        self.memory_usage = 0
+        self.disk_usage = 0
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def _discard(self, step: int) -> None:
+        """Remove a checkpoint, and the incremental ones building on it."""
+        base = self._bases.pop(step, None)
+        if base is not None:
+            for later in [s for s, b in self._bases.items() if b == base and s > step]:
+                self._discard(later)
+        if self._baseline is not None and self._baseline.step == step:
+            self._set_baseline(None)
+        index = bisect.bisect_left(self._steps, step)
+        if index < len(self._steps) and self._steps[index] == step:
+            del self._steps[index]
+        data = self._memory.pop(step, None)
+        if data is not None:
+            self.memory_usage -= len(data)
+        spilled = self._spilled.pop(step, None)
+        if spilled is not None:
+            self.disk_usage -= spilled[1]
+            self._release(*spilled)
+
+    def _set_baseline(self, baseline: Optional[Baseline]) -> None:
+        """Track the objects of the latest incremental checkpoint."""
+        if baseline is self._baseline:
+            return
+        self._baseline = baseline
+        if baseline is None:
+            self._changes.track([])
+            return
+        model = baseline.objects[0]
+        for cls in {type(obj) for obj in baseline.objects} - {type(model)}:
+            track_changes(cls)
+        self._changes.track(baseline.objects)
+
+    def _data(self, step: int) -> bytes:
+        if step in self._memory:
+            self._memory.move_to_end(step)
+            data = self._memory[step]
+        else:
+            offset, length = self._spilled[step]
+            data = self._read(offset, length)
+        if self.compression:
+            data = zlib.decompress(data)
+        return data
+
+    def _dump_incremental(self, step: int, model: Any, keyframe: bool) -> bytes:
+        """Pickle the changes since the previous checkpoint, or the full model
+        if it is due for one (or can't be checkpointed incrementally).
+
+        Both start with the tracked objects (see `Baseline`): a list of their
+        classes, or for incremental checkpoints their slots in the previous
+        one (or None if unchanged). Then follow the attributes of the changed
+        objects, with the tracked objects pickled as references, and the
+        contents of the changed cells of the grids. Objects with only some
+        changed attributes keep the others when the checkpoint is applied.
+        """
+        parts = tracked_parts(model)
+        if parts is None:
+            self._set_baseline(None)
+            return pickle.dumps(model, pickle.HIGHEST_PROTOCOL)
+        baseline = self._baseline
+        written, changed_cells = self._changes.take()
+        roster: Optional[List[Union[int, type]]] = None
+        # Names of the changed attributes by slot, None for all of them. The
+        # attributes of the model are always included.
+        changed: Dict[int, Optional[Set[str]]] = {0: None}
+
+        if (
+            keyframe
+            or baseline is None
+            or baseline.objects[0] is not model
+            # Checkpoints in between (at multiples of the interval) would
+            # not have been saved from the model
+            or not step - self.interval <= baseline.step < step
+            or baseline.step not in self._bases
+            or step - self._bases[baseline.step] >= self.base_interval
+        ):
+            base = step
+            baseline = Baseline(step, parts)
+            roster = [type(obj) for obj in baseline.objects]
+            changed = dict.fromkeys(range(len(roster)))
+        else:
+            base = self._bases[baseline.step]
+            # The agents only change if the schedule added or removed some
+            if (
+                parts != baseline.objects[: baseline.parts]
+                or written.get(id(parts[1]), ()) is None
+            ):
+                previous = baseline
+                baseline = Baseline(step, parts)
+                if baseline.objects != previous.objects:
+                    roster = [
+                        previous.slots.get(id(obj), type(obj))
+                        for obj in baseline.objects
+                    ]
+                    # New objects are changed, even if their class isn't
+                    # tracked yet
+                    for slot, entry in enumerate(roster):
+                        if isinstance(entry, type):
+                            changed[slot] = None
+
+        if roster is not None:
+            classes = {entry for entry in roster if isinstance(entry, type)}
+            if not all(map(has_plain_state, classes)):
+                self._set_baseline(None)
+                return pickle.dumps(model, pickle.HIGHEST_PROTOCOL)
+        baseline.step = step
+        self._set_baseline(baseline)
+        objects = baseline.objects
+
+        # Changes of objects removed since the previous checkpoint are ignored
+        for key, names in written.items():
+            slot = baseline.slots.get(key)
+            if slot is None:
+                continue
+            if slot not in changed:
+                changed[slot] = names
+            elif names is None:
+                changed[slot] = None
+            elif changed[slot] is not None:
+                changed[slot] |= names  # type: ignore
+
+        states = []
+        for slot, names in sorted(changed.items()):
+            attributes = objects[slot].__dict__
+            if names is not None:
+                attributes = {name: attributes[name] for name in names}
+            states.append((slot, names is None, attributes))
+        cells = []
+        for slot in baseline.grids:
+            grid = objects[slot]
+            positions = changed_cells.get(id(grid))
+            if positions and changed.get(slot, ()) is not None:
+                contents = [(pos, grid.grid[pos[0]][pos[1]]) for pos in positions]
+                cells.append((slot, contents))
+
+        file = io.BytesIO()
+        pickle.dump(roster, file, pickle.HIGHEST_PROTOCOL)
+        ReferencePickler(file, baseline.slots).dump((states, cells))
+        self._bases[step] = base
+        return file.getvalue()
+
+    def _apply(self, data: bytes, objects: List[Any]) -> List[Any]:
+        """Apply an incremental checkpoint to the objects of the previous one."""
+        file = io.BytesIO(data)
+        roster = pickle.load(file)
+        if roster is not None:
+            objects = [
+                objects[entry] if isinstance(entry, int) else object.__new__(entry)
+                for entry in roster
+            ]
+        states, cells = ReferenceUnpickler(file, objects).load()
+        for slot, full, state in states:
+            attributes = objects[slot].__dict__
+            if full:
+                attributes.clear()
+            attributes.update(state)
+        for slot, contents in cells:
+            grid = objects[slot]
+            for pos, content in contents:
+                grid.grid[pos[0]][pos[1]] = content
+                if grid.is_cell_empty(pos):
+                    grid.empties.add(pos)
+                else:
+                    grid.empties.discard(pos)
+        return objects
+
+    def _evict(self) -> None:
+        """Move least recently used checkpoints out of memory."""
+        earliest = min(self._memory, default=None)
+        while self.memory_usage > self.memory_budget and len(self._memory) > 1:
+            step = next(iter(self._memory))
+            if step == earliest and not self.spill:
+                # Without spilling keep the earliest checkpoint, so every
+                # step can still be recreated
+                self._memory.move_to_end(step)
+                step = next(iter(self._memory))
+            if not self.spill:
+                self._discard(step)
+                continue
+            data = self._memory.pop(step)
+            self.memory_usage -= len(data)
+            self._write(step, data)
+
+    def _write(self, step: int, data: bytes) -> None:
+        """Write a checkpoint to the first unused space in the spill file that
+        is large enough, or else to its end."""
+        if self._file is None:
+            self._file = tempfile.TemporaryFile(prefix="mesa_viz_checkpoints_")
+        length = len(data)
+        for index, (offset, free) in enumerate(self._free):
+            if free >= length:
+                if free > length:
+                    self._free[index] = (offset + length, free - length)
+                else:
+                    del self._free[index]
+                break
+        else:
+            offset = self._size
+            self._size += length
+        self._file.seek(offset)
+        self._file.write(data)
+        # Reused space may already be mapped for reading
+        self._file.flush()
+        self._spilled[step] = (offset, length)
+        self.disk_usage += length
+
+    def _release(self, offset: int, length: int) -> None:
+        """Mark space in the spill file as unused, and shorten the file if
+        the space is at its end."""
+        index = bisect.bisect(self._free, (offset, length))
+        if index < len(self._free) and self._free[index][0] == offset + length:
+            length += self._free.pop(index)[1]
+        if index > 0 and sum(self._free[index - 1]) == offset:
+            index -= 1
+            offset, before = self._free.pop(index)
+            length += before
+        if offset + length < self._size:
+            self._free.insert(index, (offset, length))
+            return
+        assert self._file is not None
+        self._size = offset
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        self._file.truncate(offset)
+
+    def _read(self, offset: int, length: int) -> bytes:
+        assert self._file is not None
+        if self._map is None or len(self._map) < offset + length:
+            if self._map is not None:
+                self._map.close()
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._map[offset : offset + length]
+
+
+def _copy(source: IO[bytes], target: IO[bytes], length: int) -> None:
+    """Copy `length` bytes from the position of `source`, in chunks."""
+    while length > 0:
+        data = source.read(min(length, COPY_CHUNK))
+        if not data:
+            raise EOFError("The spill file was cut short")
+        target.write(data)
+        length -= len(data)
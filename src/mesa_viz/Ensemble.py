@@ -0,0 +1,163 @@
+"""
+Ensemble
+========
+
+Replicates of one model configuration, summarized by streaming statistics.
+
+Every replicate runs headless with its own random seed in a pool of worker
+processes and returns the numeric model values of every step. These are
+folded into running statistics per step and value (count, mean and variance
+after Welford, quantiles with the P² algorithm) and dropped, so memory and
+the size of the summary sent to the frontend don't depend on the number of
+replicates. A replicate that stops early keeps its last values for the
+remaining steps.
+"""
+import math
+from typing import Any, Dict, List, Optional, Sequence
+
+import numpy as np
+
+from .Serializer import get_serializer
+from .Sweep import seeded_model
+from .TimeSeries import is_numeric
+
+
+def run_replicate(
+    model_cls: Any, params: Dict[str, Any], seed: int, steps: int
+) -> Dict[str, np.ndarray]:
+    """Run a model for `steps` steps and return its numeric values at the
+    `steps + 1` steps (including the first). Runs in the worker processes."""
+    model = seeded_model(model_cls, params, seed)
+    serializer = get_serializer(model_cls)
+    rows = []
+    for step in range(steps + 1):
+        if step > 0 and model.running:
+            model.step()
+        rows.append(serializer(model))
+    names = [name for name, value in rows[0].items() if is_numeric(value)]
+    return {
+        name: np.array([row.get(name, np.nan) for row in rows], dtype=float)
+        for name in names
+    }
+
+
+class P2Quantile:
+    """Estimate of a quantile of a stream of arrays, element-wise.
+
+    Uses the P² algorithm (Jain and Chlamtac), which keeps five markers per
+    element instead of the observations.
+    """
+
+    def __init__(self, p: float):
+        self.p = p
+        self.count = 0
+        self.initial: List[np.ndarray] = []
+        # Marker heights and (1-based) positions, one column per element
+        self.heights: Optional[np.ndarray] = None
+        self.positions: Optional[np.ndarray] = None
+        self.desired = np.array([1, 1 + 2 * p, 1 + 4 * p, 3 + 2 * p, 5])
+        self.increments = np.array([0, p / 2, p, (1 + p) / 2, 1])
+
+    def add(self, values: np.ndarray) -> None:
+        self.count += 1
+        if self.heights is None:
+            self.initial.append(values)
+            if self.count == 5:
+                self.heights = np.sort(np.stack(self.initial), axis=0)
+                self.positions = np.tile(
+                    np.arange(1.0, 6.0)[:, None], (1, len(values))
+                )
+                self.initial = []
+            return
+
+        q, n = self.heights, self.positions
+        q[0] = np.minimum(q[0], values)
+        q[4] = np.maximum(q[4], values)
+        # Cell of every observation between the markers, 0 to 3
+        cell = np.clip((q[1:4] <= values).sum(axis=0), 0, 3)
+        n += np.arange(5)[:, None] > cell
+        self.desired = self.desired + self.increments
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            for i in (1, 2, 3):
+                offset = self.desired[i] - n[i]
+                up = (offset >= 1) & (n[i + 1] - n[i] > 1)
+                down = (offset <= -1) & (n[i - 1] - n[i] < -1)
+                sign = np.where(up, 1.0, -1.0)
+                parabolic = q[i] + sign / (n[i + 1] - n[i - 1]) * (
+                    (n[i] - n[i - 1] + sign) * (q[i + 1] - q[i]) / (n[i + 1] - n[i])
+                    + (n[i + 1] - n[i] - sign) * (q[i] - q[i - 1]) / (n[i] - n[i - 1])
+                )
+                neighbor = np.where(up, q[i + 1], q[i - 1])
+                distance = np.where(up, n[i + 1], n[i - 1]) - n[i]
+                linear = q[i] + sign * (neighbor - q[i]) / distance
+                inside = (q[i - 1] < parabolic) & (parabolic < q[i + 1])
+                move = up | down
+                q[i] = np.where(move, np.where(inside, parabolic, linear), q[i])
+                n[i] = np.where(move, n[i] + sign, n[i])
+
+    @property
+    def value(self) -> np.ndarray:
+        if self.heights is None:
+            return np.quantile(np.stack(self.initial), self.p, axis=0)
+        return self.heights[2]
+
+
+class EnsembleStats:
+    """Running statistics of the values of replicates at every step."""
+
+    def __init__(self, quantiles: Sequence[float] = (0.05, 0.5, 0.95)):
+        self.quantiles = quantiles
+        self.count = 0
+        self.mean: Dict[str, np.ndarray] = {}
+        self.m2: Dict[str, np.ndarray] = {}
+        self.sketches: Dict[str, List[P2Quantile]] = {}
+
+    def add(self, values: Dict[str, np.ndarray]) -> None:
+        """Add the values of a replicate (see `run_replicate`). Values missing
+        in the first replicate are ignored."""
+        if self.count == 0:
+            for name, column in values.items():
+                self.mean[name] = np.zeros(len(column))
+                self.m2[name] = np.zeros(len(column))
+                self.sketches[name] = [P2Quantile(p) for p in self.quantiles]
+        self.count += 1
+        for name, mean in self.mean.items():
+            column = values.get(name)
+            if column is None:
+                column = np.full(len(mean), np.nan)
+            delta = column - mean
+            mean += delta / self.count
+            self.m2[name] += delta * (column - mean)
+            for sketch in self.sketches[name]:
+                sketch.add(column)
+
+    def rows(self, points: Optional[int] = None) -> List[Dict[str, Any]]:
+        """One row per step and value with its mean, standard deviation and
+        quantiles (as "q5", "q50", ...), for at most `points` steps."""
+        if self.count == 0:
+            return []
+        length = len(next(iter(self.mean.values())))
+        steps = np.arange(length)
+        if points is not None and length > points:
+            steps = np.unique(np.linspace(0, length - 1, points).round().astype(int))
+        rows = []
+        for name, mean in self.mean.items():
+            std = np.sqrt(self.m2[name] / max(self.count - 1, 1))
+            quantiles = {
+                quantile_name(sketch.p): sketch.value for sketch in self.sketches[name]
+            }
+            columns = {"mean": mean, "std": std, **quantiles}
+            for step in steps.tolist():
+                row: Dict[str, Any] = {"Step": step, "field": name}
+                for key, values in columns.items():
+                    # NaN is not valid JSON
+                    value = float(values[step])
+                    row[key] = None if math.isnan(value) else value
+                rows.append(row)
+        return rows
+
+
+def quantile_name(p: float) -> str:
+    """The name of a quantile in the rows of the summary, e.g. "q5" for 0.05."""
+    return "q" + format(p * 100, "g").replace(".", "_")
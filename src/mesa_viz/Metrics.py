@@ -0,0 +1,138 @@
+"""
+Metrics
+=======
+
+Timing of the phases of every step and memory usage, per session.
+
+The simulations time stepping their model, saving checkpoints and
+serializing their state. The runner adds encoding frames, writing them to
+the sockets and the time until they are flushed to the network. Durations are
+kept in cumulative histograms, which `/metrics` exposes in the Prometheus
+text format, and in a window of recent values, summarized for the frontend.
+"""
+import math
+from collections import deque
+from typing import Deque, Dict, Iterable, List, Optional, Tuple
+
+# Phases timed by the simulations, in seconds
+SIMULATION_PHASES = ("step", "checkpoint", "serialize")
+
+# Upper bounds of the histogram buckets, in seconds
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 5.0)
+
+# Gauges of a session and their descriptions
+GAUGES = {
+    "checkpoint_memory_bytes": "Size of the checkpoints held in memory",
+    "checkpoint_disk_bytes": "Size of the checkpoints spilled to disk",
+    "state_cache_bytes": "Size of the cached encoded states",
+    "pending_bytes": "Size of the frames not yet flushed to the sockets",
+    "sockets": "Number of sockets attached",
+    "last_step": "Last step with an encoded state",
+    "idle_seconds": "Time since a socket last sent a command",
+}
+
+
+class Histogram:
+    """Cumulative counts of durations per bucket, and the latest durations."""
+
+    def __init__(self, window: int = 100):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self.recent: Deque[float] = deque(maxlen=window)
+
+    def observe(self, value: float) -> None:
+        for i, bound in enumerate(BUCKETS):
+            if value <= bound:
+                break
+        else:
+            i = len(BUCKETS)
+        self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+        self.recent.append(value)
+
+
+class SessionMetrics:
+    """Histograms of the phases of a session and its gauges.
+
+    Phases of the simulations are kept per simulation index, those of the
+    runner under the index None.
+    """
+
+    def __init__(self, window: int = 100):
+        self.window = window
+        self.histograms: Dict[Tuple[str, Optional[int]], Histogram] = {}
+        self.gauges: Dict[Tuple[str, Optional[int]], float] = {}
+
+    def observe(
+        self, phase: str, seconds: float, simulation: Optional[int] = None
+    ) -> None:
+        histogram = self.histograms.get((phase, simulation))
+        if histogram is None:
+            histogram = self.histograms[phase, simulation] = Histogram(self.window)
+        histogram.observe(seconds)
+
+    def set(self, name: str, value: float, simulation: Optional[int] = None) -> None:
+        self.gauges[name, simulation] = value
+
+    def summary(self) -> Dict[str, Dict[str, float]]:
+        """Mean and 95th percentile (in ms) of the recent durations of every
+        phase, over all simulations."""
+        recent: Dict[str, List[float]] = {}
+        for (phase, _), histogram in self.histograms.items():
+            recent.setdefault(phase, []).extend(histogram.recent)
+        result = {}
+        for phase, values in recent.items():
+            values.sort()
+            p95 = values[min(math.ceil(len(values) * 0.95), len(values)) - 1]
+            result[phase] = {
+                "mean": 1000 * sum(values) / len(values),
+                "p95": 1000 * p95,
+            }
+        return result
+
+
+def prometheus_text(sessions: Iterable[Tuple[str, SessionMetrics]]) -> str:
+    """The metrics of the named sessions in the Prometheus text format."""
+    sessions = list(sessions)
+
+    def labels(session: str, simulation: Optional[int], **extra: str) -> str:
+        pairs = {"session": session, **extra}
+        if simulation is not None:
+            pairs["simulation"] = str(simulation)
+        text = ",".join(
+            '{}="{}"'.format(key, value.replace("\\", "\\\\").replace('"', '\\"'))
+            for key, value in pairs.items()
+        )
+        return "{" + text + "}"
+
+    lines = [
+        "# HELP mesa_viz_sessions Number of sessions",
+        "# TYPE mesa_viz_sessions gauge",
+        f"mesa_viz_sessions {len(sessions)}",
+        "# HELP mesa_viz_phase_seconds Duration of the phases of a step",
+        "# TYPE mesa_viz_phase_seconds histogram",
+    ]
+    for session, metrics in sessions:
+        for (phase, simulation), histogram in sorted(
+            metrics.histograms.items(), key=lambda item: (item[0][0], item[0][1] or -1)
+        ):
+            cumulative = 0
+            for bound, count in zip((*BUCKETS, "+Inf"), histogram.counts):
+                cumulative += count
+                label = labels(session, simulation, phase=phase, le=str(bound))
+                lines.append(f"mesa_viz_phase_seconds_bucket{label} {cumulative}")
+            label = labels(session, simulation, phase=phase)
+            lines.append(f"mesa_viz_phase_seconds_sum{label} {histogram.sum}")
+            lines.append(f"mesa_viz_phase_seconds_count{label} {histogram.count}")
+
+    for name, description in GAUGES.items():
+        lines.append(f"# HELP mesa_viz_{name} {description}")
+        lines.append(f"# TYPE mesa_viz_{name} gauge")
+        for session, metrics in sessions:
+            for (gauge, simulation), value in metrics.gauges.items():
+                if gauge == name:
+                    label = labels(session, simulation)
+                    lines.append(f"mesa_viz_{name}{label} {value}")
+    return "\n".join(lines) + "\n"
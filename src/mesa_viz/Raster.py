@@ -0,0 +1,104 @@
+"""
+Raster
+======
+
+Rendering of grids as images, for grids too large for one mark per agent.
+
+Every cell of the grid gets the index of a category, the value of the color
+field of the agent in it (0 for empty cells). Between steps only the tiles of
+the image that changed are sent. Images are sent with the top row first, so
+the largest `y` comes first.
+"""
+from operator import attrgetter
+from typing import Any, Dict, List, NamedTuple, Optional
+
+import numpy as np
+
+
+class Raster(NamedTuple):
+    # Category index of every cell, by row (from the top) and column
+    cells: np.ndarray
+    # Values of the categories, the first one (None) for empty cells
+    categories: List[Any]
+
+
+def rasterize(model: Any, field: str, codes: Dict[Any, int]) -> Raster:
+    """Create the image of the `field` of all agents on the grid of a model.
+
+    `codes` maps values to their category index. It is extended with new
+    values, so indices stay the same between steps.
+    """
+    grid = model.grid
+    get = attrgetter("pos", field)
+    xs, ys, indices = [], [], []
+    for agent in model.schedule.agents:
+        pos, value = get(agent)
+        if pos is None:
+            continue
+        try:
+            index = codes.get(value)
+        except TypeError:  # e.g. lists
+            value = str(value)
+            index = codes.get(value)
+        if index is None:
+            index = codes[value] = len(codes) + 1
+        xs.append(pos[0])
+        ys.append(pos[1])
+        indices.append(index)
+
+    dtype = np.uint8 if len(codes) < 2 ** 8 else np.uint16
+    cells = np.zeros((grid.height, grid.width), dtype=dtype)
+    if indices:
+        cells[grid.height - 1 - np.array(ys), np.array(xs)] = indices
+    return Raster(cells, [None, *codes])
+
+
+def raster_message(
+    raster: Raster, previous: Optional[Raster] = None, tile_size: int = 64
+) -> Dict[str, Any]:
+    """Describe an image as tiles of `tile_size` cells.
+
+    Without a `previous` image of the same size the whole image is sent as a
+    single tile, otherwise only the tiles that changed.
+    """
+    cells = raster.cells
+    height, width = cells.shape
+    message = {
+        "width": width,
+        "height": height,
+        "tileSize": tile_size,
+        "dtype": cells.dtype.name,
+        "categories": raster.categories,
+    }
+    if previous is None or previous.cells.shape != cells.shape:
+        message["tiles"] = [tile(cells, 0, 0, width, height)]
+        return message
+
+    changed = np.zeros(
+        (-(-height // tile_size) * tile_size, -(-width // tile_size) * tile_size),
+        dtype=bool,
+    )
+    changed[:height, :width] = cells != previous.cells
+    rows, columns = changed.shape[0] // tile_size, changed.shape[1] // tile_size
+    dirty = changed.reshape(rows, tile_size, columns, tile_size).any(axis=(1, 3))
+    message["tiles"] = [
+        tile(cells, column * tile_size, row * tile_size, tile_size, tile_size)
+        for row, column in zip(*np.nonzero(dirty))
+    ]
+    return message
+
+
+def tile(
+    cells: np.ndarray, x: int, y: int, width: int, height: int
+) -> Dict[str, Any]:
+    """A rectangle of an image, `x` and `y` being its top left cell."""
+    data = np.ascontiguousarray(
+        cells[y : y + height, x : x + width], dtype=cells.dtype.newbyteorder("<")
+    )
+    return {
+        "x": x,
+        "y": y,
+        "width": data.shape[1],
+        "height": data.shape[0],
+        "data": data.tobytes(),
+    }
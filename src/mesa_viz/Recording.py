@@ -0,0 +1,308 @@
+"""
+Recording
+=========
+
+Headless recording of model runs to a file, to be browsed later with a
+`ReplayServer` (see `Replay.py`).
+
+`record` steps the models of a `VegaServer` configuration without a browser
+and appends the encoded state frames to a file, exactly as they would have
+been sent. Frames are stored in zlib-compressed chunks of `chunk_size` steps.
+With delta updates every chunk starts at a keyframe, so any step can be
+restored from its chunk alone.
+
+The file starts with a magic string and a JSON header (name, specifications,
+parameters, ...). Every chunk has a small header of its own (first step,
+number of frames, compressed length), so a recording that was cut short can
+still be read by scanning its chunks. A finished recording ends with the
+chunk offsets, the time series of every model as raw arrays, and a JSON
+footer describing them, followed by the footer length and the magic string.
+
+A `Recording` memory-maps the file and decompresses only the (few most
+recently) requested chunks, so even long recordings open instantly.
+"""
+import itertools
+import json
+import mmap
+import struct
+import threading
+import zlib
+from collections import OrderedDict
+from typing import IO, Any, Dict, List, Optional, Tuple, Union
+
+import numpy as np
+
+from .Serializer import encode
+from .TimeSeries import Points, TimeSeries, downsample_points, points_since
+from .VegaVisualization import ModelRunner, VegaServer
+
+MAGIC = b"MESAVIZR"
+VERSION = 1
+
+# First step, number of frames and compressed length of a chunk
+CHUNK_HEADER = struct.Struct("<QII")
+# Length and whether it is binary, of every frame in a chunk
+FRAME_HEADER = struct.Struct("<IB")
+
+Frame = Union[str, bytes]
+
+
+class Recorder:
+    """Writes frames to a recording file, in chunks of `chunk_size` steps."""
+
+    def __init__(
+        self,
+        path: str,
+        header: Dict[str, Any],
+        chunk_size: int = 64,
+        compression: int = 6,
+    ):
+        self.chunk_size = max(chunk_size, 1)
+        self.compression = compression
+        self.steps = 0
+        self.offsets: List[int] = []
+        self._frames: List[Frame] = []
+
+        self._file: IO[bytes] = open(path, "wb")
+        data = encode({**header, "version": VERSION, "chunk_size": self.chunk_size})
+        data = data.encode()
+        self._file.write(MAGIC + struct.pack("<I", len(data)) + data)
+
+    def append(self, frame: Frame) -> None:
+        """Add the frame of the next step."""
+        self._frames.append(frame)
+        if len(self._frames) == self.chunk_size:
+            self.flush()
+
+    def flush(self) -> None:
+        """Write the pending frames as a chunk."""
+        if not self._frames:
+            return
+        body = b"".join(
+            FRAME_HEADER.pack(len(data), isinstance(frame, bytes)) + data
+            for frame, data in (
+                (frame, frame if isinstance(frame, bytes) else frame.encode())
+                for frame in self._frames
+            )
+        )
+        body = zlib.compress(body, self.compression)
+        self.offsets.append(self._file.tell())
+        self._file.write(CHUNK_HEADER.pack(self.steps, len(self._frames), len(body)))
+        self._file.write(body)
+        self.steps += len(self._frames)
+        self._frames = []
+
+    def close(self, series: Optional[List[TimeSeries]] = None) -> None:
+        """Write the remaining frames, the index and the time series of the
+        models, and close the file."""
+        self.flush()
+        footer: Dict[str, Any] = {"steps": self.steps, "chunks": len(self.offsets)}
+        footer["index"] = self._write_array(np.array(self.offsets, dtype="<u8"))
+        footer["series"] = []
+        for model_series in series or []:
+            steps, columns = model_series.arrays()
+            footer["series"].append(
+                {
+                    "length": len(steps),
+                    "steps": self._write_array(steps.astype("<i8")),
+                    "columns": {
+                        name: self._write_array(column.astype("<f8"))
+                        for name, column in columns.items()
+                    },
+                }
+            )
+        data = encode(footer).encode()
+        self._file.write(data + struct.pack("<Q", len(data)) + MAGIC)
+        self._file.close()
+
+    def _write_array(self, array: np.ndarray) -> int:
+        """Write an array aligned to 8 bytes and return its offset."""
+        self._file.write(bytes(-self._file.tell() % 8))
+        offset = self._file.tell()
+        self._file.write(array.tobytes())
+        return offset
+
+
+class Recording:
+    """Random access to the frames and time series of a recording file."""
+
+    def __init__(self, path: str, cache_size: int = 4):
+        self._file = open(path, "rb")
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._map[: len(MAGIC)] != MAGIC:
+            raise ValueError(f"{path} is not a recording")
+        (length,) = struct.unpack_from("<I", self._map, len(MAGIC))
+        start = len(MAGIC) + 4
+        self.header: Dict[str, Any] = json.loads(self._map[start : start + length])
+        if self.header["version"] != VERSION:
+            raise ValueError(f"Unsupported recording version {self.header['version']}")
+        self.chunk_size: int = self.header["chunk_size"]
+
+        self.series: List[Dict[str, Any]] = []
+        if len(self._map) >= start + length + 16 and self._map[-len(MAGIC) :] == MAGIC:
+            (footer_length,) = struct.unpack_from("<Q", self._map, len(self._map) - 16)
+            footer = json.loads(self._map[-16 - footer_length : -16])
+            self.steps: int = footer["steps"]
+            self.offsets = np.frombuffer(
+                self._map, "<u8", footer["chunks"], footer["index"]
+            ).copy()
+            self.series = footer["series"]
+        else:
+            self.steps, self.offsets = self._scan(start + length)
+
+        # Recently decompressed chunks, least recently used first. Runners of
+        # several sessions may read chunks at the same time.
+        self._chunks: "OrderedDict[int, List[Frame]]" = OrderedDict()
+        self.cache_size = max(cache_size, 1)
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return self.steps
+
+    def __getitem__(self, step: int) -> Frame:
+        """The frame of a step."""
+        if not 0 <= step < self.steps:
+            raise IndexError(f"Step {step} is not recorded")
+        return self._chunk(step // self.chunk_size)[step % self.chunk_size]
+
+    @property
+    def keyframes(self) -> range:
+        """The steps whose frames hold full states."""
+        return range(0, self.steps, self.header["keyframe_interval"])
+
+    def series_since(self, start: int, stop: int) -> List[Points]:
+        """Points of the time series of every model after `start`, up to
+        `stop`."""
+        return [points_since(*self._series(i), start, stop) for i in self._models]
+
+    def downsample_series(self, points: int, method: str, stop: int) -> List[Points]:
+        return [
+            downsample_points(*self._series(i), points, method, stop)
+            for i in self._models
+        ]
+
+    def cache_usage(self) -> int:
+        """Size of the decompressed chunks in the cache, in bytes."""
+        with self._lock:
+            chunks = list(self._chunks.values())
+        return sum(len(frame) for frame in itertools.chain(*chunks))
+
+    def close(self) -> None:
+        self._chunks.clear()
+        self._map.close()
+        self._file.close()
+
+    @property
+    def _models(self) -> range:
+        return range(len(self.header["model_ids"]))
+
+    def _series(self, model: int) -> Tuple[np.ndarray, Dict[str, np.ndarray]]:
+        """Steps and columns of the time series of a model, read from the file
+        without copying. Cut short recordings have empty series."""
+        if model >= len(self.series):
+            return np.empty(0, dtype=np.int64), {}
+        layout = self.series[model]
+        length = layout["length"]
+        return (
+            np.frombuffer(self._map, "<i8", length, layout["steps"]),
+            {
+                name: np.frombuffer(self._map, "<f8", length, offset)
+                for name, offset in layout["columns"].items()
+            },
+        )
+
+    def _chunk(self, index: int) -> List[Frame]:
+        with self._lock:
+            frames = self._chunks.get(index)
+            if frames is not None:
+                self._chunks.move_to_end(index)
+                return frames
+
+        offset = int(self.offsets[index])
+        _, count, length = CHUNK_HEADER.unpack_from(self._map, offset)
+        offset += CHUNK_HEADER.size
+        body = zlib.decompress(self._map[offset : offset + length])
+        frames = []
+        position = 0
+        for _ in range(count):
+            size, binary = FRAME_HEADER.unpack_from(body, position)
+            position += FRAME_HEADER.size
+            data = body[position : position + size]
+            frames.append(data if binary else data.decode())
+            position += size
+
+        with self._lock:
+            self._chunks[index] = frames
+            while len(self._chunks) > self.cache_size:
+                self._chunks.popitem(last=False)
+        return frames
+
+    def _scan(self, offset: int) -> Tuple[int, np.ndarray]:
+        """Find the complete chunks of a recording without index."""
+        steps = 0
+        offsets = []
+        while offset + CHUNK_HEADER.size <= len(self._map):
+            first, count, length = CHUNK_HEADER.unpack_from(self._map, offset)
+            end = offset + CHUNK_HEADER.size + length
+            if first != steps or end > len(self._map):
+                break
+            offsets.append(offset)
+            steps += count
+            offset = end
+        return steps, np.array(offsets, dtype=np.uint64)
+
+
+def record(
+    application: VegaServer,
+    path: str,
+    steps: Optional[int] = None,
+    chunk_size: int = 64,
+    compression: int = 6,
+) -> int:
+    """Run the models of `application` without a browser and record them.
+
+    Stops after `steps` steps (by default `max_steps`) or once no model is
+    running anymore. With delta updates the chunks are as long as the
+    `keyframe_interval`. Returns the number of recorded steps.
+    """
+    if steps is None:
+        steps = application.max_steps
+    keyframe_interval = 1
+    if application.delta_updates or application.rasters:
+        keyframe_interval = chunk_size = application.keyframe_interval
+        if keyframe_interval <= 0:
+            raise ValueError("Recording delta updates needs a keyframe_interval")
+
+    runner = ModelRunner(application)
+    header = {
+        "name": application.model_name,
+        "description": application.description,
+        "specs": application.vega_specifications,
+        "params": runner.user_params,
+        "model_ids": runner.model_ids,
+        "keyframe_interval": keyframe_interval,
+    }
+    # The series of the simulations only hold their latest steps, so they
+    # are collected after every chunk
+    series = [TimeSeries(steps) for _ in runner.simulations]
+
+    def collect_series(stop: int) -> None:
+        points = runner.broadcast("series_since", runner.series_step, stop)
+        for model_series, model_points in zip(series, points):
+            model_series.extend(model_points)
+        runner.series_step = stop
+
+    recorder = Recorder(path, header, chunk_size, compression)
+    try:
+        for step in range(steps):
+            frame = runner.compute_state(step)
+            if step > runner.last_step:
+                break
+            recorder.append(frame)
+            if (step + 1) % recorder.chunk_size == 0:
+                collect_series(step)
+        collect_series(runner.last_step)
+    finally:
+        recorder.close(series)
+        runner.close()
+    return recorder.steps
@@ -0,0 +1,126 @@
+"""
+Replay
+======
+
+Browsing of recorded model runs (see `Recording.py`) in the frontend.
+
+A `ReplayServer` serves a recording instead of running a model. Its runners
+use the recording in place of their cache of encoded states, so stepping,
+playing, requesting earlier states and flow control work as for live models.
+Frames are read from the memory-mapped file on demand. Parameter changes,
+interactions, sweeps and ensembles are ignored, and sessions are not saved.
+"""
+from typing import Any, Dict, List, Optional, Tuple, Union
+
+from .Recording import Recording
+from .Serializer import encode_batch
+from .VegaVisualization import ModelRunner, SocketHandler, VegaServer
+
+
+class ReplayRunner(ModelRunner):
+    """Serves the recorded states of a `ReplayServer` to a session."""
+
+    application: "ReplayServer"
+
+    def __init__(
+        self,
+        application: "ReplayServer",
+        socket_handler: Optional[SocketHandler] = None,
+    ):
+        self.recording = application.recording
+        super().__init__(application, socket_handler)
+        self.states = self.recording  # type: ignore
+        self.keyframes = self.recording.keyframes  # type: ignore
+        self.first_cached = 0
+        self.end_step = len(self.recording) - 1
+        self.replaying = False
+
+    def create_simulations(self) -> List[Any]:
+        return []
+
+    @property
+    def model_ids(self) -> List[int]:
+        return self.recording.header["model_ids"]
+
+    @property
+    def user_params(self) -> List[Dict[str, Any]]:
+        return self.recording.header["params"]
+
+    @property
+    def started(self) -> bool:
+        return self.replaying
+
+    def broadcast(self, method: str, *args: Any) -> List[Any]:
+        """Answer the time series requests of the runner from the recording."""
+        return getattr(self.recording, method)(*args)
+
+    def collect_metrics(self) -> None:
+        pass
+
+    def cache_usage(self) -> int:
+        return self.recording.cache_usage()
+
+    def compute_state(self, step: int) -> Union[str, bytes]:
+        return self.states[min(step, self.last_step)]
+
+    def standalone_frames(self, step: int) -> List[Union[str, bytes]]:
+        """The frame of `step`, preceded by the frames since the last keyframe
+        as a batch if it is a delta frame."""
+        interval = self.recording.header["keyframe_interval"]
+        keyframe = step - step % interval
+        if keyframe == step:
+            return [self.states[step]]
+        history = [self.states[previous] for previous in range(keyframe, step)]
+        return [
+            encode_batch("modelStates/batchReceived", history),
+            self.states[step],
+        ]
+
+    def reset_models(self) -> None:
+        """Start over at the first recorded step."""
+        for socket in self.sockets:
+            socket.skipped_step = None
+            socket.last_step = 0
+        self.series_step = -1
+        self.series_points = 0
+        self.replaying = True
+
+    def submit_params(self, model: int, param: str, value: Any) -> None:
+        pass
+
+    def save_session(self, path: str) -> None:
+        """Replays are not saved, they start over with the recording."""
+
+    async def interact_all(self, calls: List[Tuple[int, str, Dict[str, Any]]]) -> None:
+        pass
+
+    def sweep(self, params: Optional[List[str]] = None) -> None:
+        pass
+
+    def ensemble(self, replicates: Optional[int] = None) -> None:
+        pass
+
+
+class ReplayServer(VegaServer):
+    """Visualization of a recording made with `record`, instead of a model."""
+
+    runner_cls = ReplayRunner
+
+    def __init__(self, path: str):
+        self.recording = Recording(path)
+        header = self.recording.header
+        self.model_name = header["name"]
+        self.model_cls = None
+        self.description = header["description"]
+        self.n_simulations = len(header["model_ids"])
+        self.model_params = {}
+        self.model_kwargs = [{} for _ in range(self.n_simulations)]
+        self.charts = self.vega_specifications = header["specs"]
+        self.spec_cache = None
+        # Frames are already encoded, with their raster images. The agents of
+        # space charts depend on the viewport, so they are not recorded.
+        self.rasters = []
+        self.spaces = []
+        self.projection = None
+        self.lookahead = 0
+        self.init_application()
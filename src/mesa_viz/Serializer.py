@@ -0,0 +1,355 @@
+"""
+Serializer
+==========
+
+Extraction of the visualization data of models and agents.
+
+Looking up which attributes and properties of an object can be sent to the
+frontend is comparatively expensive, so it is done only once per class. The
+result is compiled into a `ClassSerializer` that reads exactly those fields
+from every instance. References to other objects (like the `model` of an
+agent, the grid or the scheduler) are skipped, positions are split into `x`
+and `y` values.
+
+Classes can still define an `as_dict` method to fully control their data.
+"""
+import json
+import numbers
+import struct
+import sys
+from array import array
+from operator import attrgetter
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    Dict,
+    FrozenSet,
+    List,
+    Optional,
+    Tuple,
+    Union,
+)
+
+if TYPE_CHECKING:
+    from mesa.model import Model
+
+JSON_TYPES = (str, int, float, bool, type(None))
+
+# Attributes that are never serialized, even if their value would be
+SKIPPED_ATTRIBUTES = ("model", "pos")
+
+
+def is_serializable(value: Any) -> bool:
+    """Whether a value can be sent to the frontend without conversion."""
+    if isinstance(value, JSON_TYPES) or isinstance(value, numbers.Number):
+        return True
+    if isinstance(value, (list, tuple)):
+        return all(isinstance(item, JSON_TYPES) for item in value)
+    if isinstance(value, dict):
+        return all(
+            isinstance(key, str) and isinstance(item, JSON_TYPES)
+            for key, item in value.items()
+        )
+    return False
+
+
+def get_property_names(cls: type) -> Tuple[str, ...]:
+    """Names of all properties of a class, including inherited ones."""
+    names: Dict[str, None] = {}
+    for klass in reversed(cls.__mro__):
+        for key, value in vars(klass).items():
+            if isinstance(value, property):
+                names[key] = None
+            else:
+                names.pop(key, None)
+    return tuple(names)
+
+
+def get_properties(obj: Any) -> Dict[str, Any]:
+    return {key: getattr(obj, key) for key in get_property_names(type(obj))}
+
+
+class ClassSerializer:
+    """Extracts the data of instances of a single class.
+
+    The layout of the extracted data is determined from the first instance
+    and recomputed only if an instance has a different set of attributes.
+    If `fields` are given, only those fields are extracted.
+    """
+
+    def __init__(self, cls: type, fields: Optional[FrozenSet[str]] = None):
+        self.cls = cls
+        self.fields = fields
+        self.has_dict = callable(getattr(cls, "as_dict", None))
+        self.property_names = get_property_names(cls)
+
+        self.names: Tuple[str, ...] = ()
+        self.containers: Tuple[str, ...] = ()
+        self.split_pos = False
+        self.getter = None
+        self._attribute_keys: Optional[frozenset] = None
+
+    def __call__(self, obj: Any) -> Dict[str, Any]:
+        if self.has_dict:
+            data = obj.as_dict()
+            if self.fields is None:
+                return dict(data)
+            return {key: data[key] for key in self.fields if key in data}
+
+        attributes = vars(obj)
+        if attributes.keys() != self._attribute_keys:
+            self.compile(obj)
+
+        if len(self.names) == 1:
+            data = {self.names[0]: self.getter(obj)}
+        elif self.names:
+            data = dict(zip(self.names, self.getter(obj)))
+        else:
+            data = {}
+
+        # Copy containers, so later changes by the model are not reflected
+        for name in self.containers:
+            value = data[name]
+            data[name] = dict(value) if isinstance(value, dict) else tuple(value)
+
+        if self.split_pos and attributes.get("pos") is not None:
+            data["x"], data["y"] = obj.pos[:2]
+        return data
+
+    def compile(self, obj: Any) -> None:
+        """Determine the serialized fields from an instance."""
+        attributes = vars(obj)
+        if self.fields is None:
+            names = [
+                key
+                for key, value in attributes.items()
+                if key not in SKIPPED_ATTRIBUTES and is_serializable(value)
+            ]
+            candidates = [
+                name for name in self.property_names if name not in attributes
+            ]
+        else:
+            names = []
+            candidates = list(self.fields)
+
+        for name in candidates:
+            if name in SKIPPED_ATTRIBUTES:
+                continue
+            try:
+                value = getattr(obj, name)
+            except Exception:
+                continue
+            if self.fields is not None or is_serializable(value):
+                names.append(name)
+
+        self.names = tuple(names)
+        self.containers = tuple(
+            name
+            for name in names
+            if isinstance(getattr(obj, name), (list, tuple, dict))
+        )
+        self.split_pos = (
+            "pos" in attributes
+            and "x" not in self.names
+            and "y" not in self.names
+            and (self.fields is None or "x" in self.fields or "y" in self.fields)
+        )
+        self.getter = attrgetter(*self.names) if self.names else None
+        self._attribute_keys = frozenset(attributes)
+
+
+# Fields to extract per dataset ("agents" and "model"), None meaning all fields.
+# Datasets missing from a projection are not extracted.
+Projection = Dict[str, Optional[FrozenSet[str]]]
+
+_serializers: Dict[Tuple[type, Optional[FrozenSet[str]]], ClassSerializer] = {}
+
+
+def get_serializer(
+    cls: type, fields: Optional[FrozenSet[str]] = None
+) -> ClassSerializer:
+    """Return the (cached) serializer for a class."""
+    serializer = _serializers.get((cls, fields))
+    if serializer is None:
+        serializer = _serializers[cls, fields] = ClassSerializer(cls, fields)
+    return serializer
+
+
+def serialize_agents(
+    agents: List[Any], fields: Optional[FrozenSet[str]] = None
+) -> List[Dict[str, Any]]:
+    """Extract the data of a list of agents, adding their `unique_id`."""
+    result = []
+    serializer = None
+    for agent in agents:
+        if serializer is None or serializer.cls is not type(agent):
+            serializer = get_serializer(type(agent), fields)
+        data = serializer(agent)
+        if "unique_id" not in data:
+            data["unique_id"] = agent.unique_id
+        result.append(data)
+    return result
+
+
+def as_json(model: "Model", projection: Optional[Projection] = None) -> Dict[str, Any]:
+    """Extract the data of a model and all of its agents.
+
+    If a `projection` is given only the listed fields are extracted.
+    """
+    if projection is None:
+        projection = {"model": None, "agents": None}
+    serializer = get_serializer(type(model), projection.get("model", frozenset()))
+    model_data = serializer(model)
+    model_data["agents"] = []
+    if "agents" in projection:
+        model_data["agents"] = serialize_agents(
+            model.schedule.agents, projection["agents"]
+        )
+    return model_data
+
+
+def _default(value: Any) -> Any:
+    item = getattr(value, "item", None)  # numpy scalars
+    if callable(item):
+        return item()
+    return str(value)
+
+
+def encode(message: Any) -> str:
+    """Encode a message for the websocket."""
+    return json.dumps(message, separators=(",", ":"), default=_default)
+
+
+# Columnar frames
+# ---------------
+#
+# Instead of a list of objects, repeating every key for every agent, agent
+# data can be sent as one typed array per field in a binary frame. A frame
+# starts with the byte length of a JSON header (uint32, little endian),
+# followed by the header and the column buffers. The header is the original
+# message in which every list of agents is replaced by a description of its
+# columns. Header and buffers are padded to 8 bytes, so the frontend can read
+# the buffers as typed arrays without copying. Other binary data (bytes) is
+# included as a buffer as well, described by {"$bytes": length, "offset": ...}.
+
+# Keys of lists of agent data that are sent as columns
+AGENT_LISTS = ("agents", "added", "changed")
+
+# (array typecode, dtype, min, max) of the integer types, smallest first
+INTEGER_TYPES = (
+    ("B", "uint8", 0, 2 ** 8 - 1),
+    ("b", "int8", -(2 ** 7), 2 ** 7 - 1),
+    ("H", "uint16", 0, 2 ** 16 - 1),
+    ("h", "int16", -(2 ** 15), 2 ** 15 - 1),
+    ("I", "uint32", 0, 2 ** 32 - 1),
+    ("i", "int32", -(2 ** 31), 2 ** 31 - 1),
+)
+
+
+def integer_array(values: List[int]) -> Tuple[str, array]:
+    """Pack integers into the smallest fitting typed array."""
+    low, high = min(values, default=0), max(values, default=0)
+    for typecode, dtype, type_min, type_max in INTEGER_TYPES:
+        if type_min <= low and high <= type_max:
+            return dtype, array(typecode, values)
+    return "float64", array("d", values)
+
+
+def encode_column(values: List[Any]) -> Tuple[Dict[str, Any], Optional[array]]:
+    """Encode the values of a single column.
+
+    Returns the column description and its buffer. Columns of mixed or
+    non-numeric types are included as plain values in the description,
+    strings are encoded as codes of their categories and integer tuples of
+    equal length (positions) are flattened.
+    """
+    types = set(map(type, values))
+    if types == {tuple} or types == {list}:
+        widths = set(map(len, values))
+        flat = [item for value in values for item in value]
+        if len(widths) == 1 and set(map(type, flat)) == {int}:
+            dtype, buffer = integer_array(flat)
+            return {"dtype": dtype, "width": widths.pop()}, buffer
+    if types == {bool}:
+        return {"dtype": "bool"}, array("B", values)
+    if types == {int}:
+        dtype, buffer = integer_array(values)
+        return {"dtype": dtype}, buffer
+    if types == {int, float} or types == {float}:
+        return {"dtype": "float64"}, array("d", values)
+    if types == {str}:
+        codes: Dict[str, int] = {}
+        indices = [codes.setdefault(value, len(codes)) for value in values]
+        dtype, buffer = integer_array(indices)
+        return {"dtype": dtype, "categories": list(codes)}, buffer
+    return {"values": values}, None
+
+
+def encode_columnar(message: Dict[str, Any]) -> bytes:
+    """Encode a message as a binary frame with columns of agent data."""
+    buffers: List[bytes] = []
+    offset = 0
+
+    def add_buffer(data: bytes) -> int:
+        nonlocal offset
+        start = offset
+        padding = -len(data) % 8
+        buffers.append(data + bytes(padding))
+        offset += len(data) + padding
+        return start
+
+    def to_columns(records: List[Dict[str, Any]]) -> Dict[str, Any]:
+        names: Dict[str, None] = {}
+        for record in records:
+            names.update(dict.fromkeys(record))
+
+        columns = {}
+        for name in names:
+            column, buffer = encode_column([record.get(name) for record in records])
+            if buffer is not None:
+                if sys.byteorder != "little":
+                    buffer.byteswap()
+                column["offset"] = add_buffer(buffer.tobytes())
+            columns[name] = column
+        return {"length": len(records), "columns": columns}
+
+    def replace_agents(value: Any) -> Any:
+        if isinstance(value, dict):
+            return {
+                key: to_columns(item)
+                if key in AGENT_LISTS and isinstance(item, list)
+                else replace_agents(item)
+                for key, item in value.items()
+            }
+        if isinstance(value, list):
+            return [replace_agents(item) for item in value]
+        if isinstance(value, bytes):
+            return {"$bytes": len(value), "offset": add_buffer(value)}
+        return value
+
+    header = encode(replace_agents(message)).encode()
+    header += b" " * (-(len(header) + 4) % 8)
+    return b"".join([struct.pack("<I", len(header)), header, *buffers])
+
+
+def encode_batch(
+    message_type: str, frames: List[Union[str, bytes]]
+) -> Union[str, bytes]:
+    """Combine already encoded frames into a single frame.
+
+    JSON frames are joined into a list as payload. Binary (columnar) frames
+    are concatenated behind a header with their lengths, each padded to 8
+    bytes.
+    """
+    if not any(isinstance(frame, bytes) for frame in frames):
+        return '{"type":"%s","payload":[%s]}' % (message_type, ",".join(frames))
+
+    header = encode({"type": message_type, "frames": list(map(len, frames))}).encode()
+    header += b" " * (-(len(header) + 4) % 8)
+    return b"".join(
+        [
+            struct.pack("<I", len(header)),
+            header,
+            *(frame + bytes(-len(frame) % 8) for frame in frames),
+        ]
+    )
@@ -0,0 +1,322 @@
+"""
+Serving
+=======
+
+Production serving of a `VegaServer` in several worker processes.
+
+`serve` binds the listening sockets once and forks `processes` workers that
+all accept connections on them, so sessions are spread over the cores. The
+parent only supervises them: it restarts workers that crashed, and on SIGTERM
+or SIGINT asks all of them to shut down gracefully. A worker then stops
+accepting connections, closes its websockets, waits up to `shutdown_timeout`
+seconds for their sessions to close and stops the remaining ones.
+
+All sockets of a named session (`/ws?session=name`) have to reach the worker
+running it. The worker accepting a connection peeks at its request line
+without consuming it, and hands connections of sessions that belong to
+another worker (by a hash of their name) over to that worker, by passing the
+file descriptor over a Unix socket (as SCM_RIGHTS ancillary data).
+"""
+import array
+import asyncio
+import json
+import os
+import random
+import signal
+import socket
+import sys
+import time
+import traceback
+import zlib
+from typing import TYPE_CHECKING, Any, Dict, List, Optional, Tuple
+from urllib.parse import parse_qs, urlsplit
+
+import tornado.httpserver
+import tornado.ioloop
+import tornado.iostream
+import tornado.log
+import tornado.netutil
+import tornado.process
+
+if TYPE_CHECKING:
+    from .VegaVisualization import VegaServer
+
+# Longest request line that is peeked at for a session name
+MAX_REQUEST_LINE = 8192
+
+# Workers restarted after crashing, before the parent gives up
+MAX_RESTARTS = 100
+
+# Unix sockets the workers receive connections of their sessions on. Worker
+# `i` receives on the second socket of `channels[i]`, the others send on the
+# first one.
+Channels = List[Tuple[socket.socket, socket.socket]]
+
+
+def send_fd(channel: socket.socket, message: bytes, fd: int) -> None:
+    """Send a message with a file descriptor over a Unix socket."""
+    channel.sendmsg(
+        [message], [(socket.SOL_SOCKET, socket.SCM_RIGHTS, array.array("i", [fd]))]
+    )
+
+
+def receive_fds(channel: socket.socket, size: int) -> Tuple[bytes, List[int]]:
+    """Receive a message sent by `send_fd` and its file descriptors."""
+    fds = array.array("i")
+    message, ancillary, _, _ = channel.recvmsg(size, socket.CMSG_SPACE(fds.itemsize))
+    for level, kind, data in ancillary:
+        if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+            fds.frombytes(data[: len(data) - len(data) % fds.itemsize])
+    return message, list(fds)
+
+
+def session_worker(session: str, processes: int) -> int:
+    """The index of the worker running a named session."""
+    return zlib.crc32(session.encode()) % processes
+
+
+def request_session(request_line: bytes) -> Optional[str]:
+    """The session name in the query of a request line, if any."""
+    parts = request_line.split(b" ")
+    if len(parts) != 3:
+        return None
+    query = parse_qs(urlsplit(parts[1].decode("latin-1")).query)
+    sessions = query.get("session")
+    return sessions[0] if sessions else None
+
+
+class WorkerHTTPServer(tornado.httpserver.HTTPServer):
+    """HTTP server of a worker, handing connections of named sessions over to
+    the worker running them."""
+
+    def initialize(  # type: ignore
+        self,
+        application: "VegaServer",
+        worker: int = 0,
+        channels: Optional[Channels] = None,
+        **kwargs: Any,
+    ) -> None:
+        super().initialize(application, **kwargs)
+        self.worker = worker
+        self.channels = channels or []
+
+    def start_receiving(self) -> None:
+        """Handle the connections handed over by other workers."""
+        if self.channels:
+            channel = self.channels[self.worker][1]
+            channel.setblocking(False)
+            tornado.ioloop.IOLoop.current().add_handler(
+                channel, self.receive_connection, tornado.ioloop.IOLoop.READ
+            )
+
+    def stop(self) -> None:
+        super().stop()
+        if self.channels:
+            channel = self.channels[self.worker][1]
+            tornado.ioloop.IOLoop.current().remove_handler(channel)
+
+    async def handle_stream(  # type: ignore
+        self, stream: tornado.iostream.IOStream, address: Tuple
+    ) -> None:
+        if not self.channels:
+            return super().handle_stream(stream, address)
+        session = request_session(await self.peek_request_line(stream.socket))
+        worker = self.worker
+        if session is not None:
+            worker = session_worker(session, len(self.channels))
+        if worker == self.worker:
+            return super().handle_stream(stream, address)
+
+        try:
+            send_fd(
+                self.channels[worker][0],
+                json.dumps(address).encode(),
+                stream.socket.fileno(),
+            )
+        except OSError:
+            tornado.log.app_log.exception("Handing over a connection failed")
+            return super().handle_stream(stream, address)
+        # The receiving worker has its own copy of the connection
+        stream.close()
+
+    async def peek_request_line(self, connection: socket.socket) -> bytes:
+        """The request line of a new connection, read without consuming it
+        (empty if it didn't arrive in time)."""
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + 10
+        data = b""
+        while b"\r\n" not in data and len(data) < MAX_REQUEST_LINE:
+            readable = loop.create_future()
+            loop.add_reader(
+                connection, lambda: readable.done() or readable.set_result(None)
+            )
+            try:
+                await asyncio.wait_for(readable, deadline - loop.time())
+            except asyncio.TimeoutError:
+                return b""
+            finally:
+                loop.remove_reader(connection)
+            try:
+                peeked = connection.recv(MAX_REQUEST_LINE, socket.MSG_PEEK)
+            except BlockingIOError:
+                continue
+            except OSError:
+                return b""
+            if len(peeked) == len(data):
+                # Closed, or only part of the line arrived so far
+                if not peeked:
+                    return b""
+                await asyncio.sleep(0.01)
+            data = peeked
+        return data.split(b"\r\n", 1)[0]
+
+    def receive_connection(self, channel: socket.socket, events: int) -> None:
+        try:
+            message, fds = receive_fds(channel, 1024)
+        except BlockingIOError:
+            return
+        for fd in fds:
+            connection = socket.socket(fileno=fd)
+            connection.setblocking(False)
+            stream = tornado.iostream.IOStream(
+                connection,
+                max_buffer_size=self.max_buffer_size,
+                read_chunk_size=self.read_chunk_size,
+            )
+            address = tuple(json.loads(message))
+            tornado.httpserver.HTTPServer.handle_stream(self, stream, address)
+
+
+async def shutdown(
+    application: "VegaServer", server: WorkerHTTPServer, timeout: float
+) -> None:
+    """Stop accepting connections, save the named sessions (if the
+    application has a `session_dir`), close all sockets and wait up to
+    `timeout` seconds for their sessions to close, then stop the IOLoop."""
+    server.stop()
+    # Named sessions are saved to continue after a restart
+    runners = list(application.runners)
+    await asyncio.gather(*(application.save_session(runner) for runner in runners))
+    for runner in runners:
+        for connection in list(runner.sockets):
+            connection.close_with_reason(1001, "Server shutting down")
+    deadline = time.monotonic() + timeout
+    while application.runners and time.monotonic() < deadline:
+        await asyncio.sleep(0.05)
+    for runner in list(application.runners):
+        runner.close()
+    application.close_executors()
+    tornado.ioloop.IOLoop.current().stop()
+
+
+def run_worker(
+    application: "VegaServer",
+    sockets: List[socket.socket],
+    worker: int = 0,
+    channels: Optional[Channels] = None,
+    shutdown_timeout: float = 10.0,
+) -> None:
+    """Serve the application on the sockets until asked to shut down."""
+    server = WorkerHTTPServer(application, worker=worker, channels=channels)
+    server.add_sockets(sockets)
+    server.start_receiving()
+
+    loop = asyncio.get_event_loop()
+    stopping: List[asyncio.Future] = []
+
+    def stop() -> None:
+        if not stopping:
+            stopping.append(
+                asyncio.ensure_future(
+                    shutdown(application, server, shutdown_timeout)
+                )
+            )
+
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(signum, stop)
+    tornado.ioloop.IOLoop.current().start()
+
+
+def serve(
+    application: "VegaServer",
+    port: int,
+    address: str = "",
+    processes: int = 1,
+    shutdown_timeout: float = 10.0,
+) -> None:
+    """Serve the application in `processes` worker processes (0 for one per
+    CPU), until SIGTERM or SIGINT."""
+    sockets = tornado.netutil.bind_sockets(port, address)
+    if processes <= 0:
+        processes = tornado.process.cpu_count()
+    if processes > 1 and not (hasattr(os, "fork") and hasattr(socket, "SCM_RIGHTS")):
+        tornado.log.gen_log.warning("Serving in a single process on this platform")
+        processes = 1
+    if processes == 1:
+        run_worker(application, sockets, shutdown_timeout=shutdown_timeout)
+        return
+
+    channels = [
+        socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM) for _ in range(processes)
+    ]
+    # Worker index by process id
+    children: Dict[int, int] = {}
+    stopping = False
+
+    def start(worker: int) -> None:
+        pid = os.fork()
+        if pid:
+            children[pid] = worker
+            return
+        status = 0
+        try:
+            for signum in (signal.SIGTERM, signal.SIGINT):
+                signal.signal(signum, signal.SIG_DFL)
+            # Don't share the random state of the parent
+            random.seed()
+            run_worker(application, sockets, worker, channels, shutdown_timeout)
+        except BaseException:
+            traceback.print_exc()
+            status = 1
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os._exit(status)
+
+    def stop(signum: int, frame: Any) -> None:
+        nonlocal stopping
+        stopping = True
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    for worker in range(processes):
+        start(worker)
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(signum, stop)
+
+    restarts = 0
+    while children:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        worker = children.pop(pid, None)
+        if worker is None or stopping:
+            continue
+        if os.WIFSIGNALED(status) or os.WEXITSTATUS(status) != 0:
+            restarts += 1
+            if restarts > MAX_RESTARTS:
+                stop(signal.SIGTERM, None)
+                continue
+            tornado.log.gen_log.warning(
+                "Worker %d (pid %d) exited with status %d, restarting",
+                worker,
+                pid,
+                status,
+            )
+            start(worker)
+    for connection in sockets:
+        connection.close()
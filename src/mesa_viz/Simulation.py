@@ -0,0 +1,374 @@
+"""
+Simulation
+==========
+
+A single model run with its own checkpoints and time series, and a proxy that
+runs it in a separate worker process.
+
+A ModelRunner talks to both through `call` and `result`: it first instructs
+all of its simulations and collects their results afterwards (see
+`call_all`), so simulations in worker processes do their work in parallel.
+
+Every simulation tracks its own step. It only restores a checkpoint when it
+is asked for a step it is not at and cannot reach by stepping forward, and
+keeps the states of its latest steps. So after an interaction with one model
+the others serve the recomputed steps from their recent states, without being
+rewound and stepped again.
+"""
+import multiprocessing
+import pickle
+import threading
+import time
+import traceback
+from collections import OrderedDict, deque
+from typing import Any, Deque, Dict, Iterable, List, Optional, Tuple
+
+import tornado.log
+
+from .Checkpoints import CheckpointStore, own_generators
+from .Metrics import SIMULATION_PHASES
+from .Raster import rasterize
+from .Serializer import Projection, as_json, get_serializer
+from .Space import snapshot
+from .TimeSeries import Points, TimeSeries
+
+# Mesa (0.9) models use the random number generator on their class while they
+# are created, models created at once in several threads would share one
+_creating = threading.Lock()
+
+
+class Simulation:
+    """A model together with the checkpoints of its previous steps and the
+    history of its values."""
+
+    def __init__(
+        self,
+        model_cls: Any,
+        checkpoint_options: Dict[str, Any],
+        series_capacity: int = 100000,
+        recent_states: int = 2,
+    ):
+        self.model_cls = model_cls
+        self.model: Any = None
+        self.current_step = 0
+        self.checkpoints = CheckpointStore(**checkpoint_options)
+        self.series = TimeSeries(series_capacity)
+        # States of the latest steps, by step
+        self.recent_states: "OrderedDict[int, Tuple[Dict[str, Any], bool]]" = (
+            OrderedDict()
+        )
+        self.recent_size = max(recent_states, 1)
+        # Category indices of the values of each rastered color field
+        self.raster_codes: Dict[str, Dict[Any, int]] = {}
+        # Durations of the phases since the metrics were last taken
+        self.timings: Dict[str, Deque[float]] = {
+            phase: deque(maxlen=1000) for phase in SIMULATION_PHASES
+        }
+        self._result: Any = None
+
+    def call(self, method: str, *args: Any) -> None:
+        self._result = getattr(self, method)(*args)
+
+    def result(self) -> Any:
+        result, self._result = self._result, None
+        return result
+
+    def reset(self, model_params: Dict[str, Any]) -> None:
+        """Reinstantiate the model with the given parameters."""
+        self.checkpoints.clear()
+        self.series.clear()
+        self.recent_states.clear()
+        with _creating:
+            self.model = self.model_cls(**model_params)
+            own_generators(self.model)
+        self.current_step = 0
+        self.record()
+
+    def state(
+        self,
+        projection: Optional[Projection],
+        rasters: List[str] = (),
+        spaces: List[Optional[str]] = (),
+    ) -> Tuple[Dict[str, Any], bool]:
+        """The data of the model and whether it is still running.
+
+        For every field in `rasters` an image of the grid is added, for every
+        (color) field in `spaces` a snapshot of the agent positions.
+        """
+        start = time.perf_counter()
+        data = as_json(self.model, projection)
+        if rasters:
+            data["rasters"] = [
+                rasterize(self.model, field, self.raster_codes.setdefault(field, {}))
+                for field in rasters
+            ]
+        if spaces:
+            data["spaces"] = [snapshot(self.model, field) for field in spaces]
+        self.timings["serialize"].append(time.perf_counter() - start)
+        self.recent_states.pop(self.current_step, None)
+        self.recent_states[self.current_step] = (data, self.model.running)
+        while len(self.recent_states) > self.recent_size:
+            self.recent_states.popitem(last=False)
+        # The caller may change its copy, e.g. take out the space snapshots
+        return dict(data), self.model.running
+
+    def state_at(
+        self,
+        step: int,
+        projection: Optional[Projection],
+        rasters: List[str] = (),
+        spaces: List[Optional[str]] = (),
+    ) -> Tuple[Dict[str, Any], bool]:
+        """The state of `step`, from the recent states if it is among them.
+        Otherwise the model is brought to `step` first."""
+        recent = self.recent_states.get(step)
+        if recent is not None:
+            data, running = recent
+            return dict(data), running
+        self.restore(step)
+        return self.state(projection, rasters, spaces)
+
+    def step_ahead(self) -> bool:
+        """Advance the model by one step and return whether it is still running."""
+        start = time.perf_counter()
+        if self.checkpoints.save(self.current_step, self.model):
+            self.timings["checkpoint"].append(time.perf_counter() - start)
+        start = time.perf_counter()
+        self.model.step()
+        self.timings["step"].append(time.perf_counter() - start)
+        self.current_step += 1
+        self.record()
+        return self.model.running
+
+    def take_metrics(self) -> Dict[str, Any]:
+        """The durations of the phases since the last call, and the memory
+        used by the checkpoints."""
+        timings = {phase: list(values) for phase, values in self.timings.items()}
+        for values in self.timings.values():
+            values.clear()
+        return {
+            "timings": timings,
+            "checkpoint_memory_bytes": self.checkpoints.memory_usage,
+            "checkpoint_disk_bytes": self.checkpoints.disk_usage,
+        }
+
+    def record(self) -> None:
+        """Add the values of the model to its time series."""
+        data = get_serializer(type(self.model))(self.model)
+        self.series.append(self.current_step, data)
+
+    def series_since(self, start: int, stop: int) -> Points:
+        """Points of the time series after `start`, up to `stop`."""
+        return self.series.since(start, stop)
+
+    def downsample_series(self, points: int, method: str, stop: int) -> Points:
+        return self.series.downsample(points, method, stop)
+
+    def restore(self, step: int) -> None:
+        """Bring the model to `step`.
+
+        The nearest checkpoint is only restored if the model is past `step`,
+        or if the checkpoint is closer than the current step.
+        """
+        if step == self.current_step:
+            return
+        checkpoint = self.checkpoints.nearest(step)
+        if step < self.current_step or (
+            checkpoint is not None and checkpoint > self.current_step
+        ):
+            if checkpoint is None:
+                raise ValueError(f"No checkpoint available for step {step}")
+            self.model = self.checkpoints.load(checkpoint)
+            self.current_step = checkpoint
+        while self.current_step < step:
+            self.step_ahead()
+
+    def rewind(self, step: int, projection: Optional[Projection]) -> None:
+        """Bring the model back to `step` to interact with it.
+
+        If the step was shown, the data of the restored model is compared with
+        it: models drawing from the global random generators are not restored
+        exactly, and would be interacted with in a state nobody saw.
+        """
+        shown = self.recent_states.get(step)
+        if step == self.current_step:
+            return
+        self.restore(step)
+        if shown is None:
+            return
+        data = {
+            key: value
+            for key, value in shown[0].items()
+            if key not in ("rasters", "spaces")
+        }
+        if as_json(self.model, projection) != data:
+            tornado.log.app_log.warning(
+                f"Restored step {step} of {type(self.model).__name__} differs "
+                "from the one shown, set checkpoint_interval to 1 if the model "
+                "draws from the global random generators"
+            )
+
+    def advance(self, step: int) -> bool:
+        """Bring the model to `step`, unless it is there already, and return
+        whether it is still running.
+
+        A model past `step` (e.g. one that looked ahead while another model
+        was interacted with) is left there if it still has the state of
+        `step`, which `state_at` serves.
+        """
+        recent = self.recent_states.get(step)
+        if recent is not None and step <= self.current_step:
+            return recent[1]
+        self.restore(step)
+        return self.model.running
+
+    def interact(self, method: str, data: Dict[str, Any]) -> None:
+        """Call an interaction method (like `on_click`) of the model.
+
+        The changed model is kept as a keyframe, since later checkpoints are
+        outdated and re-stepping from an earlier one would lose the
+        interaction.
+        """
+        try:
+            getattr(self.model, method)(**data)
+        except (AttributeError, TypeError):
+            pass
+        for step in [step for step in self.recent_states if step >= self.current_step]:
+            del self.recent_states[step]
+        self.checkpoints.truncate(self.current_step)
+        self.checkpoints.save(self.current_step, self.model, keyframe=True)
+        self.series.truncate(self.current_step - 1)
+        self.record()
+
+    def save(self, path: str) -> None:
+        """Write the model with its checkpoints and time series to a file.
+
+        The spilled checkpoints follow the pickle, so they aren't read into
+        memory.
+        """
+        with open(path, "wb") as file:
+            pickle.dump(
+                (
+                    self.model,
+                    self.current_step,
+                    self.checkpoints,
+                    self.series,
+                    self.recent_states,
+                    self.raster_codes,
+                ),
+                file,
+                pickle.HIGHEST_PROTOCOL,
+            )
+            self.checkpoints.write_spilled(file)
+
+    def load(self, path: str) -> None:
+        """Continue the simulation written to a file by `save`."""
+        with open(path, "rb") as file:
+            saved = pickle.load(file)
+            saved[2].read_spilled(file)
+        self.checkpoints.clear()
+        (
+            self.model,
+            self.current_step,
+            self.checkpoints,
+            self.series,
+            self.recent_states,
+            self.raster_codes,
+        ) = saved
+
+    def close(self) -> None:
+        self.checkpoints.clear()
+
+
+def serve(
+    connection: Any,
+    model_cls: Any,
+    checkpoint_options: Dict[str, Any],
+    series_capacity: int,
+    recent_states: int,
+) -> None:
+    """Main loop of a worker process: call methods of a `Simulation`."""
+    simulation = Simulation(
+        model_cls, checkpoint_options, series_capacity, recent_states
+    )
+    while True:
+        try:
+            command = connection.recv()
+        except (EOFError, KeyboardInterrupt):
+            break
+        if command is None:
+            break
+        method, args = command
+        try:
+            connection.send((True, getattr(simulation, method)(*args)))
+        except Exception:
+            connection.send((False, traceback.format_exc()))
+    simulation.close()
+
+
+class SimulationProcess:
+    """Runs a `Simulation` in a worker process."""
+
+    def __init__(
+        self,
+        model_cls: Any,
+        checkpoint_options: Dict[str, Any],
+        series_capacity: int = 100000,
+        recent_states: int = 2,
+    ):
+        self.connection, child = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(
+            target=serve,
+            args=(child, model_cls, checkpoint_options, series_capacity, recent_states),
+            daemon=True,
+        )
+        self.process.start()
+        child.close()
+
+    def call(self, method: str, *args: Any) -> None:
+        self.connection.send((method, args))
+
+    def result(self) -> Any:
+        success, result = self.connection.recv()
+        if not success:
+            raise RuntimeError(f"Error in simulation process:\n{result}")
+        return result
+
+    def close(self) -> None:
+        try:
+            self.connection.send(None)
+        except (BrokenPipeError, OSError):
+            pass
+        self.process.join(timeout=1)
+        if self.process.is_alive():
+            self.process.terminate()
+        self.connection.close()
+
+
+def call_all(calls: Iterable[Tuple[Any, str, Tuple[Any, ...]]]) -> List[Any]:
+    """Call a method of each simulation, then return their results in order.
+
+    All results are read before the first error is raised, so no worker
+    process is left with a reply that the next call would take for its own.
+    """
+    errors: List[Exception] = []
+    called: List[Optional[Any]] = []
+    for simulation, method, args in calls:
+        try:
+            simulation.call(method, *args)
+        except Exception as error:
+            errors.append(error)
+            simulation = None
+        called.append(simulation)
+    results: List[Any] = []
+    for simulation in called:
+        result = None
+        if simulation is not None:
+            try:
+                result = simulation.result()
+            except Exception as error:
+                errors.append(error)
+        results.append(result)
+    if errors:
+        raise errors[0]
+    return results
@@ -0,0 +1,90 @@
+"""
+Space
+=====
+
+Level of detail for continuous spaces with many agents.
+
+Instead of every agent, the frontend receives the number of agents per bin of
+a regular grid laid over its current viewport. Only once it zoomed in far
+enough to see at most `detail` agents, they are sent individually. Since every
+socket has its own viewport, these messages are computed for every socket,
+from the positions of the agents at the last sent step.
+"""
+from operator import attrgetter
+from typing import Any, Dict, List, NamedTuple, Optional
+
+import numpy as np
+
+# Visible area of a space: {"x_min": ..., "x_max": ..., "y_min": ..., "y_max": ...}
+Viewport = Dict[str, float]
+
+
+class Snapshot(NamedTuple):
+    # Positions of the agents, one row of x and y per agent
+    positions: np.ndarray
+    unique_ids: List[Any]
+    # Values of the color field of the agents, if any
+    values: Optional[List[Any]]
+
+
+def snapshot(model: Any, field: Optional[str] = None) -> Snapshot:
+    """Record the positions (and the `field`) of all agents of a model."""
+    agents = [agent for agent in model.schedule.agents if agent.pos is not None]
+    positions = np.array([agent.pos[:2] for agent in agents], dtype=float)
+    values = None
+    if field is not None:
+        values = list(map(attrgetter(field), agents))
+    return Snapshot(
+        positions.reshape(-1, 2), [agent.unique_id for agent in agents], values
+    )
+
+
+def space_message(
+    snapshot: Snapshot,
+    viewport: Viewport,
+    field: Optional[str] = None,
+    bins: int = 64,
+    detail: int = 1000,
+) -> Dict[str, Any]:
+    """Describe the agents within a viewport.
+
+    If there are at most `detail` agents they are listed individually,
+    otherwise their number in each of `bins` x `bins` bins is given. Bins
+    are described by the corner of the first one, their size and the
+    column, row and count of every bin with agents in it.
+    """
+    x_min, x_max = viewport["x_min"], viewport["x_max"]
+    y_min, y_max = viewport["y_min"], viewport["y_max"]
+    xs, ys = snapshot.positions[:, 0], snapshot.positions[:, 1]
+    inside = (xs >= x_min) & (xs <= x_max) & (ys >= y_min) & (ys <= y_max)
+    indices = np.flatnonzero(inside)
+
+    if len(indices) <= detail:
+        agents = []
+        for index in indices.tolist():
+            agent = {
+                "unique_id": snapshot.unique_ids[index],
+                "x": float(xs[index]),
+                "y": float(ys[index]),
+            }
+            if field is not None and snapshot.values is not None:
+                agent[field] = snapshot.values[index]
+            agents.append(agent)
+        return {"detail": True, "agents": agents}
+
+    counts, _, _ = np.histogram2d(
+        xs[indices], ys[indices], bins=bins, range=[[x_min, x_max], [y_min, y_max]]
+    )
+    columns, rows = np.nonzero(counts)
+    return {
+        "detail": False,
+        "bins": {
+            "x": x_min,
+            "y": y_min,
+            "width": (x_max - x_min) / bins,
+            "height": (y_max - y_min) / bins,
+            "columns": columns.tolist(),
+            "rows": rows.tolist(),
+            "counts": counts[columns, rows].astype(int).tolist(),
+        },
+    }
@@ -0,0 +1,126 @@
+"""
+Sweep
+=====
+
+Parameter sweeps over the user settable parameters of a model.
+
+The selected parameters are expanded into a grid of all combinations of their
+values (see `sweep_values`). Every combination runs headless for a fixed
+number of steps, with a fixed random seed, in a pool of worker processes. The
+model values at its last step form one row of the "sweep" dataset, which the
+runner sends to the frontend as the rows arrive, to be charted by specs like
+`SweepChart`. Results are cached by the model, its parameters, the seed and
+the number of steps, so repeating or extending a sweep only runs the new
+combinations.
+"""
+import hashlib
+import itertools
+import json
+import random
+from typing import Any, Dict, List, Optional, Sequence
+
+import numpy as np
+
+from . import __version__
+from .Serializer import get_serializer
+from .TimeSeries import is_numeric
+from .UserParam import UserSettableParameter
+from .VegaSpec import SpecCache, model_version
+
+
+def sweep_values(
+    param: UserSettableParameter, points: Optional[int] = None
+) -> List[Any]:
+    """The values a parameter takes in a sweep.
+
+    Sliders range from `min_value` to `max_value` in steps of `step`, evenly
+    thinned out to at most `points` values. Choices and checkboxes take all
+    of their values, numbers only their current one.
+    """
+    if param.param_type == param.SLIDER:
+        count = int(round((param.max_value - param.min_value) / param.step)) + 1
+        indices = range(count)
+        if points is not None and count > points:
+            indices = np.linspace(0, count - 1, points).round().astype(int).tolist()
+        values = [
+            min(param.min_value + index * param.step, param.max_value)
+            for index in indices
+        ]
+        # Avoid values like 0.30000000000000004 in the results
+        return [
+            round(value, 10) if isinstance(value, float) else value for value in values
+        ]
+    if param.param_type == param.CHOICE:
+        return list(param.choices)
+    if param.param_type == param.CHECKBOX:
+        return [False, True]
+    if param.param_type == param.NUMBER:
+        return [param.value]
+    raise ValueError(f"Parameter {param.name!r} can't be swept")
+
+
+def sweep_grid(
+    model_params: Dict[str, Any],
+    model_kwargs: Dict[str, Any],
+    names: Sequence[str],
+    points: Optional[int] = None,
+) -> List[Dict[str, Any]]:
+    """The model parameters of all combinations of the values of the
+    parameters `names`. Other parameters keep their value in `model_kwargs`."""
+    values = []
+    for name in names:
+        param = model_params.get(name)
+        if not isinstance(param, UserSettableParameter):
+            raise ValueError(f"{name!r} is not a user settable parameter")
+        values.append(sweep_values(param, points))
+    return [
+        {**model_kwargs, **dict(zip(names, combination))}
+        for combination in itertools.product(*values)
+    ]
+
+
+def seeded_model(model_cls: Any, params: Dict[str, Any], seed: int) -> Any:
+    """Instantiate a model with its random number generators seeded."""
+    random.seed(seed)
+    np.random.seed(seed)
+    if hasattr(model_cls, "reset_randomizer"):
+        # Mesa models create their generator from the `seed` given to __new__
+        model = model_cls.__new__(model_cls, **params, seed=seed)
+        model.__init__(**params)
+        return model
+    return model_cls(**params)
+
+
+def run_combination(
+    model_cls: Any, params: Dict[str, Any], seed: int, steps: int
+) -> Dict[str, Any]:
+    """Run a model for `steps` steps (or until it stops) and return its
+    numeric values at the last step. Runs in the worker processes."""
+    model = seeded_model(model_cls, params, seed)
+    step = 0
+    while step < steps and model.running:
+        model.step()
+        step += 1
+    values = get_serializer(model_cls)(model)
+    result = {
+        name: value.item() if isinstance(value, np.generic) else value
+        for name, value in values.items()
+        if is_numeric(value)
+    }
+    result["Step"] = step
+    return result
+
+
+class ResultCache(SpecCache):
+    """Results of sweep combinations, kept in memory and as JSON files in
+    `directory` (if given)."""
+
+    def result_key(
+        self, model_cls: Any, params: Dict[str, Any], seed: int, steps: int
+    ) -> str:
+        key = json.dumps(
+            [__version__, *model_version(model_cls), params, seed, steps],
+            sort_keys=True,
+            default=repr,
+        )
+        return hashlib.sha256(key.encode()).hexdigest()
@@ -0,0 +1,254 @@
+"""
+TimeSeries
+==========
+
+History of the numeric model values (like the number of happy agents) of a
+simulation, recorded at every step, even at steps whose state is never sent.
+
+Values are kept in NumPy ring buffers holding the last `capacity` steps. The
+frontend receives only newly appended points and, once it holds too many of
+them, a downsampled copy of the whole history instead.
+"""
+import numbers
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+
+# Points of a series: {"steps": [...], "columns": {name: [...]}}
+Points = Dict[str, Any]
+
+
+def is_numeric(value: Any) -> bool:
+    return isinstance(value, numbers.Real) and not isinstance(value, bool)
+
+
+def lttb(x: np.ndarray, y: np.ndarray, points: int) -> np.ndarray:
+    """Indices of the points chosen by Largest-Triangle-Three-Buckets.
+
+    The first and last point are always kept. Of every bucket in between the
+    point forming the largest triangle with the previously chosen point and
+    the average of the next bucket is chosen.
+    """
+    n = len(x)
+    if points >= n or points < 3:
+        return np.arange(n)
+
+    y = np.nan_to_num(y)
+    edges = np.linspace(1, n - 1, points - 1).astype(int)
+    indices = np.empty(points, dtype=int)
+    indices[0], indices[-1] = 0, n - 1
+    previous = 0
+    for bucket in range(points - 2):
+        start, stop = edges[bucket], edges[bucket + 1]
+        next_stop = edges[bucket + 2] if bucket + 2 < len(edges) else n
+        next_x = x[stop:next_stop].mean()
+        next_y = y[stop:next_stop].mean()
+        areas = np.abs(
+            (x[previous] - next_x) * (y[start:stop] - y[previous])
+            - (x[previous] - x[start:stop]) * (next_y - y[previous])
+        )
+        previous = start + int(areas.argmax())
+        indices[bucket + 1] = previous
+    return indices
+
+
+def min_max(x: np.ndarray, y: np.ndarray, points: int) -> np.ndarray:
+    """Indices of the minimum and maximum of `points // 2` equal buckets."""
+    n = len(y)
+    buckets = points // 2
+    if points >= n or buckets < 1:
+        return np.arange(n)
+
+    y = np.nan_to_num(y)
+    edges = np.linspace(0, n, buckets + 1).astype(int)
+    starts = edges[:-1]
+    low = np.minimum.reduceat(y, starts)
+    high = np.maximum.reduceat(y, starts)
+    indices = []
+    for start, stop, bucket_low, bucket_high in zip(starts, edges[1:], low, high):
+        values = y[start:stop]
+        indices.append(start + int(np.argmax(values == bucket_low)))
+        indices.append(start + int(np.argmax(values == bucket_high)))
+    return np.unique(indices)
+
+
+# Downsampling methods by name, returning the indices of the chosen points
+DOWNSAMPLING = {"lttb": lttb, "minmax": min_max}
+
+
+def points_since(
+    steps: np.ndarray,
+    columns: Dict[str, np.ndarray],
+    start: int,
+    stop: Optional[int] = None,
+) -> Points:
+    """The points of sorted `steps` after step `start`, up to step `stop`."""
+    first = int(np.searchsorted(steps, start, side="right"))
+    last = len(steps)
+    if stop is not None:
+        last = int(np.searchsorted(steps, stop, side="right"))
+    return to_points(
+        steps[first:last],
+        {name: column[first:last] for name, column in columns.items()},
+    )
+
+
+def downsample_points(
+    steps: np.ndarray,
+    columns: Dict[str, np.ndarray],
+    points: int,
+    method: str = "lttb",
+    stop: Optional[int] = None,
+) -> Points:
+    """The points of sorted `steps` up to step `stop`, reduced to about
+    `points` per column.
+
+    The points chosen for each column are combined, so all columns still
+    share the same steps.
+    """
+    if stop is not None:
+        last = int(np.searchsorted(steps, stop, side="right"))
+        steps = steps[:last]
+        columns = {name: column[:last] for name, column in columns.items()}
+    if len(steps) > points and columns:
+        select = DOWNSAMPLING[method]
+        x = steps.astype(float)
+        indices = np.unique(
+            np.concatenate([select(x, y, points) for y in columns.values()])
+        )
+        steps = steps[indices]
+        columns = {name: column[indices] for name, column in columns.items()}
+    return to_points(steps, columns)
+
+
+def to_points(steps: np.ndarray, columns: Dict[str, np.ndarray]) -> Points:
+    def to_list(column: np.ndarray) -> List[Optional[float]]:
+        return [None if value != value else value for value in column.tolist()]
+
+    return {
+        "steps": steps.tolist(),
+        "columns": {name: to_list(column) for name, column in columns.items()},
+    }
+
+
+class TimeSeries:
+    """Ring buffers of the numeric model values of a simulation, by step."""
+
+    def __init__(self, capacity: int = 100000):
+        self.capacity = max(capacity, 1)
+        self._size = min(self.capacity, 1024)
+        self._steps = np.empty(self._size, dtype=np.int64)
+        self._columns: Dict[str, np.ndarray] = {}
+        # Number of points recorded, including those already overwritten,
+        # and the number of the oldest point still in the buffers
+        self.count = 0
+        self.first = 0
+
+    def __len__(self) -> int:
+        return self.count - self.first
+
+    @property
+    def last_step(self) -> int:
+        if not self.count:
+            return -1
+        return int(self._steps[(self.count - 1) % self._size])
+
+    def append(self, step: int, data: Dict[str, Any]) -> None:
+        """Record the numeric values of `data` at `step`.
+
+        Steps at or before the last recorded one are ignored, e.g. when
+        previous steps are recomputed. Use `truncate` if they changed.
+        """
+        if step <= self.last_step:
+            return
+        if len(self) == self._size:
+            if self._size < self.capacity:
+                self._grow()
+            else:
+                self.first += 1  # overwrite the oldest point
+
+        index = self.count % self._size
+        self._steps[index] = step
+        for name, value in data.items():
+            if not is_numeric(value):
+                continue
+            column = self._columns.get(name)
+            if column is None:
+                column = self._columns[name] = np.full(self._size, np.nan)
+            column[index] = value
+        for name, column in self._columns.items():
+            if name not in data or not is_numeric(data[name]):
+                column[index] = np.nan
+        self.count += 1
+
+    def truncate(self, step: int) -> None:
+        """Remove all points after `step`."""
+        while len(self) and self.last_step > step:
+            self.count -= 1
+
+    def clear(self) -> None:
+        self.count = 0
+        self.first = 0
+        self._columns.clear()
+
+    def extend(self, points: Points) -> None:
+        """Record points as returned by `since`."""
+        columns = points["columns"].items()
+        for i, step in enumerate(points["steps"]):
+            self.append(step, {name: values[i] for name, values in columns})
+
+    def since(self, start: int, stop: Optional[int] = None) -> Points:
+        """All points after step `start`, up to step `stop`.
+
+        Only those points are copied out of the buffers, so the cost doesn't
+        grow with the length of the history.
+        """
+        first = self._after(start)
+        last = self.count if stop is None else max(self._after(stop), first)
+        order = np.arange(first, last) % self._size
+        return to_points(
+            self._steps[order],
+            {name: column[order] for name, column in self._columns.items()},
+        )
+
+    def downsample(
+        self, points: int, method: str = "lttb", stop: Optional[int] = None
+    ) -> Points:
+        """All points up to step `stop`, reduced to about `points` per column."""
+        return downsample_points(*self.arrays(), points, method, stop)
+
+    def arrays(self) -> Tuple[np.ndarray, Dict[str, np.ndarray]]:
+        """Copies of the steps and columns, oldest point first."""
+        order = np.arange(self.first, self.count) % self._size
+        return (
+            self._steps[order],
+            {name: column[order] for name, column in self._columns.items()},
+        )
+
+    def _after(self, step: int) -> int:
+        """The number of the first point after `step` (binary search, the
+        steps increase)."""
+        low, high = self.first, self.count
+        while low < high:
+            middle = (low + high) // 2
+            if self._steps[middle % self._size] <= step:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def _grow(self) -> None:
+        """Double the size of the (full) buffers, up to the capacity."""
+        order = np.arange(self.first, self.count) % self._size
+        size = min(self._size * 2, self.capacity)
+        steps = np.empty(size, dtype=np.int64)
+        steps[: len(order)] = self._steps[order]
+        self._steps = steps
+        for name, column in self._columns.items():
+            grown = np.full(size, np.nan)
+            grown[: len(order)] = column[order]
+            self._columns[name] = grown
+        self._size = size
+        # Points are numbered from the start of the buffers again
+        self.count -= self.first
+        self.first = 0
@@ -1,37 +1,96 @@
+import dataclasses
+import hashlib
+import inspect
+import json
+import os
+import re
 from dataclasses import dataclass
-
-import altair as alt
+from typing import Any, Dict, FrozenSet, Iterable, List, Optional, Set, Union
 
 from mesa.model import Model
 
+from . import __version__
+
+# Datasets the frontend provides to every specification
+DATASETS = ("agents", "model")
+
+# Keys of (vega-lite) transforms and their parameters that hold field names
+TRANSFORM_FIELDS = {
+    "density": ("density", "groupby"),
+    "extent": ("extent",),
+    "flatten": ("flatten",),
+    "fold": ("fold",),
+    "impute": ("impute", "key", "groupby"),
+    "loess": ("loess", "on", "groupby"),
+    "lookup": ("lookup",),
+    "pivot": ("pivot", "value", "groupby"),
+    "quantile": ("quantile", "groupby"),
+    "regression": ("regression", "on", "groupby"),
+    "stack": ("stack", "groupby"),
+}
+
+# Keys that hold expressions, which may refer to fields as `datum.field`
+EXPRESSION_KEYS = ("calculate", "filter", "expr", "test")
+
+EXPRESSION_FIELD = re.compile(
+    r"""datum\.([A-Za-z_$][\w$]*)|datum\[\s*['"]([^'"]+)['"]\s*\]"""
+)
+
 
 class VegaChart:
-    pass
+    def spec_from_params(self, params: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """Create the specification from the model parameters alone.
+
+        Returns None if a model is needed, see `create_spec`.
+        """
+        return None
+
+    def create_spec(self, model: Model) -> Dict[str, Any]:
+        raise NotImplementedError
 
 
 @dataclass
 class GridChart(VegaChart):
+    # Size of the grid. If not given, it is taken from the `width_param` and
+    # `height_param` model parameters, or else from the grid of a model.
     width: int = None
     height: int = None
     color: str = None
+    # Draw the grid as an image with one pixel per cell instead of one mark
+    # per agent, for large grids. `colors` maps values of the color field to
+    # CSS colors, other values get colors of a default scheme.
+    raster: bool = False
+    colors: Dict[Any, str] = None
+    width_param: str = "width"
+    height_param: str = "height"
 
-    def create_spec(self, model: Model):
-        if not self.width:
-            self.width = model.grid.width
-        if not self.height:
-            self.height = model.grid.height
-        if not self.color:
-            self.color = self.color = "unique_id"
+    def spec_from_params(self, params: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        if self.raster:
+            return raster_spec(self.color or "unique_id", self.colors)
+        width = self.width or params.get(self.width_param)
+        height = self.height or params.get(self.height_param)
+        if not isinstance(width, int) or not isinstance(height, int):
+            return None
+        return self.grid_spec(width, height)
+
+    def create_spec(self, model: Model) -> Dict[str, Any]:
+        if self.raster:
+            return raster_spec(self.color or "unique_id", self.colors)
+        return self.grid_spec(
+            self.width or model.grid.width, self.height or model.grid.height
+        )
+
+    def grid_spec(self, width: int, height: int) -> Dict[str, Any]:
+        # Altair takes a while to import, and is not needed for cached specs
+        import altair as alt
 
         chart = (
             alt.Chart({"name": "agents"})
             .mark_rect()
             .encode(
-                x=alt.X("x:N", scale=alt.Scale(domain=list(range(self.width)))),
-                y=alt.Y(
-                    "y:N", scale=alt.Scale(domain=list(range(self.height - 1, -1, -1)))
-                ),
-                color=f"{self.color}:N",
+                x=alt.X("x:N", scale=alt.Scale(domain=list(range(width)))),
+                y=alt.Y("y:N", scale=alt.Scale(domain=list(range(height - 1, -1, -1)))),
+                color=f"{self.color or 'unique_id'}:N",
             )
         )
 
@@ -42,3 +101,430 @@ class GridChart(VegaChart):
         spec = chart.to_dict()
 
         return spec
+
+
+@dataclass
+class SpaceChart(VegaChart):
+    """Agents in a continuous space, as the number of agents per bin.
+
+    Once zoomed in far enough to show at most `detail` agents, they are
+    shown individually. Binning is done by the server for the viewport of
+    every client (see `Space.py`). `space` is the attribute of the model
+    holding the space.
+    """
+
+    color: str = None
+    space: str = "space"
+    bins: int = 64
+    detail: int = 1000
+    width: int = 300
+    height: int = 300
+
+    def create_spec(self, model: Model) -> Dict[str, Any]:
+        space = getattr(model, self.space)
+        extent = {
+            "x_min": space.x_min,
+            "x_max": space.x_max,
+            "y_min": space.y_min,
+            "y_max": space.y_max,
+        }
+
+        def axis(name: str) -> Dict[str, Any]:
+            domain = [extent[f"{name}_min"], extent[f"{name}_max"]]
+            return {
+                "field": name,
+                "type": "quantitative",
+                "scale": {"domain": domain},
+                "title": None,
+            }
+
+        detail = {"data": {"name": "detail"}, "mark": "circle"}
+        detail["encoding"] = {"x": axis("x"), "y": axis("y")}
+        if self.color:
+            detail["encoding"]["color"] = {"field": self.color, "type": "nominal"}
+
+        # Vega-lite 4, as used by the frontend
+        return {
+            "$schema": "https://vega.github.io/schema/vega-lite/v4.json",
+            "width": self.width,
+            "height": self.height,
+            "layer": [
+                {
+                    "data": {"name": "density"},
+                    "mark": "rect",
+                    # Zooming and panning change the viewport
+                    "selection": {"viewport": {"type": "interval", "bind": "scales"}},
+                    "encoding": {
+                        "x": axis("x"),
+                        "x2": {"field": "x2"},
+                        "y": axis("y"),
+                        "y2": {"field": "y2"},
+                        "color": {
+                            "field": "count",
+                            "type": "quantitative",
+                            "scale": {"scheme": "blues"},
+                            "legend": None,
+                        },
+                    },
+                },
+                detail,
+            ],
+            "resolve": {"scale": {"color": "independent"}},
+            "usermeta": {
+                "space": {
+                    "color": self.color,
+                    "bins": self.bins,
+                    "detail": self.detail,
+                    "extent": extent,
+                }
+            },
+        }
+
+
+@dataclass
+class SweepChart(VegaChart):
+    """Results of a parameter sweep (see `Sweep.py`) as a heatmap.
+
+    Every cell is a combination of the swept parameters `x` and `y`, colored
+    by the model value `color` at the last step. Charted once for all
+    simulations, from the "sweep" dataset.
+    """
+
+    x: str = None
+    y: str = None
+    color: str = None
+    aggregate: str = "mean"
+    width: int = 300
+    height: int = 300
+
+    def spec_from_params(self, params: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        # Vega-lite 4, as used by the frontend
+        return {
+            "$schema": "https://vega.github.io/schema/vega-lite/v4.json",
+            "width": self.width,
+            "height": self.height,
+            "data": {"name": "sweep"},
+            "mark": "rect",
+            "encoding": {
+                "x": {"field": self.x, "type": "ordinal"},
+                "y": {"field": self.y, "type": "ordinal", "sort": "descending"},
+                "color": {
+                    "field": self.color,
+                    "type": "quantitative",
+                    "aggregate": self.aggregate,
+                },
+                "tooltip": [
+                    {"field": self.x, "type": "ordinal"},
+                    {"field": self.y, "type": "ordinal"},
+                    {
+                        "field": self.color,
+                        "type": "quantitative",
+                        "aggregate": self.aggregate,
+                    },
+                ],
+            },
+            "usermeta": {"sweep": {"x": self.x, "y": self.y, "color": self.color}},
+        }
+
+    def create_spec(self, model: Model) -> Dict[str, Any]:
+        return self.spec_from_params({})
+
+
+@dataclass
+class EnsembleChart(VegaChart):
+    """A model value of the replicates of an ensemble (see `Ensemble.py`),
+    as its mean over the steps within a band between two quantiles.
+
+    `lower` and `upper` name quantiles of the `ensemble_quantiles` of the
+    server. Charted once for all simulations, from the "ensemble" dataset.
+    """
+
+    field: str = None
+    lower: str = "q5"
+    upper: str = "q95"
+    width: int = 300
+    height: int = 200
+
+    def spec_from_params(self, params: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        x = {"field": "Step", "type": "quantitative"}
+        # Vega-lite 4, as used by the frontend
+        return {
+            "$schema": "https://vega.github.io/schema/vega-lite/v4.json",
+            "width": self.width,
+            "height": self.height,
+            "data": {"name": "ensemble"},
+            "transform": [{"filter": {"field": "field", "equal": self.field}}],
+            "layer": [
+                {
+                    "mark": {"type": "area", "opacity": 0.3},
+                    "encoding": {
+                        "x": x,
+                        "y": {"field": self.lower, "type": "quantitative"},
+                        "y2": {"field": self.upper},
+                    },
+                },
+                {
+                    "mark": "line",
+                    "encoding": {
+                        "x": x,
+                        "y": {
+                            "field": "mean",
+                            "type": "quantitative",
+                            "title": self.field,
+                        },
+                    },
+                },
+            ],
+            "usermeta": {"ensemble": {"field": self.field}},
+        }
+
+    def create_spec(self, model: Model) -> Dict[str, Any]:
+        return self.spec_from_params({})
+
+
+def model_version(model_cls: Any) -> List[Any]:
+    """The name of a model class and the time its module was changed, to key
+    cached data that depends on the model."""
+    try:
+        modified = os.path.getmtime(inspect.getfile(model_cls))
+    except (TypeError, OSError):
+        modified = None
+    return [f"{model_cls.__module__}.{model_cls.__qualname__}", modified]
+
+
+class SpecCache:
+    """Specifications created by charts, kept in memory and as JSON files in
+    `directory` (if given), so restarts need neither a model nor altair.
+
+    Specifications are keyed by the chart, the model class (and the time its
+    module was changed) and the model parameters.
+    """
+
+    def __init__(self, directory: Optional[str] = None):
+        self.directory = directory
+        self._specs: Dict[str, Dict[str, Any]] = {}
+
+    def key(self, chart: VegaChart, model_cls: Any, params: Dict[str, Any]) -> str:
+        config = dataclasses.asdict(chart) if dataclasses.is_dataclass(chart) else {}
+        key = json.dumps(
+            [
+                __version__,
+                type(chart).__qualname__,
+                config,
+                *model_version(model_cls),
+                params,
+            ],
+            sort_keys=True,
+            default=repr,
+        )
+        return hashlib.sha256(key.encode()).hexdigest()
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        spec = self._specs.get(key)
+        if spec is None and self.directory is not None:
+            try:
+                with open(os.path.join(self.directory, f"{key}.json")) as file:
+                    spec = self._specs[key] = json.load(file)
+            except (OSError, ValueError):
+                return None
+        return spec
+
+    def put(self, key: str, spec: Dict[str, Any]) -> None:
+        self._specs[key] = spec
+        if self.directory is None:
+            return
+        path = os.path.join(self.directory, f"{key}.json")
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(f"{path}.{os.getpid()}", "w") as file:
+                json.dump(spec, file)
+            os.replace(f"{path}.{os.getpid()}", path)
+        except (OSError, TypeError, ValueError):
+            pass  # the cache is only an optimization
+
+
+def create_specs(
+    charts: Iterable[Union[str, Dict[str, Any], VegaChart]],
+    model_cls: Any,
+    model_kwargs: Dict[str, Any],
+    cache: Optional[SpecCache] = None,
+) -> List[Union[str, Dict[str, Any]]]:
+    """Create the specifications of charts for a model with `model_kwargs`.
+
+    Cached specifications are reused. Otherwise charts create their
+    specification from the parameters (including the defaults of the model
+    class) if they can. Only if one of them needs a model, a model is
+    created, once for all charts.
+    """
+    params = {}
+    if model_cls is not None:
+        try:
+            signature = inspect.signature(model_cls)
+        except (TypeError, ValueError):
+            pass
+        else:
+            params = {
+                name: parameter.default
+                for name, parameter in signature.parameters.items()
+                if parameter.default is not parameter.empty
+            }
+    params.update(model_kwargs)
+
+    model = None
+    specs = []
+    for chart in charts:
+        if not isinstance(chart, VegaChart):
+            specs.append(chart)
+            continue
+        key = None if cache is None else cache.key(chart, model_cls, params)
+        spec = None if cache is None else cache.get(key)
+        if spec is None:
+            spec = chart.spec_from_params(params)
+            if spec is None:
+                if model is None:
+                    model = model_cls(**model_kwargs)
+                spec = chart.create_spec(model)
+            if cache is not None:
+                cache.put(key, spec)
+        specs.append(spec)
+    return specs
+
+
+def raster_spec(color: str, colors: Optional[Dict[Any, str]] = None) -> Dict[str, Any]:
+    """Specification of a grid drawn as an image, see `Raster.py`.
+
+    It is not a vega specification, the frontend draws these itself.
+    """
+    return {
+        "width": 300,
+        "height": 300,
+        "usermeta": {
+            "raster": {"color": color, "colors": list((colors or {}).items())}
+        },
+    }
+
+
+def raster_field(spec: Union[str, Dict[str, Any]]) -> Optional[str]:
+    """The color field of a raster specification, None for other specifications."""
+    if isinstance(spec, dict):
+        raster = spec.get("usermeta", {}).get("raster")
+        if isinstance(raster, dict):
+            return raster["color"]
+    return None
+
+
+def space_options(spec: Union[str, Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+    """The options of a `SpaceChart` specification, None for other specifications."""
+    if isinstance(spec, dict):
+        space = spec.get("usermeta", {}).get("space")
+        if isinstance(space, dict):
+            return space
+    return None
+
+
+def spec_fields(spec: Union[str, Dict[str, Any]]) -> Dict[str, Optional[Set[str]]]:
+    """Find the fields of each dataset used by a vega(-lite) specification.
+
+    Fields are collected from encodings (including tooltips), transforms and
+    expressions. A dataset maps to None if the specification might use any of
+    its fields, e.g. because a tooltip shows the whole datum or because it is
+    a plain vega specification that can't be analyzed. Datasets that are
+    not used at all are missing.
+    """
+    if isinstance(spec, str):
+        try:
+            spec = json.loads(spec)
+        except ValueError:
+            return dict.fromkeys(DATASETS)
+    if "vega/v" in spec.get("$schema", "") or "marks" in spec:
+        return dict.fromkeys(DATASETS)
+
+    fields: Dict[str, Optional[Set[str]]] = {}
+
+    def add(dataset: Optional[str], names: Any) -> None:
+        if dataset is None or (dataset in fields and fields[dataset] is None):
+            return
+        if isinstance(names, str):
+            names = [names]
+        if not isinstance(names, list) or not all(
+            isinstance(name, str) for name in names
+        ):
+            fields[dataset] = None  # e.g. {"repeat": "row"}
+            return
+        # Nested fields ("a.b") are read from the top level attribute
+        fields.setdefault(dataset, set()).update(
+            name.split(".")[0] for name in names if name
+        )
+
+    def visit(node: Any, dataset: Optional[str]) -> None:
+        if isinstance(node, list):
+            for item in node:
+                visit(item, dataset)
+            return
+        if not isinstance(node, dict):
+            return
+
+        data = node.get("data")
+        if isinstance(data, dict) and isinstance(data.get("name"), str):
+            dataset = data["name"]
+            fields.setdefault(dataset, set())
+
+        # Tooltips of marks that show the whole datum
+        tooltip = node.get("tooltip")
+        if tooltip is True or (
+            isinstance(tooltip, dict) and tooltip.get("content") == "data"
+        ):
+            add(dataset, None)
+        if "repeat" in node:
+            add(dataset, None)
+
+        for key in ("field", "fields", "groupby"):
+            if key in node:
+                add(dataset, node[key])
+        for transform, keys in TRANSFORM_FIELDS.items():
+            if transform in node:
+                for key in keys:
+                    if key in node:
+                        add(dataset, node[key])
+        for key in EXPRESSION_KEYS:
+            if isinstance(node.get(key), str):
+                add(
+                    dataset,
+                    [a or b for a, b in EXPRESSION_FIELD.findall(node[key])],
+                )
+
+        for value in node.values():
+            if isinstance(value, (dict, list)):
+                visit(value, dataset)
+
+    visit(spec, None)
+    return fields
+
+
+def get_projection(
+    specs: Iterable[Union[str, Dict[str, Any]]],
+    extra_fields: Optional[Dict[str, List[str]]] = None,
+) -> Dict[str, Optional[FrozenSet[str]]]:
+    """Combine the fields used by all specifications into a projection.
+
+    `extra_fields` adds fields per dataset that are not charted, but needed
+    elsewhere (e.g. by the `on_click` method of a model). Datasets that are
+    neither used nor listed are not extracted at all, apart from the model
+    values of the "model" dataset.
+    """
+    projection: Dict[str, Optional[Set[str]]] = {"model": set()}
+    for spec in specs:
+        for dataset, names in spec_fields(spec).items():
+            current = projection.get(dataset, set())
+            if current is not None:
+                projection[dataset] = None if names is None else current | names
+
+    for dataset, names in (extra_fields or {}).items():
+        current = projection.get(dataset, set())
+        if current is not None:
+            projection[dataset] = current | set(names)
+
+    return {
+        dataset: None if names is None else frozenset(names)
+        for dataset, names in projection.items()
+    }
@@ -15,59 +15,77 @@ a "on_click" method in your model class to respond to clicks. Every click passes
 underlying visualization data to your "on-click" function.
 """
 import asyncio
+import hashlib
+import inspect
+import itertools
 import platform
-import json
 import os
 import pickle
+import shutil
+import time
 import webbrowser
-from typing import TYPE_CHECKING, Any, Awaitable, Dict, List, Optional, Union
+from collections import deque
+from concurrent.futures import (
+    Executor,
+    Future,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+)
+from functools import partial
+from typing import (
+    Any,
+    Awaitable,
+    Callable,
+    Deque,
+    Dict,
+    List,
+    Optional,
+    Sequence,
+    Set,
+    Tuple,
+    Type,
+    TypeVar,
+    Union,
+)
 
 import tornado.autoreload
 import tornado.escape
 import tornado.gen
 import tornado.ioloop
+import tornado.log
 import tornado.web
 import tornado.websocket
 
+from .Ensemble import EnsembleStats, run_replicate
+from .Metrics import SessionMetrics, prometheus_text
+from .Raster import raster_message
+from .Serializer import (  # noqa: F401
+    as_json,
+    encode,
+    encode_batch,
+    encode_columnar,
+    get_properties,
+)
+from .Serving import serve
+from .Simulation import Simulation, SimulationProcess, call_all
+from .Space import Snapshot, space_message
+from .Sweep import ResultCache, run_combination, sweep_grid
 from .UserParam import UserSettableParameter
-from .VegaSpec import VegaChart
+from .VegaSpec import (
+    SpecCache,
+    VegaChart,
+    create_specs,
+    get_projection,
+    raster_field,
+    space_options,
+)
 
-if TYPE_CHECKING:
-    from mesa.model import Model
+T = TypeVar("T")
 
 if platform.system() == "Windows" and platform.python_version_tuple() >= ("3", "7"):
     asyncio.set_event_loop_policy(asyncio.WindowsSelectorEventLoopPolicy())
 
 
-def get_properties(obj):
-    return {
-        key: getattr(obj, key)
-        for key, value in obj.__class__.__dict__.items()
-        if type(value) == property
-    }
-
-
-def as_json(model: "Model"):
-
-    model_has_dict = getattr(model, "as_dict", None)
-    if model_has_dict:
-        model_data = model.as_dict()
-    else:
-        model_data = {**model.__dict__, **get_properties(model)}
-
-    agent_has_dict = getattr(model.schedule.agents[0], "as_dict", None)
-    if agent_has_dict:
-        agent_data = [agent.as_dict() for agent in model.schedule.agents]
-    else:
-        agent_data = [
-            {**agent.__dict__, **get_properties(agent)}
-            for agent in model.schedule.agents
-        ]
-
-    model_data.update({"agents": agent_data})
-    return json.loads(json.dumps(model_data, default=lambda a: str(a)))
-
-
 class PageHandler(tornado.web.RequestHandler):
     """ Handler for the HTML template which holds the visualization. """
 
@@ -82,32 +100,449 @@ class PageHandler(tornado.web.RequestHandler):
         )
 
 
+class MetricsHandler(tornado.web.RequestHandler):
+    """Metrics of all sessions in the Prometheus text format."""
+
+    application: "VegaServer"
+
+    def get(self, *args: Any) -> None:
+        self.set_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        names = {runner: name for name, runner in self.application.sessions.items()}
+        sessions = []
+        for runner in list(self.application.runners):
+            runner.update_gauges()
+            sessions.append((names.get(runner, f"{id(runner):x}"), runner.metrics))
+        self.write(prometheus_text(sessions))
+
+
+def agent_key(agent: Dict[str, Any]) -> Any:
+    """Hashable key of a serialized agent (`unique_id` may be a position)."""
+    unique_id = agent["unique_id"]
+    if isinstance(unique_id, list):  # positions sent by an `as_dict` method
+        return tuple(unique_id)
+    return unique_id
+
+
+def diff_state(
+    previous: Dict[str, Any], current: Dict[str, Any], tile_size: int = 64
+) -> Dict[str, Any]:
+    """Compute the changes between two model states created by `as_json`.
+
+    Agents are keyed by their `unique_id`. Agents that are new or whose data
+    changed are included in full, removed agents only by their `unique_id`.
+    Of the model data only changed values are included, of raster images
+    only the changed tiles.
+    """
+    old_agents = {agent_key(agent): agent for agent in previous["agents"]}
+    new_agents = {agent_key(agent): agent for agent in current["agents"]}
+
+    added = []
+    changed = []
+    for key, agent in new_agents.items():
+        old_agent = old_agents.get(key)
+        if old_agent is None:
+            added.append(agent)
+        elif old_agent != agent:
+            changed.append(agent)
+    removed = [
+        agent["unique_id"] for key, agent in old_agents.items() if key not in new_agents
+    ]
+
+    model = {
+        key: value
+        for key, value in current.items()
+        if key not in ("agents", "rasters")
+        and (key not in previous or previous[key] != value)
+    }
+
+    delta = {"model": model, "added": added, "changed": changed, "removed": removed}
+    if "rasters" in current:
+        delta["rasters"] = [
+            raster_message(raster, old, tile_size)
+            for raster, old in zip(current["rasters"], previous["rasters"])
+        ]
+    return delta
+
+
 class ModelRunner:
     current_step = 0
-    models: List["Model"] = []
-    states: List[str] = []
+    # Encoded state of every step, None for states evicted from the cache
+    states: List[Optional[Union[str, bytes]]]
+
+    # Queued commands made obsolete by a directly following command (of the
+    # same socket and chart, for commands answered to a single socket)
+    SUPERSEDED_BY = {
+        "reset": {"reset", "step", "get_state", "interact_all", "play", "run_until"},
+        "step": {"step", "get_state"},
+        "get_state": {"get_state"},
+        "get_stats": {"get_stats"},
+        "viewport": {"viewport"},
+        "play": {"play", "run_until", "pause"},
+        "run_until": {"play", "run_until", "pause"},
+        "pause": {"play", "run_until", "pause"},
+        "sweep": {"sweep", "stop_sweep"},
+        "stop_sweep": {"sweep", "stop_sweep"},
+        "ensemble": {"ensemble", "stop_ensemble"},
+        "stop_ensemble": {"ensemble", "stop_ensemble"},
+    }
+    # Interaction messages and the methods of the models they call
+    INTERACTIONS = {"call_method": "on_click", "key_press": "on_key"}
 
-    def __init__(self, application: "VegaServer", socket_handler: "SocketHandler"):
+    def __init__(
+        self,
+        application: "VegaServer",
+        socket_handler: Optional["SocketHandler"] = None,
+    ):
         self.application = application
-        self.socket_handler = socket_handler
+        # All sockets attached to this runner, the first one controls it
+        self.sockets: List["SocketHandler"] = []
+        if socket_handler is not None:
+            self.sockets.append(socket_handler)
+        # Name of the session (None if unnamed), and when a socket last
+        # joined or sent a command
+        self.session: Optional[str] = None
+        self.last_active = time.monotonic()
+        self.keyframes: Set[int] = set()
+        self.last_encoded: Optional[Tuple[int, List[Dict[str, Any]]]] = None
+        self.end_step: Optional[int] = None
+        self.sent_step = 0
+        # Incremented whenever precomputed states become invalid
+        self.generation = 0
+        # Task stepping the models on the server, see `play`
+        self.playing: Optional["asyncio.Task[None]"] = None
+        # Task precomputing the states after the last sent step
+        self.looking_ahead: Optional["asyncio.Task[None]"] = None
+        # Commands of the sockets waiting to be executed, and the task
+        # executing them (see `enqueue`)
+        self.commands: Deque[Tuple[str, Dict[str, Any]]] = deque()
+        self.executing: Optional["asyncio.Task[None]"] = None
+        # Task running a parameter sweep, the parameters and number of its
+        # combinations, and the rows of results so far (see `sweep`)
+        self.sweeping: Optional["asyncio.Task[None]"] = None
+        self.sweep_status: Optional[Dict[str, Any]] = None
+        self.sweep_rows: List[Dict[str, Any]] = []
+        # Task running the replicates of an ensemble, their number and the
+        # summary of those finished so far (see `ensemble`)
+        self.ensembling: Optional["asyncio.Task[None]"] = None
+        self.ensemble_status: Optional[Dict[str, Any]] = None
+        self.ensemble_rows: List[Dict[str, Any]] = []
+        # Last step of the time series sent, and the number of points per
+        # series the frontend holds
+        self.series_step = -1
+        self.series_points = 0
+        # Agent positions in the continuous spaces of the latest steps, per
+        # step, model and space chart
+        self.space_snapshots: Dict[int, List[List[Snapshot]]] = {}
+        self.metrics = SessionMetrics()
+        # Specifications for the current grid sizes (see `reset`)
+        self.specs = application.vega_specifications
+        self.lock = asyncio.Lock()
+        application.runners.add(self)
+        self.simulations = self.create_simulations()
         self.reset_models()
 
-    def current_state(self, step: int) -> str:
-        return tornado.escape.json_encode(
-            {
-                "type": "modelStates/stepReceived",
+    def create_simulations(self) -> List[Union[Simulation, SimulationProcess]]:
+        """A simulation for each model of the session."""
+        application = self.application
+        checkpoint_options = {
+            "interval": application.checkpoint_interval,
+            "memory_budget": (
+                application.checkpoint_memory // application.n_simulations
+            ),
+            "compression": application.checkpoint_compression,
+            "spill": application.checkpoint_spill,
+            "base_interval": application.checkpoint_base_interval,
+        }
+        simulation_cls = (
+            SimulationProcess if application.execution == "process" else Simulation
+        )
+        return [
+            simulation_cls(
+                application.model_cls,
+                checkpoint_options,
+                application.series_capacity,
+                # Enough recent states to serve all steps after the sent one
+                application.lookahead + 2,
+            )
+            for _ in range(application.n_simulations)
+        ]
+
+    def broadcast(self, method: str, *args: Any) -> List[Any]:
+        """Call a method of all simulations and return their results."""
+        return call_all((simulation, method, args) for simulation in self.simulations)
+
+    @property
+    def model_ids(self) -> List[int]:
+        """Identifiers of the models in messages, in the order of the models."""
+        return [id(simulation) for simulation in self.simulations]
+
+    def current_state(
+        self, step: int, model_states: List[Dict[str, Any]]
+    ) -> Union[str, bytes]:
+        """Encode the state of all models as a message for the given step.
+
+        If the application uses `delta_updates` (or raster images) and the
+        previous step was the last one encoded, only the changes since then
+        are encoded. Every `keyframe_interval` steps (and whenever the
+        previous step is not available) the full state is sent instead.
+        """
+        start = time.perf_counter()
+        if self.is_keyframe(step):
+            self.keyframes.add(step)
+            message = self.keyframe_message(step, model_states)
+        else:
+            _, previous_states = self.last_encoded
+            message = {
+                "type": "modelStates/deltaReceived",
                 "payload": {
                     "step": step,
                     "modelStates": [
-                        {"modelId": id(model), "state": as_json(model)}
-                        for model in self.models
+                        {
+                            "modelId": model_id,
+                            **diff_state(
+                                previous, state, self.application.raster_tile_size
+                            ),
+                        }
+                        for model_id, previous, state in zip(
+                            self.model_ids, previous_states, model_states
+                        )
                     ],
                 },
             }
+
+        self.last_encoded = (step, model_states)
+        frame = self.encode_frame(message)
+        self.metrics.observe("encode", time.perf_counter() - start)
+        return frame
+
+    def keyframe_message(
+        self, step: int, model_states: List[Dict[str, Any]]
+    ) -> Dict[str, Any]:
+        return {
+            "type": "modelStates/stepReceived",
+            "payload": {
+                "step": step,
+                "modelStates": [
+                    {"modelId": model_id, "state": self.full_state(state)}
+                    for model_id, state in zip(self.model_ids, model_states)
+                ],
+            },
+        }
+
+    def full_state(self, state: Dict[str, Any]) -> Dict[str, Any]:
+        """A model state as sent in keyframes, with complete raster images."""
+        if "rasters" not in state:
+            return state
+        tile_size = self.application.raster_tile_size
+        rasters = [
+            raster_message(raster, None, tile_size) for raster in state["rasters"]
+        ]
+        return {**state, "rasters": rasters}
+
+    def encode_frame(self, message: Dict[str, Any]) -> Union[str, bytes]:
+        """Encode a message according to the protocol of the application.
+
+        Raster images are binary, so frames with images are always columnar.
+        """
+        if self.application.protocol == "columnar" or self.application.rasters:
+            return encode_columnar(message)
+        return encode(message)
+
+    def send(
+        self,
+        frame: Union[str, bytes, Dict[str, Any]],
+        sockets: Optional[List["SocketHandler"]] = None,
+        step: Optional[int] = None,
+    ) -> None:
+        """Send an encoded frame (or a message) to all attached sockets.
+
+        The frame is encoded only once, independent of the number of sockets.
+        The state frame of a `step` is not sent to sockets lagging behind,
+        they get the latest skipped state once they caught up.
+        """
+        if isinstance(frame, dict):
+            frame = encode(frame)
+        start = time.perf_counter()
+        binary = isinstance(frame, bytes)
+        data = tornado.escape.utf8(frame)
+        for socket in self.sockets if sockets is None else sockets:
+            if step is not None and (socket.lagging or socket.skipped_step is not None):
+                # Later delta frames are useless without the skipped ones
+                socket.skipped_step = step
+                socket.dropped_frames += 1
+                if not socket.lagging:
+                    asyncio.ensure_future(self.catch_up(socket))
+                continue
+            socket.write_frame(data, binary)
+            if step is not None:
+                socket.last_step = step
+        if step is not None:
+            self.metrics.observe("write", time.perf_counter() - start)
+
+    async def catch_up(self, socket: "SocketHandler") -> None:
+        """Send the latest state skipped for a socket in full."""
+        if socket.catching_up:
+            return
+        socket.catching_up = True
+        try:
+            while socket.skipped_step is not None and not socket.lagging:
+                step = socket.skipped_step
+                if step >= len(self.states):  # outdated by an interaction
+                    socket.skipped_step = None
+                    break
+                frames = await self.run(self.standalone_frames, step)
+                if socket.skipped_step == step:  # no later step in between
+                    socket.skipped_step = None
+                    for frame in frames:
+                        binary = isinstance(frame, bytes)
+                        socket.write_frame(tornado.escape.utf8(frame), binary)
+                    socket.last_step = step
+        finally:
+            socket.catching_up = False
+
+    def socket_stats(self, socket: "SocketHandler") -> Dict[str, Any]:
+        """Flow control statistics of a socket, `lag` being the number of
+        steps it is behind."""
+        return {**socket.stats, "lag": self.sent_step - socket.last_step}
+
+    def get_stats(self, socket: "SocketHandler") -> None:
+        self.send(
+            {"type": "session/stats", "payload": self.socket_stats(socket)}, [socket]
         )
 
-    def get_state(self, step: int) -> None:
-        self.socket_handler.write_message(self.states[step])
+    @property
+    def socket_handler(self) -> "SocketHandler":
+        """The socket controlling the runner."""
+        return self.sockets[0]
+
+    def attach(self, socket: "SocketHandler") -> None:
+        """Add a socket and bring it up to date with the last sent step."""
+        self.sockets.append(socket)
+        self.last_active = time.monotonic()
+        self.bring_up_to_date(socket)
+
+    def bring_up_to_date(self, socket: "SocketHandler") -> None:
+        """Send the parameters, the last sent step and the time series, and
+        the progress of sweeps and ensembles to a socket."""
+        self.send({"type": "parameter/init", "payload": self.user_params}, [socket])
+        if self.started:
+            asyncio.ensure_future(
+                self.get_states(self.sent_step, self.sent_step + 1, socket=socket)
+            )
+            asyncio.ensure_future(self.get_series(socket=socket))
+        if self.sweep_status is not None:
+            self.send({"type": "sweep/started", "payload": self.sweep_status}, [socket])
+            self.send(
+                {"type": "sweep/resultsReceived", "payload": self.sweep_rows}, [socket]
+            )
+            if self.sweeping is None:
+                self.send({"type": "sweep/finished"}, [socket])
+        if self.ensemble_status is not None:
+            self.send(
+                {
+                    "type": "ensemble/updated",
+                    "payload": {**self.ensemble_status, "rows": self.ensemble_rows},
+                },
+                [socket],
+            )
+
+    def detach(self, socket: "SocketHandler") -> None:
+        """Remove a socket. If it controlled the runner, the next one takes over."""
+        self.sockets.remove(socket)
+        if self.sockets:
+            self.send_roles()
+
+    def send_roles(self) -> None:
+        for socket in self.sockets:
+            self.send(
+                {
+                    "type": "session/joined",
+                    "payload": {
+                        "controller": self.can_control(socket),
+                        "started": self.started,
+                        "viewers": len(self.sockets),
+                    },
+                },
+                [socket],
+            )
+
+    @property
+    def started(self) -> bool:
+        """Whether the models were started by a first `reset`."""
+        return bool(self.states)
+
+    def can_control(self, socket: "SocketHandler") -> bool:
+        return self.application.shared_control or socket is self.socket_handler
+
+    def is_keyframe(self, step: int) -> bool:
+        """Whether the state for `step` needs to be sent in full."""
+        deltas = self.application.delta_updates or self.application.rasters
+        if not deltas or self.last_encoded is None:
+            return True
+        last_step, _ = self.last_encoded
+        interval = self.application.keyframe_interval
+        return last_step != step - 1 or (interval > 0 and step % interval == 0)
+
+    async def get_state(
+        self, step: int, socket: Optional["SocketHandler"] = None
+    ) -> None:
+        state = self.states[step]
+        if state is None:
+            state = (await self.run(self.recompute_states, [step]))[step]
+        self.send(state, None if socket is None else [socket])
+
+    async def get_series(
+        self,
+        points: Optional[int] = None,
+        method: Optional[str] = None,
+        socket: Optional["SocketHandler"] = None,
+    ) -> None:
+        """Send the time series up to the last sent step, downsampled to
+        `points` per series."""
+        application = self.application
+        payload = await self.run(
+            self.broadcast,
+            "downsample_series",
+            points or application.series_points or application.series_capacity,
+            method or application.series_downsampling,
+            self.series_step,
+        )
+        self.send(
+            self.series_message_of("series/replaced", payload),
+            None if socket is None else [socket],
+        )
+
+    async def get_states(
+        self,
+        start: int,
+        stop: int,
+        stride: int = 1,
+        socket: Optional["SocketHandler"] = None,
+    ) -> None:
+        """Send the states of `range(start, stop, stride)` in a single frame.
+
+        Cached frames are sent as they are. Delta frames need the frame of the
+        previous step, so those are included as well, back to the last
+        keyframe. States that were evicted from the cache are recomputed.
+        """
+        stop = min(stop, len(self.states))
+        steps = set(range(max(start, 0), stop, max(stride, 1)))
+        for step in sorted(steps):
+            while step not in self.keyframes and self.states[step] is not None:
+                step -= 1
+                if step in steps:
+                    break
+                steps.add(step)
+
+        frames = {step: self.states[step] for step in steps}
+        missing = [step for step, frame in frames.items() if frame is None]
+        if missing:
+            frames.update(await self.run(self.recompute_states, missing))
+
+        batch = encode_batch(
+            "modelStates/batchReceived", [frames[step] for step in sorted(frames)]
+        )
+        self.send(batch, None if socket is None else [socket])
 
     def submit_params(self, model: int, param: str, value: Any) -> None:
         """Submit model parameters."""
@@ -115,58 +550,669 @@ class ModelRunner:
         # Is the param editable?
         self.application.model_kwargs[model][param].value = value
 
-    async def reset(self) -> None:
-        self.reset_models()
-        self.states = []
+    def enqueue(self, command: str, data: Dict[str, Any]) -> None:
+        """Queue a command (a method and its arguments) received from a socket.
+
+        Commands are executed one after another, in the order they arrived.
+        While one is executing, the following ones pile up and are merged:
+        a command drops the commands directly before it that it makes
+        obsolete (see `SUPERSEDED_BY`), so consecutive steps become a single
+        advance. Consecutive interactions are applied together and the step
+        is recomputed only once.
+        """
+        self.last_active = time.monotonic()
+        if command in self.INTERACTIONS:
+            call = (data["model_id"], self.INTERACTIONS[command], data["data"])
+            if self.commands and self.commands[-1][0] == "interact_all":
+                self.commands[-1][1]["calls"].append(call)
+                return
+            command, data = "interact_all", {"calls": [call]}
+        superseded = self.SUPERSEDED_BY.get(command, ())
+        target = (data.get("socket"), data.get("chart"))
+        while (
+            self.commands
+            and self.commands[-1][0] in superseded
+            and (self.commands[-1][1].get("socket"), self.commands[-1][1].get("chart"))
+            == target
+        ):
+            self.commands.pop()
+        self.commands.append((command, data))
+        if self.executing is None:
+            self.executing = asyncio.ensure_future(self.execute_commands())
+
+    async def execute_commands(self) -> None:
+        try:
+            while self.commands:
+                command, data = self.commands.popleft()
+                try:
+                    result = getattr(self, command)(**data)
+                    if inspect.isawaitable(result):
+                        await result
+                except Exception:
+                    tornado.log.app_log.exception(f"Error executing {command}")
+        finally:
+            self.executing = None
+
+    async def run(self, function: Callable[..., T], *args: Any) -> T:
+        """Run blocking work on the models in the executor of the application.
+
+        Work of a runner is never run concurrently, so the models and the
+        cached states are only accessed by one call at a time. A cancelled
+        caller keeps the lock until the work is done.
+        """
+        async with self.lock:
+            executor = self.application.get_executor()
+            if executor is None:
+                return function(*args)
+            loop = asyncio.get_event_loop()
+            future = loop.run_in_executor(executor, function, *args)
+            try:
+                return await asyncio.shield(future)
+            except asyncio.CancelledError:
+                await asyncio.wait([future])
+                raise
 
-        self.socket_handler.write_message(
-            {"type": "parameter/init", "payload": self.user_params}
+    @property
+    def busy(self) -> bool:
+        """Whether the runner executes commands, plays or runs a sweep or an
+        ensemble."""
+        return any(
+            task is not None
+            for task in (self.executing, self.playing, self.sweeping, self.ensembling)
         )
-        self.current_step = 0
-        await self.step(0)
 
-    async def step(self, step: int) -> None:
-        if step < self.current_step:
-            self.restore_state(max(step - 1, 0))
+    def stop_looking_ahead(self) -> None:
+        """Cancel the precomputation of states that just became invalid."""
+        if self.looking_ahead is not None:
+            self.looking_ahead.cancel()
+            self.looking_ahead = None
 
-        elif step > self.current_step:
-            self.step_ahead()
+    async def reset(self) -> None:
+        self.pause()
+        self.generation += 1
+        self.stop_looking_ahead()
+        await self.run(self.reset_models)
+        # Parameters like the size of a grid may have changed
+        specs = await self.run(self.application.create_specs, self.model_params(0))
+        if specs != self.specs:
+            self.specs = specs
+            self.send({"type": "chart/createSpec", "payload": {"specs": specs}})
+        self.send({"type": "parameter/init", "payload": self.user_params})
+        await self.step(0)
+        if self.application.replicates > 0:
+            self.ensemble()
 
-        state = self.current_state(step)
-        self.states.append(state)
-        self.socket_handler.write_message(state)
+    async def step(self, step: int) -> None:
+        if self.end_step is not None and step > self.end_step:
+            self.send({"type": "end"})
+            return
+
+        frames = [await self.run(self.compute_state, step)]
+        step = min(step, self.last_step)
+        if (
+            step - 1 != self.sent_step
+            and step not in self.keyframes
+            and self.states[step] is not None
+        ):
+            # A cached delta frame, but the previous step was skipped
+            frames = await self.run(self.standalone_frames, step)
+        for frame in frames:
+            self.send(frame, step=step)
+        self.sent_step = step
+        series = await self.run(self.series_message)
+        if series is not None:
+            self.send(series)
+        await self.send_spaces(step)
+        if self.application.collect_metrics:
+            await self.run(self.collect_metrics)
+            if self.application.metrics_overlay:
+                summary = self.metrics.summary()
+                self.send({"type": "session/metrics", "payload": summary})
+
+        if self.end_step is not None and step >= self.end_step:
+            self.send({"type": "end"})
+        elif self.application.lookahead > 0 and self.playing is None:
+            self.stop_looking_ahead()
+            self.looking_ahead = asyncio.ensure_future(self.look_ahead(step))
+
+    def play(self, fps: Optional[float] = None, stride: int = 1) -> None:
+        """Step the models on the server until they stop or `pause` is called.
+
+        Only every `stride`-th step is sent, and at most `fps` frames per
+        second. The models keep stepping between frames without encoding
+        their states.
+        """
+        self.pause()
+        self.playing = asyncio.ensure_future(self.play_steps(fps, stride))
+
+    def run_until(self, step: int, fps: Optional[float] = 1) -> None:
+        """Step the models up to `step`, sending about `fps` frames per second
+        to show the progress."""
+        self.pause()
+        stride = 1 if fps else max(step - self.sent_step, 1)
+        self.playing = asyncio.ensure_future(self.play_steps(fps, stride, until=step))
+
+    def pause(self) -> None:
+        """Stop playing. The playing task stops after its current frame."""
+        if self.playing is not None:
+            self.playing = None
+            self.send({"type": "controller/paused"})
+
+    async def play_steps(
+        self, fps: Optional[float], stride: int, until: Optional[int] = None
+    ) -> None:
+        task = asyncio.current_task()
+        period = 1 / fps if fps else 0.0
+        stride = max(stride, 1)
+        frame_time = 0.0  # Time taken to encode and send the last frame
+        self.send({"type": "controller/playing"})
+
+        while self.playing is task:
+            step = self.sent_step
+            if (until is not None and step >= until) or (
+                self.end_step is not None and step >= self.end_step
+            ):
+                break
+
+            deadline = time.monotonic() + period
+            target = step + stride
+            running = True
+            if fps and target >= len(self.states):
+                # Keep stepping for as long as the frame rate allows and send
+                # the next multiple of `stride` after that. If frames take
+                # longer than the frame rate allows, at least half of the time
+                # is still spent stepping.
+                budget = max(period - frame_time, period / 2)
+                running = await self.run(
+                    self.skip_states, until, time.monotonic() + budget
+                )
+                skipped = len(self.states) - step
+                target = step + stride * max(-(-skipped // stride), 1)
+            if until is not None:
+                target = min(target, until)
+            if self.end_step is not None:
+                target = min(target, self.end_step)
+            if running:
+                running = await self.run(self.skip_states, target)
+            if not running:
+                # Send the state in which the models stopped
+                target = len(self.states)
+            if self.playing is not task:
+                break
+            start = time.monotonic()
+            await self.step(target)
+            frame_time = time.monotonic() - start
+
+            # Also yields to the event loop, so messages like `pause` arrive
+            await asyncio.sleep(max(deadline - time.monotonic(), 0))
+
+        if self.playing is task:
+            self.playing = None
+            self.send({"type": "controller/paused"})
+
+    def skip_states(
+        self, stop: Optional[int], deadline: Optional[float] = None
+    ) -> bool:
+        """Step the models up to `stop` without encoding the states in between.
+
+        Skipped states are left empty in the cache, like evicted ones, and
+        recomputed if requested later. Stops early at the `deadline` (a
+        `time.monotonic` value). Returns False once no model is running
+        anymore, the state they stopped in has to be encoded next.
+        """
+        while (stop is None or len(self.states) < stop) and self.end_step is None:
+            if deadline is not None and time.monotonic() >= deadline:
+                break
+            if self.current_step != len(self.states):
+                self.restore_state(len(self.states))
+            self.states.append(None)
+            self.evict_states()
+            if not self.step_ahead():
+                return False
+        return True
+
+    def sweep(self, params: Optional[List[str]] = None) -> None:
+        """Start a parameter sweep over `params` (by default the `sweep_params`
+        of the application), replacing a running one. See `Sweep.py`."""
+        self.stop_sweep()
+        application = self.application
+        names = list(params or application.sweep_params)
+        # Other parameters keep the values of the first simulation
+        combinations = sweep_grid(
+            application.model_params,
+            self.model_params(0),
+            names,
+            application.sweep_points,
+        )
+        self.sweeping = asyncio.ensure_future(self.run_sweep(names, combinations))
+
+    def stop_sweep(self) -> None:
+        if self.sweeping is not None:
+            self.sweeping.cancel()
+            self.sweeping = None
+            self.send({"type": "sweep/finished"})
+
+    async def run_sweep(
+        self, names: List[str], combinations: List[Dict[str, Any]]
+    ) -> None:
+        """Run the combinations of model parameters in the process pool of the
+        application and send their results as they arrive. Cached results are
+        sent right away."""
+        application = self.application
+        seed, steps = application.sweep_seed, application.sweep_steps
+        self.sweep_status = {"params": names, "total": len(combinations)}
+        self.sweep_rows = []
+        self.send({"type": "sweep/started", "payload": self.sweep_status})
+
+        def row(params: Dict[str, Any], result: Dict[str, Any]) -> Dict[str, Any]:
+            return {**result, **{name: params[name] for name in names}, "seed": seed}
+
+        cache = application.sweep_cache
+        cached = []
+        pending = []
+        for params in combinations:
+            key = cache.result_key(application.model_cls, params, seed, steps)
+            result = cache.get(key)
+            if result is None:
+                pending.append((key, params))
+            else:
+                cached.append(row(params, result))
+        if cached:
+            self.send_sweep_rows(cached)
+
+        futures = {
+            application.submit_sweep(
+                run_combination, application.model_cls, params, seed, steps
+            ): (key, params)
+            for key, params in pending
+        }
+        try:
+            while futures:
+                done, _ = await asyncio.wait(
+                    futures, return_when=asyncio.FIRST_COMPLETED
+                )
+                rows = []
+                for future in done:
+                    key, params = futures.pop(future)
+                    try:
+                        result = future.result()
+                    except Exception:
+                        tornado.log.app_log.exception(
+                            f"Error running the sweep combination {params}"
+                        )
+                        continue
+                    cache.put(key, result)
+                    rows.append(row(params, result))
+                if rows:
+                    self.send_sweep_rows(rows)
+        finally:
+            for future in futures:
+                future.cancel()
+        self.sweeping = None
+        self.send({"type": "sweep/finished"})
+
+    def send_sweep_rows(self, rows: List[Dict[str, Any]]) -> None:
+        self.sweep_rows.extend(rows)
+        self.send({"type": "sweep/resultsReceived", "payload": rows})
+
+    def ensemble(self, replicates: Optional[int] = None) -> None:
+        """Start running `replicates` (by default the `replicates` of the
+        application) replicates of the configuration of the first simulation,
+        replacing a running ensemble. See `Ensemble.py`.
+
+        The first simulation is their representative, only its agents are
+        sent. Of the replicates only the summary of their values is.
+        """
+        self.stop_ensemble()
+        count = replicates or self.application.replicates
+        if count <= 0:
+            raise ValueError("An ensemble needs at least one replicate")
+        self.ensembling = asyncio.ensure_future(
+            self.run_ensemble(self.model_params(0), count)
+        )
 
-        if not any([model.running for model in self.models]):
-            self.socket_handler.write_message({"type": "end"})
+    def stop_ensemble(self) -> None:
+        if self.ensembling is not None:
+            self.ensembling.cancel()
+            self.ensembling = None
+
+    async def run_ensemble(self, params: Dict[str, Any], count: int) -> None:
+        """Run the replicates in the process pool of the application, a few
+        at a time, and send the summary of their values every
+        `ensemble_interval` seconds."""
+        application = self.application
+        first_seed = application.replicate_seed
+        stats = EnsembleStats(application.ensemble_quantiles)
+        seeds = iter(range(first_seed, first_seed + count))
+        self.ensemble_status = {"replicates": 0, "total": count, "running": True}
+        self.ensemble_rows = []
+
+        def send_summary() -> None:
+            self.ensemble_status["replicates"] = stats.count
+            self.ensemble_rows = stats.rows(application.series_points or None)
+            payload = {**self.ensemble_status, "rows": self.ensemble_rows}
+            self.send({"type": "ensemble/updated", "payload": payload})
+
+        send_summary()
+        # Only a few replicates are submitted at once, so neither the queue of
+        # the pool nor the finished values grow with the number of replicates
+        window = 2 * (application.sweep_workers or os.cpu_count() or 1)
+        futures: Set["asyncio.Future[Dict[str, Any]]"] = set()
+        sent = time.monotonic()
+        try:
+            while True:
+                for seed in itertools.islice(seeds, window - len(futures)):
+                    future = application.submit_sweep(
+                        run_replicate,
+                        application.model_cls,
+                        params,
+                        seed,
+                        application.replicate_steps,
+                    )
+                    futures.add(future)
+                if not futures:
+                    break
+                done, futures = await asyncio.wait(
+                    futures, return_when=asyncio.FIRST_COMPLETED
+                )
+                for future in done:
+                    try:
+                        stats.add(future.result())
+                    except Exception:
+                        tornado.log.app_log.exception("Error running a replicate")
+                if time.monotonic() - sent >= application.ensemble_interval:
+                    send_summary()
+                    sent = time.monotonic()
+        finally:
+            for future in futures:
+                future.cancel()
+        self.ensembling = None
+        self.ensemble_status["running"] = False
+        send_summary()
+
+    async def look_ahead(self, step: int) -> None:
+        """Precompute the states following `step` while the user looks at it."""
+        generation = self.generation
+        for ahead in range(step + 1, step + 1 + self.application.lookahead):
+            if not await self.run(self.precompute_state, ahead, generation):
+                return
+
+    def precompute_state(self, step: int, generation: int) -> bool:
+        """Compute the state of `step`, unless an interaction or reset happened
+        since the lookahead started. Returns whether to continue."""
+        if generation != self.generation or self.end_step is not None:
+            return False
+        self.compute_state(step)
+        return True
+
+    def compute_state(self, step: int) -> Union[str, bytes]:
+        """Return the encoded state of `step`, stepping the models if needed.
+
+        The models are always kept one step ahead of the last encoded state,
+        so the next step can be sent without waiting for the models.
+        """
+        while len(self.states) <= step and self.end_step is None:
+            self.current_step = len(self.states)
+            results = self.model_states(self.current_step)
+            model_states = [state for state, _ in results]
+            frame = self.current_state(self.current_step, model_states)
+            self.states.append(frame)
+            self.cached_bytes += len(frame)
+            self.evict_states()
+            if any(running for _, running in results):
+                self.step_ahead()
+            else:
+                self.end_step = self.current_step
+
+        step = min(step, len(self.states) - 1)
+        state = self.states[step]
+        if state is None:
+            state = self.recompute_states([step])[step]
+        return state
+
+    def model_states(self, step: int) -> List[Tuple[Dict[str, Any], bool]]:
+        """The data of all models at `step` and whether they run.
+
+        Every simulation serves it from its recent states if it can, and
+        otherwise brings its model to `step` first.
+
+        Snapshots of continuous spaces are not part of the states, they are
+        kept for the latest steps and binned for every socket separately.
+        """
+        application = self.application
+        fields = [options["color"] for _, options in application.spaces]
+        results = self.broadcast(
+            "state_at", step, application.projection, application.rasters, fields
+        )
+        if fields:
+            snapshots = [state.pop("spaces") for state, _ in results]
+            self.space_snapshots.pop(step, None)
+            self.space_snapshots[step] = snapshots
+            while len(self.space_snapshots) > application.lookahead + 2:
+                del self.space_snapshots[next(iter(self.space_snapshots))]
+        return results
+
+    async def send_spaces(
+        self, step: int, sockets: Optional[List["SocketHandler"]] = None
+    ) -> None:
+        """Send the agents in the viewports of the sockets at `step`."""
+        if not self.application.spaces:
+            return
+        sockets = [
+            socket
+            for socket in (self.sockets if sockets is None else sockets)
+            if not socket.lagging
+        ]
+        for socket, frame in await self.run(self.space_frames, step, sockets):
+            self.send(frame, [socket])
+
+    def space_frames(
+        self, step: int, sockets: List["SocketHandler"]
+    ) -> List[Tuple["SocketHandler", str]]:
+        """Encode the agents in the viewport of every socket and space chart.
+
+        Sockets with the same viewport share the encoded frame.
+        """
+        snapshots = self.space_snapshots.get(step)
+        if snapshots is None:
+            return []
+        frames = []
+        encoded: Dict[Tuple[int, Tuple[float, ...]], str] = {}
+        for index, (chart, options) in enumerate(self.application.spaces):
+            for socket in sockets:
+                viewport = socket.viewports.get(chart, options["extent"])
+                key = (chart, tuple(sorted(viewport.items())))
+                if key not in encoded:
+                    models = [
+                        {
+                            "modelId": model_id,
+                            **space_message(
+                                model_snapshots[index],
+                                viewport,
+                                options["color"],
+                                options["bins"],
+                                options["detail"],
+                            ),
+                        }
+                        for model_id, model_snapshots in zip(
+                            self.model_ids, snapshots
+                        )
+                    ]
+                    encoded[key] = encode(
+                        {
+                            "type": "space/received",
+                            "payload": {"step": step, "chart": chart, "models": models},
+                        }
+                    )
+                frames.append((socket, encoded[key]))
+        return frames
+
+    async def viewport(
+        self,
+        chart: int,
+        x_min: Optional[float] = None,
+        x_max: Optional[float] = None,
+        y_min: Optional[float] = None,
+        y_max: Optional[float] = None,
+        socket: Optional["SocketHandler"] = None,
+    ) -> None:
+        """Set the visible area of a space chart, the whole space if not given."""
+        if x_min is None:
+            socket.viewports.pop(chart, None)
+        else:
+            socket.viewports[chart] = {
+                "x_min": x_min,
+                "x_max": x_max,
+                "y_min": y_min,
+                "y_max": y_max,
+            }
+        await self.send_spaces(self.sent_step, [socket])
+
+    def collect_metrics(self) -> None:
+        """Add the durations of the phases of the simulations to the metrics."""
+        for index, metrics in enumerate(self.broadcast("take_metrics")):
+            for phase, durations in metrics.pop("timings").items():
+                for duration in durations:
+                    self.metrics.observe(phase, duration, index)
+            for name, value in metrics.items():
+                self.metrics.set(name, value, index)
+
+    def update_gauges(self) -> None:
+        """Update the gauges of the runner itself."""
+        metrics = self.metrics
+        metrics.set("state_cache_bytes", self.cache_usage())
+        metrics.set("idle_seconds", time.monotonic() - self.last_active)
+        pending = sum(socket.pending_bytes for socket in self.sockets)
+        metrics.set("pending_bytes", pending)
+        metrics.set("sockets", len(self.sockets))
+        metrics.set("last_step", self.last_step)
+
+    def cache_usage(self) -> int:
+        """Size of the cached encoded states, in bytes."""
+        return self.cached_bytes
+
+    def series_message(self) -> Optional[Dict[str, Any]]:
+        """The points of the time series up to the last sent step that were
+        not sent yet.
+
+        Once the frontend would hold more than twice `series_points` points,
+        the whole history is sent downsampled instead.
+        """
+        if self.sent_step == self.series_step:
+            return None
+        budget = self.application.series_points
+        new_points = self.sent_step - self.series_step
+        if budget and self.series_points + new_points > 2 * budget:
+            message_type = "series/replaced"
+            method = self.application.series_downsampling
+            points = self.broadcast("downsample_series", budget, method, self.sent_step)
+            self.series_points = 0
         else:
-            self.step_ahead()
-            self.current_step = step + 1
+            message_type = "series/appended"
+            points = self.broadcast("series_since", self.series_step, self.sent_step)
+        self.series_points += max(len(series["steps"]) for series in points)
+        self.series_step = self.sent_step
+        return self.series_message_of(message_type, points)
+
+    def series_message_of(
+        self, message_type: str, points: List[Dict[str, Any]]
+    ) -> Dict[str, Any]:
+        return {
+            "type": message_type,
+            "payload": [
+                {"modelId": model_id, **series}
+                for model_id, series in zip(self.model_ids, points)
+            ],
+        }
+
+    def evict_states(self) -> None:
+        """Drop the oldest cached states beyond the `state_cache_size`, or
+        beyond `state_cache_memory` bytes. The latest state is always kept."""
+        size = self.application.state_cache_size
+        memory = self.application.state_cache_memory
+        while self.first_cached < len(self.states) - 1 and (
+            (size and len(self.states) - self.first_cached > size)
+            or (memory and self.cached_bytes > memory)
+        ):
+            self.cached_bytes -= len(self.states[self.first_cached] or "")
+            self.states[self.first_cached] = None
+            self.keyframes.discard(self.first_cached)
+            self.first_cached += 1
+
+    def standalone_frames(self, step: int) -> List[Union[str, bytes]]:
+        """Frames bringing a client without the previous state to `step`."""
+        frame = self.states[step]
+        if frame is None or step not in self.keyframes:
+            frame = self.recompute_states([step])[step]
+        return [frame]
+
+    def recompute_states(self, steps: List[int]) -> Dict[int, Union[str, bytes]]:
+        """Encode full states of steps that are no longer cached.
+
+        The models are restored to the first of the steps and stepped through
+        all of them. Afterwards they are restored to where they were.
+        """
+        current_step = self.current_step
+        interval = self.application.checkpoint_interval
+        frames = {}
+        for step in sorted(steps):
+            # Step forward if that is cheaper than restoring a checkpoint
+            if not self.current_step <= step < self.current_step + interval:
+                self.restore_state(step)
+            while self.current_step < step:
+                self.step_ahead()
+            results = self.model_states(step)
+            message = self.keyframe_message(step, [state for state, _ in results])
+            frames[step] = self.encode_frame(message)
+        self.restore_state(current_step)
+        return frames
 
     async def call_method(self, model_id: int, data: Dict[str, Any]) -> None:
-        self.current_step -= 1
-        self.restore_state(self.current_step)
-        self.states = self.states[: self.current_step]
-
-        model = self.models[model_id]
-        try:
-            model.on_click(**data)
-        except (AttributeError, TypeError):
-            pass
-
-        await self.step(self.current_step)
+        await self.interact(model_id, self.INTERACTIONS["call_method"], data)
 
     async def key_press(self, model_id: int, data: Dict[str, Any]) -> None:
-        self.current_step -= 1
-        self.restore_state(self.current_step)
-        self.states = self.states[: self.current_step]
-
-        model = self.models[model_id]
-        try:
-            model.on_key(**data)
-        except (AttributeError, TypeError):
-            pass
+        await self.interact(model_id, self.INTERACTIONS["key_press"], data)
+
+    async def interact(self, model_id: int, method: str, data: Dict[str, Any]) -> None:
+        """Call a method of a model at the last sent step and recompute the step."""
+        await self.interact_all([(model_id, method, data)])
+
+    async def interact_all(self, calls: List[Tuple[int, str, Dict[str, Any]]]) -> None:
+        """Call methods of the models at the last sent step, in order, and
+        recompute the step once."""
+        self.generation += 1
+        self.stop_looking_ahead()
+        step = await self.run(self.apply_interactions, calls)
+        await self.step(step)
+
+    def apply_interactions(self, calls: List[Tuple[int, str, Dict[str, Any]]]) -> int:
+        """Only the models interacted with are rewound to the last sent step
+        (restoring the state that was shown, see `Simulation.rewind`), the
+        others keep their checkpoints and serve the recomputed steps from
+        their recent states."""
+        step = self.sent_step
+        self.current_step = step
+        self.cached_bytes -= sum(len(frame or "") for frame in self.states[step:])
+        self.states = self.states[:step]
+        self.first_cached = min(self.first_cached, step)
+        self.keyframes = {keyframe for keyframe in self.keyframes if keyframe < step}
+        self.end_step = None
+        self.series_step = min(self.series_step, step - 1)
+
+        call_all(
+            (self.simulations[model_id], "rewind", (step, self.application.projection))
+            for model_id in sorted({model_id for model_id, _, _ in calls})
+        )
+        for model_id, method, data in calls:
+            simulation = self.simulations[model_id]
+            simulation.call("interact", method, data)
+            simulation.result()
+        return step
 
-        await self.step(self.current_step)
+    @property
+    def last_step(self) -> int:
+        """The last step with an encoded state."""
+        return max(len(self.states) - 1, 0)
 
     @property
     def user_params(self) -> List[Dict[str, Any]]:
@@ -180,57 +1226,200 @@ class ModelRunner:
                 result.append(val.json)
         return result
 
-    def step_ahead(self) -> None:
-        """Advance all models by one step."""
-        self.pickles[self.current_step] = pickle.dumps(self.models)
-        for model in self.models:
-            model.step()
+    def step_ahead(self) -> bool:
+        """Advance all models to the step after the current one, unless they
+        are there already. Returns whether any is still running."""
+        running = self.broadcast("advance", self.current_step + 1)
         self.current_step += 1
+        return any(running)
 
     def restore_state(self, step: int) -> None:
-        self.models = pickle.loads(self.pickles[step])
+        """Restore all models to the state of `step`."""
+        self.broadcast("restore", step)
         self.current_step = step
 
     def reset_models(self) -> None:
         """ Reinstantiate the model object, using the current parameters. """
 
-        self.models = []
-        self.pickles = {}
-        for i in range(self.application.n_simulations):
-            model_params = {}
-            for key, val in self.application.model_kwargs[i].items():
-                if isinstance(val, UserSettableParameter):
-                    if (
-                        val.param_type == "static_text"
-                    ):  # static_text is never used for setting params
-                        continue
-                    model_params[key] = val.value
-                else:
-                    model_params[key] = val
-            self.models.append(self.application.model_cls(**model_params))
-            self.current_step = 0
+        self.states = []
+        self.first_cached = 0
+        self.cached_bytes = 0
+        for socket in self.sockets:
+            socket.skipped_step = None
+            socket.last_step = 0
+        self.keyframes.clear()
+        self.last_encoded = None
+        self.end_step = None
+        self.series_step = -1
+        self.series_points = 0
+        self.space_snapshots.clear()
+        call_all(
+            (simulation, "reset", (self.model_params(i),))
+            for i, simulation in enumerate(self.simulations)
+        )
+        self.current_step = 0
+
+    def model_params(self, index: int) -> Dict[str, Any]:
+        """The parameters of the model of a simulation."""
+        model_params = {}
+        for key, val in self.application.model_kwargs[index].items():
+            if isinstance(val, UserSettableParameter):
+                if (
+                    val.param_type == "static_text"
+                ):  # static_text is never used for setting params
+                    continue
+                model_params[key] = val.value
+            else:
+                model_params[key] = val
+        return model_params
+
+    def save_session(self, path: str) -> None:
+        """Write the simulations and the progress of the session to the
+        directory `path`, to be continued by `resume`.
+
+        Encoded states are not saved, they are recomputed from the
+        checkpoints when requested.
+        """
+        os.makedirs(path, exist_ok=True)
+        call_all(
+            (simulation, "save", (os.path.join(path, f"simulation-{index}.pickle"),))
+            for index, simulation in enumerate(self.simulations)
+        )
+        session = {
+            "simulations": len(self.simulations),
+            "specs": self.specs,
+            "steps": len(self.states),
+            "current_step": self.current_step,
+            "sent_step": self.sent_step,
+            "end_step": self.end_step,
+        }
+        # Written last, sessions without it are incomplete
+        with open(os.path.join(path, "session.pickle"), "wb") as file:
+            pickle.dump(session, file, pickle.HIGHEST_PROTOCOL)
+
+    def load_session(self, path: str) -> None:
+        """Continue the session saved to the directory `path`."""
+        with open(os.path.join(path, "session.pickle"), "rb") as file:
+            session = pickle.load(file)
+        if session["simulations"] != len(self.simulations):
+            raise ValueError("The saved session has a different number of models")
+        call_all(
+            (simulation, "load", (os.path.join(path, f"simulation-{index}.pickle"),))
+            for index, simulation in enumerate(self.simulations)
+        )
+
+        self.specs = session["specs"]
+        self.states = [None] * session["steps"]
+        self.first_cached = len(self.states)
+        self.cached_bytes = 0
+        self.keyframes.clear()
+        self.last_encoded = None
+        self.current_step = session["current_step"]
+        self.sent_step = session["sent_step"]
+        self.end_step = session["end_step"]
+        # The sockets get the series up to the sent step, see `resume`
+        self.series_step = self.sent_step
+        self.series_points = 0
+        self.space_snapshots.clear()
+
+    async def resume(self) -> None:
+        """Continue the named session if it was saved to the `session_dir`
+        (starting over if it can't be loaded), and tell the sockets."""
+        path = self.application.session_path(self.session)
+        if path is not None and os.path.exists(os.path.join(path, "session.pickle")):
+            try:
+                await self.run(self.load_session, path)
+            except Exception:
+                tornado.log.app_log.exception(f"Resuming session {self.session} failed")
+                await self.run(self.reset_models)
+            finally:
+                shutil.rmtree(path, ignore_errors=True)
+            if self.specs != self.application.vega_specifications:
+                self.send(
+                    {"type": "chart/createSpec", "payload": {"specs": self.specs}}
+                )
+        self.send_roles()
+        if self.started:
+            for socket in self.sockets:
+                self.bring_up_to_date(socket)
+
+    def close(self) -> None:
+        """Stop all simulations (and their worker processes)."""
+        self.playing = None
+        self.commands.clear()
+        self.stop_looking_ahead()
+        self.stop_sweep()
+        self.stop_ensemble()
+        self.application.runners.discard(self)
+        for simulation in self.simulations:
+            simulation.close()
 
 
 class SocketHandler(tornado.websocket.WebSocketHandler):
+    """Websocket connection to a browser.
+
+    Every socket gets its own model runner, unless a session name is given
+    (`/ws?session=name`). All sockets of a named session share one runner:
+    steps are computed and encoded once and sent to every socket. Only the
+    first socket controls the session, unless the application allows
+    `shared_control`.
+    """
+
     application: "VegaServer"
 
+    # Messages every socket may send, which are answered to it alone
+    VIEWER_MESSAGES = ("get_state", "get_states", "get_stats", "viewport")
+
     def open(self, *args: str, **kwargs: str) -> Optional[Awaitable[None]]:
         self.set_nodelay(True)
-        # self.states: List[str] = []
         if self.application.verbose:
             print("Socket opened!")
-        self.model_runner = ModelRunner(self.application, self)
-
-        # self.write_message(self.model_runner.current_state(0))
 
+        # Frames written but not yet flushed to the network
+        self.pending_bytes = 0
+        self.pending_frames = 0
+        self.sent_frames = 0
+        self.dropped_frames = 0
+        # Step of the last state sent, and of the latest one skipped
+        self.last_step = 0
+        self.skipped_step: Optional[int] = None
+        self.catching_up = False
+        # Visible area of the space charts, by chart index
+        self.viewports: Dict[int, Dict[str, float]] = {}
+
+        application = self.application
+        application.watch_sessions()
+        self.session = self.get_argument("session", None)
+        self.model_runner: Optional[ModelRunner] = None
+        if self.session in application.sessions:
+            self.model_runner = application.sessions[self.session]
+            self.model_runner.attach(self)
+        elif 0 < application.max_sessions <= len(application.runners):
+            self.close_with_reason(
+                1013,
+                f"The server is at its limit of {application.max_sessions} "
+                "sessions, please try again later",
+            )
+            return None
+        else:
+            self.model_runner = application.runner_cls(application, self)
+            if self.session is not None:
+                self.model_runner.session = self.session
+                application.sessions[self.session] = self.model_runner
         self.write_message(
             {
                 "type": "chart/createSpec",
                 "payload": {
-                    "specs": self.application.vega_specifications,
+                    "specs": self.model_runner.specs,
                 },
             }
         )
+        if application.session_path(self.model_runner.session) is not None:
+            # Continue the session if it was saved, before the frontend
+            # learns whether it needs to start the models
+            self.model_runner.enqueue("resume", {})
+        else:
+            self.model_runner.send_roles()
 
         return None
 
@@ -240,13 +1429,81 @@ class SocketHandler(tornado.websocket.WebSocketHandler):
         if self.application.verbose:
             print(msg)
 
-        response_function = getattr(self.model_runner, msg["type"], None)
-
-        if response_function:
-            loop = asyncio.get_event_loop()
-            loop.create_task(response_function(**msg["data"]))
+        data = msg.get("data", {})
+        if self.model_runner is None:  # rejected
+            return None
+        if msg["type"] in self.VIEWER_MESSAGES:
+            data["socket"] = self
+        elif not self.model_runner.can_control(self):
+            if self.application.verbose:
+                print("Ignoring message from viewer")
+            return None
+
+        if hasattr(self.model_runner, msg["type"]):
+            self.model_runner.enqueue(msg["type"], data)
         elif self.application.verbose:
             print("Unexpected message!")
+        return None
+
+    def write_frame(self, data: bytes, binary: bool) -> None:
+        """Write a frame and track it until it is flushed to the network."""
+        try:
+            future = self.write_message(data, binary=binary)
+        except tornado.websocket.WebSocketClosedError:
+            return
+        self.pending_bytes += len(data)
+        self.pending_frames += 1
+        self.sent_frames += 1
+        future.add_done_callback(
+            partial(self.frame_written, len(data), time.perf_counter())
+        )
+
+    def frame_written(
+        self, size: int, start: float, future: "asyncio.Future[None]"
+    ) -> None:
+        self.pending_bytes -= size
+        self.pending_frames -= 1
+        self.model_runner.metrics.observe("flush", time.perf_counter() - start)
+        if not future.cancelled():
+            future.exception()  # a closed connection is handled by on_close
+        if self.skipped_step is not None and not self.lagging:
+            asyncio.ensure_future(self.model_runner.catch_up(self))
+
+    @property
+    def lagging(self) -> bool:
+        """Whether the client is too far behind to send it further states."""
+        return (
+            self.pending_bytes > self.application.max_pending_bytes
+            or self.pending_frames > self.application.max_pending_frames
+        )
+
+    @property
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "pendingBytes": self.pending_bytes,
+            "pendingFrames": self.pending_frames,
+            "sentFrames": self.sent_frames,
+            "droppedFrames": self.dropped_frames,
+            "lastStep": self.last_step,
+        }
+
+    def close_with_reason(self, code: int, reason: str) -> None:
+        """Tell the frontend why its session ends, and close the socket."""
+        try:
+            self.write_message(
+                {"type": "session/closed", "payload": {"reason": reason}}
+            )
+        except tornado.websocket.WebSocketClosedError:
+            return
+        self.close(code, reason)
+
+    def on_close(self) -> None:
+        if self.model_runner is None:
+            return
+        self.model_runner.detach(self)
+        if not self.model_runner.sockets:
+            self.model_runner.close()
+            self.application.sessions.pop(self.session, None)
 
 
 class VegaServer(tornado.web.Application):
@@ -257,16 +1514,152 @@ class VegaServer(tornado.web.Application):
     port = 3000  # Default port to listen on
     max_steps = 100000
 
+    # In production (also enabled by the environment variable
+    # MESA_VIZ_PRODUCTION) the app runs without autoreload and browser, in
+    # `processes` worker processes (0 for one per CPU, overridden by
+    # WEB_CONCURRENCY) listening on `address`. Named sessions always run in
+    # the same worker. On SIGTERM workers close their sockets and give their
+    # sessions `shutdown_timeout` seconds to end (see `Serving.py`).
+    production = False
+    processes = 1
+    address = ""
+    shutdown_timeout = 10.0
+
+    # Only send changed agents and model values between steps,
+    # with a full state every `keyframe_interval` steps (0 to disable keyframes)
+    delta_updates = False
+    keyframe_interval = 50
+
+    # Encoding of step messages: "json" or "columnar" (binary frames, where
+    # agent data is sent as typed arrays per field)
+    protocol = "json"
+
+    # Only serialize the fields that are used by the vega specifications
+    project_fields = True
+
+    # Models are checkpointed every `checkpoint_interval` steps (and after
+    # interactions), other steps are recreated by stepping forward again.
+    # Beyond `checkpoint_memory` bytes per session (split evenly between the
+    # simulations) the least recently used checkpoints are moved to a
+    # temporary file (or dropped if `checkpoint_spill` is off). Steps are only
+    # recreated exactly if the models draw random numbers from their own
+    # generators (such as `self.random`) rather than the global ones of
+    # `random` or numpy; set `checkpoint_interval` to 1 for those that don't.
+    checkpoint_interval = 10
+    checkpoint_memory = 256 * 2 ** 20
+    checkpoint_compression = 0  # zlib level, 0 to disable
+    checkpoint_spill = True
+
+    # With `checkpoint_base_interval` > 0 checkpoints are incremental: the
+    # full model is only pickled every `checkpoint_base_interval` steps, the
+    # checkpoints in between hold what changed since the previous one. Their
+    # size and cost depend on the number of changed agents rather than on the
+    # size of the model, so `checkpoint_interval` can be 1 and no steps need
+    # to be recomputed. Only suitable for mesa models whose agents change by
+    # assigning their attributes (see `Checkpoints.py`).
+    checkpoint_base_interval = 0
+
+    # Where the models are stepped and serialized: "inline" on the IOLoop,
+    # "thread" in a pool of `max_workers` threads, so slow models don't
+    # block other connections, or "process" to additionally run every
+    # simulation in its own worker process, stepping them in parallel
+    execution = "thread"
+    max_workers: Optional[int] = None
+
+    # Number of steps precomputed in the background after each sent step
+    lookahead = 0
+
+    # Number of encoded states kept per session (0 for all) and their size in
+    # bytes (0 for any). Older states are recomputed from checkpoints when
+    # requested again.
+    state_cache_size = 1000
+    state_cache_memory = 256 * 2 ** 20
+
+    # At most `max_sessions` sessions run at a time (per process, 0 for no
+    # limit), further sockets are rejected. Sessions that received no command
+    # for `session_timeout` seconds are closed (0 to keep them). Named
+    # sessions closed this way or by a shutdown are saved to `session_dir`
+    # (unless None), and continue when they are opened again.
+    max_sessions = 0
+    session_timeout = 0.0
+    session_dir: Optional[str] = None
+
+    # Numeric model values are recorded at every step, for the last
+    # `series_capacity` steps. The frontend receives the new values with
+    # every step, but never more than twice `series_points` points per value:
+    # beyond that the history is downsampled ("lttb" or "minmax").
+    series_capacity = 100000
+    series_points = 1000
+    series_downsampling = "lttb"
+
+    # Size of the tiles of raster images (see GridChart), only changed tiles
+    # are sent between steps
+    raster_tile_size = 64
+
+    # Whether all sockets of a named session may control it,
+    # instead of only the first one
+    shared_control = False
+
+    # States are not sent to sockets with more unsent data than this,
+    # only the latest one once they caught up
+    max_pending_bytes = 4 * 2 ** 20
+    max_pending_frames = 16
+
+    # Time the phases of every step (see /metrics), and send a summary of
+    # the recent durations to the frontend after every step
+    collect_metrics = True
+    metrics_overlay = False
+
+    # Specifications created by charts are cached in this directory (None to
+    # only cache them in memory), so restarts don't need to create a model
+    spec_cache_dir: Optional[str] = os.path.join(
+        os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")),
+        "mesa_viz",
+        "specs",
+    )
+
+    # Parameter sweeps (see `Sweep.py`): the `sweep_params` are expanded into
+    # a grid of combinations, with at most `sweep_points` values per slider.
+    # Every combination runs `sweep_steps` steps with the random seed
+    # `sweep_seed`, in a pool of `sweep_workers` processes. Results are cached
+    # in `sweep_cache_dir` (None to only cache them in memory).
+    sweep_params: Sequence[str] = ()
+    sweep_points: Optional[int] = 10
+    sweep_steps = 100
+    sweep_seed = 0
+    sweep_workers: Optional[int] = None
+    sweep_cache_dir: Optional[str] = os.path.join(
+        os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")),
+        "mesa_viz",
+        "sweeps",
+    )
+
+    # Ensembles (see `Ensemble.py`): `replicates` runs of the configuration of
+    # the first simulation, with the random seeds `replicate_seed`,
+    # `replicate_seed + 1`, ... in the process pool of sweeps, started on
+    # every reset (0 to disable). Their values over `replicate_steps` steps
+    # are reduced to the mean, standard deviation and `ensemble_quantiles`
+    # of every step, sent every `ensemble_interval` seconds while they run.
+    replicates = 0
+    replicate_steps = 100
+    replicate_seed = 0
+    ensemble_quantiles = (0.05, 0.5, 0.95)
+    ensemble_interval = 0.5
+
+    # Runs the models of every session
+    runner_cls: Type[ModelRunner] = ModelRunner
+
     # Handlers and other globals:
     page_handler = (r"/", PageHandler)
     socket_handler = (r"/ws", SocketHandler)
+    metrics_handler = (r"/metrics", MetricsHandler)
     static_handler = (
         r"/(.*)",
         tornado.web.StaticFileHandler,
         {"path": os.path.dirname(os.path.dirname(os.path.dirname(__file__)))},
     )
 
-    handlers = [page_handler, socket_handler, static_handler]
+    handlers = [page_handler, socket_handler, metrics_handler, static_handler]
 
     settings = {
         "debug": False,
@@ -282,8 +1675,14 @@ class VegaServer(tornado.web.Application):
         name: str = "Mesa Model",
         model_params: Optional[Dict[str, Any]] = None,
         n_simulations: int = 1,
+        extra_fields: Optional[Dict[str, List[str]]] = None,
     ):
-        """ Create a new visualization server with the given elements. """
+        """Create a new visualization server with the given elements.
+
+        `extra_fields` lists fields per dataset ("agents" or "model") that
+        are serialized in addition to the fields used by the specifications,
+        e.g. because the `on_click` method of the model needs them.
+        """
 
         # Initializing the model
         self.model_name = name
@@ -312,24 +1711,169 @@ class VegaServer(tornado.web.Application):
             self.model_kwargs.append(kwargs)
 
         # Prep visualization elements:
-        self.vega_specifications = []
-        for spec in vega_specifications:
-            if isinstance(spec, VegaChart):
-                self.vega_specifications.append(
-                    spec.create_spec(model_cls(**self.model_kwargs[0]))
-                )
-            else:
-                self.vega_specifications.append(spec)
+        self.charts = list(vega_specifications)
+        self.spec_cache = SpecCache(self.spec_cache_dir)
+        self.vega_specifications = self.create_specs(self.model_kwargs[0])
+
+        # Color fields of the grids drawn as images
+        self.rasters = [
+            field
+            for field in map(raster_field, self.vega_specifications)
+            if field is not None
+        ]
+
+        # Index and options of the continuous space charts
+        self.spaces = [
+            (index, options)
+            for index, options in enumerate(
+                map(space_options, self.vega_specifications)
+            )
+            if options is not None
+        ]
+
+        self.projection = None
+        if self.project_fields:
+            self.projection = get_projection(self.vega_specifications, extra_fields)
+
+        self.init_application()
+
+    def init_application(self) -> None:
+        """Set up the state shared by the sessions and initialize the tornado
+        application."""
+        self.executor: Optional[Executor] = None
+        self.sweep_executor: Optional[Executor] = None
+        # Work submitted to the sweep executor and not done yet
+        self.sweep_futures: Set[Future] = set()
+        self.sweep_cache = ResultCache(self.sweep_cache_dir)
+        self.sessions: Dict[str, ModelRunner] = {}
+        # All runners, including those of unnamed sessions
+        self.runners: Set[ModelRunner] = set()
+        # Closes idle sessions, see `watch_sessions`
+        self.session_watcher: Optional[tornado.ioloop.PeriodicCallback] = None
 
         # Initializing the application itself:
         super().__init__(self.handlers, "", [], **self.settings)
 
-    def launch(self, port: Optional[int] = None) -> None:
+    def create_specs(self, model_kwargs: Dict[str, Any]) -> List[Dict[str, Any]]:
+        """The specifications of the charts for a model with these parameters."""
+        return create_specs(self.charts, self.model_cls, model_kwargs, self.spec_cache)
+
+    def get_executor(self) -> Optional[Executor]:
+        """Return the executor for model work (None to run on the IOLoop)."""
+        if self.execution == "inline":
+            return None
+        if self.executor is None:
+            if self.execution not in ("thread", "process"):
+                raise ValueError(f"Unknown execution mode {self.execution!r}")
+            self.executor = ThreadPoolExecutor(self.max_workers)
+        return self.executor
+
+    def get_sweep_executor(self) -> Executor:
+        """Return the process pool running the combinations of sweeps."""
+        if self.sweep_executor is None:
+            self.sweep_executor = ProcessPoolExecutor(self.sweep_workers)
+        return self.sweep_executor
+
+    def submit_sweep(
+        self, function: Callable[..., Any], *args: Any
+    ) -> "asyncio.Future[Any]":
+        """Run a sweep combination or ensemble replicate in the process pool."""
+        future = self.get_sweep_executor().submit(function, *args)
+        self.sweep_futures.add(future)
+        result = asyncio.wrap_future(future)
+        result.add_done_callback(lambda _: self.sweep_futures.discard(future))
+        return result
+
+    def session_path(self, session: Optional[str]) -> Optional[str]:
+        """The directory a named session is saved to (None without a
+        `session_dir`)."""
+        if session is None or self.session_dir is None:
+            return None
+        name = hashlib.sha256(session.encode()).hexdigest()
+        return os.path.join(self.session_dir, name)
+
+    async def save_session(self, runner: ModelRunner) -> bool:
+        """Save a named session to the `session_dir`, if it was started.
+        Returns whether it was saved."""
+        path = self.session_path(runner.session)
+        if path is None or not runner.started:
+            return False
+        try:
+            await runner.run(runner.save_session, path)
+        except Exception:
+            tornado.log.app_log.exception(f"Saving session {runner.session} failed")
+            shutil.rmtree(path, ignore_errors=True)
+            return False
+        return True
+
+    def watch_sessions(self) -> None:
+        """Start closing idle sessions, if there is a `session_timeout`."""
+        if self.session_timeout > 0 and self.session_watcher is None:
+            interval = min(self.session_timeout / 4, 60)
+            self.session_watcher = tornado.ioloop.PeriodicCallback(
+                self.close_idle_sessions, 1000 * interval
+            )
+            self.session_watcher.start()
+
+    async def close_idle_sessions(self) -> None:
+        """Close the sessions that received no command for `session_timeout`
+        seconds, saving named ones first."""
+        reason = f"Session closed after {self.session_timeout:g} s without activity"
+        deadline = time.monotonic() - self.session_timeout
+        for runner in list(self.runners):
+            if not runner.sockets or runner.busy or runner.last_active > deadline:
+                continue
+            last_active = runner.last_active
+            saved = await self.save_session(runner)
+            if runner.last_active != last_active:
+                # Used again while it was saved
+                if saved:
+                    shutil.rmtree(self.session_path(runner.session), ignore_errors=True)
+                continue
+            for socket in list(runner.sockets):
+                socket.close_with_reason(1000, reason)
+
+    def close_executors(self) -> None:
+        """Shut down the executors, without waiting for their work."""
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+            self.executor = None
+        if self.sweep_executor is not None:
+            # Work that hasn't started yet is dropped
+            for future in self.sweep_futures:
+                future.cancel()
+            self.sweep_futures.clear()
+            self.sweep_executor.shutdown(wait=False)
+            self.sweep_executor = None
+
+    def launch(
+        self,
+        port: Optional[int] = None,
+        open_browser: bool = True,
+        production: Optional[bool] = None,
+    ) -> None:
         """ Run the app. """
-        self.port = int(os.getenv("PORT", 3000))
+        if port is None:
+            port = int(os.getenv("PORT", self.port))
+        self.port = port
+        if production is None:
+            production = self.production or os.getenv(
+                "MESA_VIZ_PRODUCTION", ""
+            ).lower() not in ("", "0", "false")
+        if production:
+            processes = int(os.getenv("WEB_CONCURRENCY", self.processes))
+            print(
+                "Serving on port {PORT} with {processes} processes".format(
+                    PORT=self.port, processes=processes or "all CPU"
+                )
+            )
+            serve(self, self.port, self.address, processes, self.shutdown_timeout)
+            return
+
         url = "http://127.0.0.1:{PORT}".format(PORT=self.port)
         print("Interface starting at {url}".format(url=url))
         self.listen(self.port)
-        webbrowser.open(url)
+        if open_browser:
+            webbrowser.open(url)
         tornado.autoreload.start()
         tornado.ioloop.IOLoop.current().start()
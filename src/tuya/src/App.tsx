@@ -39,6 +39,10 @@ import {
 import { VegaCharts } from "./features/charts/VegaCharts";
 import ModelController from "./features/controller/ModelController";
 import Parameters from "./features/parameters/ParameterInput";
+import MetricsOverlay from "./features/session/MetricsOverlay";
+import SessionClosed from "./features/session/SessionClosed";
+import { SweepCharts } from "./features/sweep/SweepCharts";
+import { EnsembleCharts } from "./features/ensemble/EnsembleCharts";
 
 function App() {
   const [open, setOpen] = useState(false);
@@ -56,6 +60,8 @@ function App() {
       <ParameterDrawer open={open} />
       <Main />
       <ModelController />
+      <MetricsOverlay />
+      <SessionClosed />
     </>
   );
 }
@@ -65,6 +71,8 @@ const Main = React.memo(() => {
     <DrawerAppContent>
       <Grid>
         <VegaCharts />
+        <SweepCharts />
+        <EnsembleCharts />
       </Grid>
     </DrawerAppContent>
   );
@@ -0,0 +1,117 @@
+import React, { useEffect, useRef } from "react";
+import { RasterImage } from "./raster";
+
+// Colors of categories without a color of their own (vega's "tableau10")
+const SCHEME = [
+  "#4c78a8",
+  "#f58518",
+  "#e45756",
+  "#72b7b2",
+  "#54a24b",
+  "#eeca3b",
+  "#b279a2",
+  "#ff9da6",
+  "#9d755d",
+  "#bab0ac",
+];
+
+// A CSS color as a pixel value of an ImageData (RGBA in memory order)
+function toPixel(color: string, context: CanvasRenderingContext2D) {
+  context.clearRect(0, 0, 1, 1);
+  context.fillStyle = color;
+  context.fillRect(0, 0, 1, 1);
+  return new Uint32Array(context.getImageData(0, 0, 1, 1).data.buffer)[0];
+}
+
+function palette(categories: any[], colors: [any, string][]) {
+  const context = document.createElement("canvas").getContext("2d")!;
+  // Empty cells (category 0) stay transparent
+  return Uint32Array.from(categories, (value, code) => {
+    if (code === 0) {
+      return 0;
+    }
+    const color = colors.find(([key]) => key === value)?.[1];
+    return toPixel(color ?? SCHEME[(code - 1) % SCHEME.length], context);
+  });
+}
+
+// Draws a grid sent as raster image (see GridChart). Only tiles that differ
+// from the last drawn image are drawn again.
+export function RasterChart({ raster, spec, onClick }) {
+  const canvas = useRef<HTMLCanvasElement>(null);
+  const drawn = useRef<RasterImage>();
+  const image = useRef<ImageData>();
+  const { color, colors } = spec.usermeta.raster;
+
+  useEffect(() => {
+    if (raster === undefined || canvas.current === null) {
+      return;
+    }
+    const context = canvas.current.getContext("2d")!;
+    const { width, height, tileSize, columns } = raster;
+    const previous = drawn.current;
+    const resized =
+      previous === undefined ||
+      previous.width !== width ||
+      previous.height !== height ||
+      previous.tileSize !== tileSize;
+    if (resized) {
+      canvas.current.width = width;
+      canvas.current.height = height;
+      image.current = context.createImageData(width, height);
+    }
+
+    const pixels = new Uint32Array(image.current!.data.buffer);
+    const pixelOf = palette(raster.categories, colors);
+    raster.tiles.forEach((tile, i) => {
+      if (!resized && previous!.tiles[i] === tile) {
+        return;
+      }
+      const x = (i % columns) * tileSize;
+      const y = Math.floor(i / columns) * tileSize;
+      const tileWidth = Math.min(tileSize, width - x);
+      const tileHeight = tile.length / tileWidth;
+      for (let j = 0; j < tile.length; j++) {
+        const row = y + Math.floor(j / tileWidth);
+        pixels[row * width + x + (j % tileWidth)] = pixelOf[tile[j]];
+      }
+      context.putImageData(image.current!, 0, 0, x, y, tileWidth, tileHeight);
+    });
+    drawn.current = raster;
+  }, [raster]);
+
+  // Clicks are answered with the cell and the value of its agent
+  function handleClick(event: React.MouseEvent<HTMLCanvasElement>) {
+    if (raster === undefined) {
+      return;
+    }
+    const { width, height, tileSize, columns } = raster;
+    const bounds = event.currentTarget.getBoundingClientRect();
+    const x = Math.floor(((event.clientX - bounds.left) / bounds.width) * width);
+    const row = Math.floor(
+      ((event.clientY - bounds.top) / bounds.height) * height
+    );
+    const tileX = Math.floor(x / tileSize);
+    const tileWidth = Math.min(tileSize, width - tileX * tileSize);
+    const tile = raster.tiles[Math.floor(row / tileSize) * columns + tileX];
+    const code = tile[(row % tileSize) * tileWidth + (x % tileSize)];
+
+    const datum = { x, y: height - 1 - row };
+    if (code) {
+      datum[color] = raster.categories[code];
+    }
+    onClick("get_datum", datum);
+  }
+
+  return (
+    <canvas
+      ref={canvas}
+      onClick={handleClick}
+      style={{
+        width: spec.width,
+        height: spec.height,
+        imageRendering: "pixelated",
+      }}
+    />
+  );
+}
@@ -0,0 +1,41 @@
+import React, { useMemo, useRef } from "react";
+import { Vega } from "react-vega";
+import { SpaceData, toDatasets } from "../space/spaceReducer";
+
+// Minimum time between viewport messages while zooming or panning (ms)
+const VIEWPORT_INTERVAL = 100;
+
+// Draws a continuous space (see SpaceChart) from the bins or agents the
+// server sent for the current viewport. Zooming and panning report the new
+// viewport, so the server can send more detail.
+export function SpaceChart({ spec, space, onViewport }) {
+  const data = useMemo(() => toDatasets(space as SpaceData | undefined), [
+    space,
+  ]);
+  const timer = useRef<number>();
+  const latest = useRef<any>();
+
+  // Only the latest viewport of an interval is sent
+  function handleViewport(_name: string, value: any) {
+    latest.current = value;
+    if (timer.current !== undefined) {
+      return;
+    }
+    timer.current = window.setTimeout(() => {
+      timer.current = undefined;
+      const { x, y } = latest.current ?? {};
+      // An empty selection shows the whole space again
+      onViewport(
+        x && y ? { x_min: x[0], x_max: x[1], y_min: y[0], y_max: y[1] } : {}
+      );
+    }, VIEWPORT_INTERVAL);
+  }
+
+  return (
+    <Vega
+      spec={spec}
+      data={data}
+      signalListeners={{ viewport: handleViewport }}
+    />
+  );
+}
@@ -3,26 +3,51 @@ import { useSelector } from "react-redux";
 import { Vega } from "react-vega";
 import { RootState } from "../../store";
 import { selectStep } from "../modelStates/modelStatesReducer";
+import { selectSeries, toRows } from "../series/seriesReducer";
+import { RasterChart } from "./RasterChart";
+import { SpaceChart } from "./SpaceChart";
 import { cloneDeep } from "lodash-es";
 import { GridCell, Typography } from "rmwc";
 import "@rmwc/grid/styles";
 import "@rmwc/typography/styles";
 import { useMySocket } from "../websocket/websocket";
+import { agentRecords } from "../websocket/frames";
 
 export function VegaCharts() {
   const { sendJsonMessage } = useMySocket();
   const currentStep = useSelector(
     (state: RootState) => state.modelStates.currentStep
   );
-  const maxStep = useSelector((state: RootState) => state.modelStates.maxStep);
   const specs = useSelector((state: RootState) => state.chart.specs);
   const currentStepData = useSelector(selectStep(currentStep));
-  const currentData = cloneDeep(currentStepData?.data);
-  const maxStepData = useSelector(selectStep(maxStep));
-  const maxData = cloneDeep(maxStepData?.data);
+  // Raster images are left out, vega only needs copies of the agents. Their
+  // records are built once per step, if any chart draws them
+  const agentCharts = specs.some(
+    (spec) =>
+      !chartedOnce(spec) && !spec.usermeta?.space && !spec.usermeta?.raster
+  );
+  const currentData = useMemo(
+    () =>
+      currentStepData?.data.map(({ rasters, agents, ...model }) => ({
+        ...cloneDeep(model),
+        agents: agentCharts ? agentRecords(agents) : [],
+      })),
+    [currentStepData, agentCharts]
+  );
+  // Rows are created from the series, so vega may modify them
+  const series = useSelector(selectSeries);
+  const spaces = useSelector((state: RootState) => state.space);
+  const rows = useMemo(
+    () => currentData?.map((model: any) => toRows(series[model.modelId])),
+    [series, currentStepData]
+  );
 
-  if (currentData && maxData) {
+  if (currentData && rows) {
+    const rasterSpecs = specs.filter((spec) => spec.usermeta?.raster);
     const charts = currentData.map((model: any, idx) => {
+      const modelRows = rows[idx];
+      // Not deep copied, unchanged tiles are recognized by their identity
+      const rasters = currentStepData!.data[idx].rasters;
       const handleClick = (_name: string, data: object | unknown) =>
         sendJsonMessage({
           type: "call_method",
@@ -40,15 +65,36 @@ export function VegaCharts() {
           >
             Model {idx + 1}
           </Typography>
-          {specs.map((spec, idx) => (
-            <Vega
-              key={idx}
-              spec={spec}
-              data={{ agents: model.agents, model: maxData[idx].model }}
-              patch={specPatch}
-              signalListeners={{ get_datum: handleClick }}
-            />
-          ))}
+          {specs.map((spec, idx) =>
+            chartedOnce(spec) ? null : spec.usermeta?.space ? (
+              <SpaceChart
+                key={idx}
+                spec={spec}
+                space={spaces[idx]?.models[model.modelId]}
+                onViewport={(viewport) =>
+                  sendJsonMessage({
+                    type: "viewport",
+                    data: { chart: idx, ...viewport },
+                  })
+                }
+              />
+            ) : spec.usermeta?.raster ? (
+              <RasterChart
+                key={idx}
+                spec={spec}
+                raster={rasters?.[rasterSpecs.indexOf(spec)]}
+                onClick={handleClick}
+              />
+            ) : (
+              <Vega
+                key={idx}
+                spec={spec}
+                data={{ agents: model.agents, model: modelRows }}
+                patch={specPatch}
+                signalListeners={{ get_datum: handleClick }}
+              />
+            )
+          )}
         </GridCell>
       );
     });
@@ -57,6 +103,12 @@ export function VegaCharts() {
   return <div>nothing</div>;
 }
 
+// Sweeps and ensembles are charted once for all models, see SweepCharts and
+// EnsembleCharts
+function chartedOnce(spec: any) {
+  return spec.usermeta?.sweep || spec.usermeta?.ensemble;
+}
+
 function specPatch(spec: object) {
   if (spec) {
     //@ts-ignore
@@ -0,0 +1,89 @@
+// Raster images of grids, see mesa_viz/Raster.py
+
+type Tile = {
+  x: number;
+  y: number;
+  width: number;
+  height: number;
+  data: Uint8Array;
+};
+
+export type RasterMessage = {
+  width: number;
+  height: number;
+  tileSize: number;
+  dtype: "uint8" | "uint16";
+  categories: any[];
+  tiles: Tile[];
+};
+
+// An image as a list of tiles, row by row. Tiles that did not change are
+// shared with the image of the previous step.
+export type RasterImage = {
+  width: number;
+  height: number;
+  tileSize: number;
+  columns: number;
+  categories: any[];
+  tiles: (Uint8Array | Uint16Array)[];
+};
+
+function cellsOf(tile: Tile, dtype: string) {
+  if (dtype === "uint16") {
+    return new Uint16Array(
+      tile.data.buffer,
+      tile.data.byteOffset,
+      tile.data.byteLength / 2
+    );
+  }
+  return tile.data;
+}
+
+export function applyRaster(
+  previous: RasterImage | undefined,
+  message: RasterMessage
+): RasterImage {
+  const { width, height, tileSize, categories } = message;
+  const columns = Math.ceil(width / tileSize);
+  const rows = Math.ceil(height / tileSize);
+  const ArrayType = message.dtype === "uint16" ? Uint16Array : Uint8Array;
+
+  const sameSize =
+    previous !== undefined &&
+    previous.width === width &&
+    previous.height === height &&
+    previous.tileSize === tileSize;
+  const tiles = sameSize
+    ? [...previous!.tiles]
+    : Array.from({ length: rows * columns }, (_, i) => {
+        const tileWidth = Math.min(tileSize, width - (i % columns) * tileSize);
+        const tileHeight = Math.min(
+          tileSize,
+          height - Math.floor(i / columns) * tileSize
+        );
+        return new ArrayType(tileWidth * tileHeight);
+      });
+
+  for (const tile of message.tiles) {
+    const cells = cellsOf(tile, message.dtype);
+    if (tile.width <= tileSize && tile.height <= tileSize) {
+      tiles[(tile.y / tileSize) * columns + tile.x / tileSize] = cells;
+      continue;
+    }
+    // A whole image, split into tiles
+    for (let row = 0; row < rows; row++) {
+      for (let column = 0; column < columns; column++) {
+        const x = column * tileSize;
+        const tileWidth = Math.min(tileSize, width - x);
+        const tileHeight = Math.min(tileSize, height - row * tileSize);
+        const target = new ArrayType(tileWidth * tileHeight);
+        for (let y = 0; y < tileHeight; y++) {
+          const offset = (row * tileSize + y) * width + x;
+          target.set(cells.subarray(offset, offset + tileWidth), y * tileWidth);
+        }
+        tiles[row * columns + column] = target;
+      }
+    }
+  }
+  return { width, height, tileSize, columns, categories, tiles };
+}
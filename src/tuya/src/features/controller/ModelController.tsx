@@ -1,7 +1,7 @@
 import { useDispatch, useSelector } from "react-redux";
 import { Button, Card, IconButton, Slider } from "rmwc";
 import { RootState } from "../../store";
-import React, { useEffect, useState } from "react";
+import React from "react";
 import "@rmwc/slider/styles";
 import "@rmwc/card/styles";
 import { Root } from "postcss";
@@ -13,6 +13,9 @@ export default function ModelController() {
   const currentStep = useSelector(
     (state: RootState) => state.modelStates.currentStep
   );
+  const controller = useSelector(
+    (state: RootState) => state.session.controller
+  );
   const { sendJsonMessage } = useMySocket();
   const dispatch = useDispatch();
 
@@ -59,15 +62,17 @@ export default function ModelController() {
             icon="skip_previous"
             onClick={() => dispatch(displayStep(currentStep - 1))}
           />
-          <PlayButton currentStep={currentStep} nextStep={nextStep} />
+          <PlayButton disabled={!controller} />
           <IconButton
             icon="skip_next"
+            disabled={!controller}
             onClick={() => {
               nextStep();
             }}
           />
           <IconButton
             icon="replay"
+            disabled={!controller}
             onClick={() => sendJsonMessage({ type: "reset", data: {} })}
           ></IconButton>
         </div>
@@ -76,20 +81,24 @@ export default function ModelController() {
   );
 }
 
-function PlayButton({ currentStep, nextStep }) {
-  const [running, setRunning] = useState(false);
-
-  useEffect(() => {
-    if (running) {
-      nextStep();
-    }
-  }, [running, currentStep]);
+function PlayButton({ disabled }) {
+  const running = useSelector((state: RootState) => state.controller.running);
+  const { sendJsonMessage } = useMySocket();
 
+  // The server steps the models and sends the frames while playing
   return (
     <IconButton
       icon="play_arrow"
       onIcon="stop"
-      onClick={() => setRunning(!running)}
+      checked={running}
+      disabled={disabled}
+      onClick={() =>
+        sendJsonMessage(
+          running
+            ? { type: "pause", data: {} }
+            : { type: "play", data: { fps: 30 } }
+        )
+      }
     />
   );
 }
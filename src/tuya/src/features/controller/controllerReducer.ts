@@ -11,8 +11,21 @@ export const controllerSlice = createSlice({
     increment: (state) => {
       state.currentStep += 1;
     },
+    // The server steps the models, see ModelRunner.play
+    playing: (state) => {
+      state.running = true;
+    },
+    paused: (state) => {
+      state.running = false;
+    },
   },
   extraReducers: (builder) => {
+    builder.addMatcher(
+      (action) => action.type === "end",
+      (state) => {
+        state.running = false;
+      }
+    );
     builder.addMatcher(
       (action) => action.type.endsWith("stepReceived"),
       (state) => {
@@ -22,6 +35,6 @@ export const controllerSlice = createSlice({
   },
 });
 
-export const { increment } = controllerSlice.actions;
+export const { increment, playing, paused } = controllerSlice.actions;
 
 export default controllerSlice.reducer;
@@ -0,0 +1,52 @@
+import React from "react";
+import { useSelector } from "react-redux";
+import { Vega } from "react-vega";
+import { Button, GridCell, Typography } from "rmwc";
+import { cloneDeep } from "lodash-es";
+import "@rmwc/button/styles";
+import "@rmwc/grid/styles";
+import "@rmwc/typography/styles";
+import { RootState } from "../../store";
+import { useMySocket } from "../websocket/websocket";
+
+// Charts of the "ensemble" dataset (see EnsembleChart), shown once for all
+// models
+export function EnsembleCharts() {
+  const { sendJsonMessage } = useMySocket();
+  const specs = useSelector((state: RootState) =>
+    state.chart.specs.filter((spec) => spec.usermeta?.ensemble)
+  );
+  const { replicates, total, running, rows } = useSelector(
+    (state: RootState) => state.ensemble
+  );
+  const controller = useSelector(
+    (state: RootState) => state.session.controller
+  );
+
+  if (specs.length === 0) {
+    return null;
+  }
+  return (
+    <GridCell span={12}>
+      <Typography use="headline6">
+        Ensemble {total > 0 ? `(${replicates} / ${total} replicates)` : ""}
+      </Typography>
+      <Button
+        label={running ? "Stop" : "Run ensemble"}
+        disabled={!controller}
+        onClick={() =>
+          sendJsonMessage({
+            type: running ? "stop_ensemble" : "ensemble",
+            data: {},
+          })
+        }
+      />
+      <div>
+        {specs.map((spec, idx) => (
+          // Rows are copied, vega may modify them
+          <Vega key={idx} spec={spec} data={{ ensemble: cloneDeep(rows) }} />
+        ))}
+      </div>
+    </GridCell>
+  );
+}
@@ -0,0 +1,31 @@
+import { createSlice } from "@reduxjs/toolkit";
+
+// Summary of the replicates of an ensemble, one row per step and model value,
+// see mesa_viz/Ensemble.py
+export type EnsembleRow = {
+  Step: number;
+  field: string;
+  mean: number | null;
+  std: number | null;
+  [quantile: string]: number | string | null;
+};
+
+export const ensembleSlice = createSlice({
+  name: "ensemble",
+  initialState: {
+    replicates: 0,
+    total: 0,
+    running: false,
+    rows: [] as EnsembleRow[],
+  },
+  reducers: {
+    // The summary is sent in full, it doesn't grow with the replicates
+    updated(state, action: { type: string; payload: any }) {
+      return action.payload;
+    },
+  },
+});
+
+export const { updated } = ensembleSlice.actions;
+
+export default ensembleSlice.reducer;
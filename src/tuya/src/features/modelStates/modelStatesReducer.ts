@@ -3,25 +3,27 @@ import {
   createEntityAdapter,
   createSelector,
 } from "@reduxjs/toolkit";
-import { cloneDeep } from "lodash";
 import { RootState } from "../../store";
+import { applyRaster, RasterImage, RasterMessage } from "../charts/raster";
+import { AgentColumns, isColumnar, updateColumns } from "../websocket/frames";
 
 export type RawMesaData = {
   running: boolean;
-  agents: [{ unique_id: number | string }];
+  agents: Agents;
 };
 
 export type VegaData = {
   model: { running: boolean };
-  agents: [{ unique_id: number | string }];
+  agents: AgentData[];
 };
 
 export type ModelStates = {
   step: number;
   data: {
     modelId: number;
-    agents: [{ unique_id: number | string }];
+    agents: Agents;
     model: any;
+    rasters?: RasterImage[];
   }[];
 };
 
@@ -37,39 +39,121 @@ interface ModelStatesAction {
   };
 }
 
+export type AgentData = { unique_id: number | string };
+
+// Records of the agents, or their columns with the columnar protocol
+export type Agents = AgentData[] | AgentColumns;
+
+interface ModelDeltasAction {
+  type: string;
+  payload: {
+    step: number;
+    modelStates: [
+      {
+        modelId: number;
+        model: any;
+        added: Agents;
+        changed: Agents;
+        removed: (number | string)[];
+        rasters?: RasterMessage[];
+      }
+    ];
+  };
+}
+
+// The history of model values is kept in the series slice, every step only
+// holds the values of that step
+function applyStep(state, action: ModelStatesAction) {
+  const modelsData = action.payload.modelStates.map((modelState) => {
+    const { agents, rasters, ...model } = modelState.state as any;
+    return {
+      modelId: modelState.modelId,
+      agents: agents,
+      model: model,
+      rasters: rasters?.map((raster) => applyRaster(undefined, raster)),
+    };
+  });
+  const entity = { step: action.payload.step, data: modelsData };
+  modelStates.upsertOne(state, entity);
+  state.currentStep = entity.step;
+  state.maxStep = entity.step;
+}
+
+function applyAgents(
+  agents: Agents,
+  delta: ModelDeltasAction["payload"]["modelStates"][0]
+): Agents {
+  const { removed, changed, added } = delta;
+  if (isColumnar(agents)) {
+    return updateColumns(
+      agents,
+      removed,
+      changed as AgentColumns,
+      added as AgentColumns
+    );
+  }
+  // unique_id may be a position, so key agents by their JSON representation
+  const records = new Map<string, AgentData>(
+    agents.map((agent) => [JSON.stringify(agent.unique_id), agent])
+  );
+  for (const unique_id of removed) {
+    records.delete(JSON.stringify(unique_id));
+  }
+  for (const agent of [
+    ...(changed as AgentData[]),
+    ...(added as AgentData[]),
+  ]) {
+    records.set(JSON.stringify(agent.unique_id), agent);
+  }
+  return Array.from(records.values());
+}
+
+function applyDelta(state, action: ModelDeltasAction) {
+  const previous = modelStates
+    .getSelectors()
+    .selectById(state, action.payload.step - 1);
+  if (previous === undefined) {
+    return;
+  }
+  const modelsData = action.payload.modelStates.map((delta, idx) => {
+    const lastData = previous.data[idx];
+    return {
+      modelId: delta.modelId,
+      agents: applyAgents(lastData.agents, delta),
+      model: { ...lastData.model, ...delta.model },
+      rasters: delta.rasters?.map((raster, i) =>
+        applyRaster(lastData.rasters?.[i], raster)
+      ),
+    };
+  });
+  const entity = { step: action.payload.step, data: modelsData };
+  modelStates.upsertOne(state, entity);
+  state.currentStep = entity.step;
+  state.maxStep = entity.step;
+}
+
 export const modelStatesSlice = createSlice({
   name: "modelStates",
   initialState: modelStates.getInitialState({ currentStep: 0, maxStep: 0 }),
   reducers: {
     stepReceived(state, action: ModelStatesAction) {
-      const modelsData = action.payload.modelStates.map((modelState, idx) => {
-        const { agents, ...model } = modelState.state;
-        let lastValues = modelStates
-          .getSelectors()
-          .selectById(state, action.payload.step - 1)?.data[idx]?.model;
-        console.log(lastValues);
-        if (lastValues === undefined) {
-          lastValues = {};
-          const test = {};
-          for (const key of Object.keys(model)) {
-            lastValues[key] = [];
-          }
-        }
-        const newValues = cloneDeep(lastValues);
-        for (const [key, value] of Object.entries(model)) {
-          newValues[key].push(value);
+      applyStep(state, action);
+    },
+    deltaReceived(state, action: ModelDeltasAction) {
+      applyDelta(state, action);
+    },
+    batchReceived(state, action: { type: string; payload: any[] }) {
+      // Batches fill in the history, they don't change the displayed step
+      const { currentStep, maxStep } = state;
+      for (const frame of action.payload) {
+        if (frame.type.endsWith("deltaReceived")) {
+          applyDelta(state, frame);
+        } else {
+          applyStep(state, frame);
         }
-        console.log(newValues);
-        return {
-          modelId: modelState.modelId,
-          agents: agents,
-          model: newValues,
-        };
-      });
-      const entity = { step: action.payload.step, data: modelsData };
-      modelStates.upsertOne(state, entity);
-      state.currentStep = entity.step;
-      state.maxStep = entity.step;
+      }
+      state.currentStep = currentStep;
+      state.maxStep = Math.max(maxStep, state.maxStep);
     },
     reset() {
       return modelStates.getInitialState({ currentStep: 0, maxStep: 0 });
@@ -80,7 +164,13 @@ export const modelStatesSlice = createSlice({
   },
 });
 
-export const { stepReceived, displayStep, reset } = modelStatesSlice.actions;
+export const {
+  stepReceived,
+  deltaReceived,
+  batchReceived,
+  displayStep,
+  reset,
+} = modelStatesSlice.actions;
 
 export const modelStatesSelectors = modelStates.getSelectors<RootState>(
   (state) => state.modelStates
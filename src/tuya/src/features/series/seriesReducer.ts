@@ -0,0 +1,72 @@
+import { createSlice } from "@reduxjs/toolkit";
+import { RootState } from "../../store";
+
+// History of the numeric model values, see mesa_viz/TimeSeries.py
+export type Series = {
+  steps: number[];
+  columns: { [name: string]: (number | null)[] };
+};
+
+type SeriesAction = {
+  type: string;
+  payload: ({ modelId: number } & Series)[];
+};
+
+export const seriesSlice = createSlice({
+  name: "series",
+  initialState: {} as { [modelId: number]: Series },
+  reducers: {
+    appended(state, action: SeriesAction) {
+      for (const { modelId, steps, columns } of action.payload) {
+        const series = state[modelId];
+        if (series === undefined) {
+          state[modelId] = { steps, columns };
+          continue;
+        }
+        if (steps.length === 0) {
+          continue;
+        }
+        // Points from the first new step on were recomputed (after a reset
+        // or an interaction), so they are replaced
+        let length = series.steps.length;
+        while (length > 0 && series.steps[length - 1] >= steps[0]) {
+          length--;
+        }
+        series.steps.splice(length, Infinity, ...steps);
+        for (const name of Object.keys({ ...series.columns, ...columns })) {
+          if (series.columns[name] === undefined) {
+            series.columns[name] = new Array(length).fill(null);
+          }
+          const values = columns[name] ?? new Array(steps.length).fill(null);
+          series.columns[name].splice(length, Infinity, ...values);
+        }
+      }
+    },
+    replaced(state, action: SeriesAction) {
+      for (const { modelId, steps, columns } of action.payload) {
+        state[modelId] = { steps, columns };
+      }
+    },
+  },
+});
+
+export const { appended, replaced } = seriesSlice.actions;
+
+export const selectSeries = (state: RootState) => state.series;
+
+// Rows of the "model" dataset of the vega specifications
+export function toRows(series: Series | undefined) {
+  if (series === undefined) {
+    return [];
+  }
+  const columns = Object.entries(series.columns);
+  return series.steps.map((step, i) => {
+    const row = { Step: step };
+    for (const [name, values] of columns) {
+      row[name] = values[i];
+    }
+    return row;
+  });
+}
+
+export default seriesSlice.reducer;
@@ -0,0 +1,42 @@
+import React from "react";
+import { useSelector } from "react-redux";
+import { RootState } from "../../store";
+
+// Timing of the phases of a step, sent if the server has `metrics_overlay`
+export default function MetricsOverlay() {
+  const metrics = useSelector((state: RootState) => state.session.metrics);
+  const phases = Object.entries(metrics);
+  if (phases.length === 0) {
+    return null;
+  }
+  return (
+    <table
+      style={{
+        position: "fixed",
+        right: "8px",
+        bottom: "8px",
+        padding: "4px",
+        font: "12px monospace",
+        background: "rgba(255, 255, 255, 0.8)",
+        pointerEvents: "none",
+      }}
+    >
+      <thead>
+        <tr>
+          <th>phase</th>
+          <th>mean ms</th>
+          <th>p95 ms</th>
+        </tr>
+      </thead>
+      <tbody>
+        {phases.map(([phase, { mean, p95 }]) => (
+          <tr key={phase}>
+            <td>{phase}</td>
+            <td>{mean.toFixed(2)}</td>
+            <td>{p95.toFixed(2)}</td>
+          </tr>
+        ))}
+      </tbody>
+    </table>
+  );
+}
@@ -0,0 +1,27 @@
+import React from "react";
+import { useSelector } from "react-redux";
+import { RootState } from "../../store";
+
+// Reason the server gave for ending the session, see SocketHandler.close_with_reason
+export default function SessionClosed() {
+  const reason = useSelector((state: RootState) => state.session.closedReason);
+  if (reason === null) {
+    return null;
+  }
+  return (
+    <div
+      style={{
+        position: "fixed",
+        left: "50%",
+        top: "72px",
+        transform: "translateX(-50%)",
+        padding: "8px 16px",
+        background: "rgba(255, 255, 255, 0.9)",
+        border: "1px solid #ccc",
+        zIndex: 10,
+      }}
+    >
+      {reason}
+    </div>
+  );
+}
@@ -0,0 +1,34 @@
+import { createSlice } from "@reduxjs/toolkit";
+
+export const sessionSlice = createSlice({
+  name: "session",
+  initialState: {
+    controller: true,
+    viewers: 1,
+    // Flow control statistics of the connection, see ModelRunner.socket_stats
+    stats: {},
+    // Recent durations of the phases of a step (ms), see SessionMetrics.summary
+    metrics: {} as { [phase: string]: { mean: number; p95: number } },
+    // Why the server ended the session (rejected, idle or shutting down)
+    closedReason: null as string | null,
+  },
+  reducers: {
+    joined: (state, action) => {
+      state.controller = action.payload.controller;
+      state.viewers = action.payload.viewers;
+    },
+    stats: (state, action) => {
+      state.stats = action.payload;
+    },
+    metrics: (state, action) => {
+      state.metrics = action.payload;
+    },
+    closed: (state, action) => {
+      state.closedReason = action.payload.reason;
+    },
+  },
+});
+
+export const { joined, stats, metrics, closed } = sessionSlice.actions;
+
+export default sessionSlice.reducer;
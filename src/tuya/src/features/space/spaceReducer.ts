@@ -0,0 +1,76 @@
+import { createSlice } from "@reduxjs/toolkit";
+import { RootState } from "../../store";
+import { AgentData } from "../modelStates/modelStatesReducer";
+import { AgentColumns, agentRecords } from "../websocket/frames";
+
+// Agents of a continuous space within the viewport, see mesa_viz/Space.py
+export type SpaceData =
+  | {
+      detail: true;
+      agents: (AgentData & { x: number; y: number })[] | AgentColumns;
+    }
+  | {
+      detail: false;
+      bins: {
+        x: number;
+        y: number;
+        width: number;
+        height: number;
+        columns: number[];
+        rows: number[];
+        counts: number[];
+      };
+    };
+
+type SpaceAction = {
+  type: string;
+  payload: {
+    step: number;
+    chart: number;
+    models: ({ modelId: number } & SpaceData)[];
+  };
+};
+
+type Space = { step: number; models: { [modelId: number]: SpaceData } };
+
+export const spaceSlice = createSlice({
+  name: "space",
+  initialState: {} as { [chart: number]: Space },
+  reducers: {
+    received(state, action: SpaceAction) {
+      const { step, chart, models } = action.payload;
+      state[chart] = {
+        step,
+        models: Object.fromEntries(
+          models.map(({ modelId, ...data }) => [modelId, data])
+        ),
+      };
+    },
+  },
+});
+
+export const { received } = spaceSlice.actions;
+
+export const selectSpace = (chart: number) => (state: RootState) =>
+  state.space[chart];
+
+// Rows of the "density" and "detail" datasets of a space chart
+export function toDatasets(data: SpaceData | undefined) {
+  if (data === undefined) {
+    return { density: [], detail: [] };
+  }
+  if (data.detail) {
+    return { density: [], detail: agentRecords(data.agents) };
+  }
+  const { x, y, width, height, columns, rows, counts } = data.bins;
+  const density = counts.map((count, i) => ({
+    x: x + columns[i] * width,
+    x2: x + (columns[i] + 1) * width,
+    y: y + rows[i] * height,
+    y2: y + (rows[i] + 1) * height,
+    count: count,
+  }));
+  return { density, detail: [] };
+}
+
+export default spaceSlice.reducer;
@@ -0,0 +1,48 @@
+import React from "react";
+import { useSelector } from "react-redux";
+import { Vega } from "react-vega";
+import { Button, GridCell, Typography } from "rmwc";
+import { cloneDeep } from "lodash-es";
+import "@rmwc/button/styles";
+import "@rmwc/grid/styles";
+import "@rmwc/typography/styles";
+import { RootState } from "../../store";
+import { useMySocket } from "../websocket/websocket";
+
+// Charts of the "sweep" dataset (see SweepChart), shown once for all models
+export function SweepCharts() {
+  const { sendJsonMessage } = useMySocket();
+  const specs = useSelector((state: RootState) =>
+    state.chart.specs.filter((spec) => spec.usermeta?.sweep)
+  );
+  const { total, running, rows } = useSelector(
+    (state: RootState) => state.sweep
+  );
+  const controller = useSelector(
+    (state: RootState) => state.session.controller
+  );
+
+  if (specs.length === 0) {
+    return null;
+  }
+  return (
+    <GridCell span={12}>
+      <Typography use="headline6">
+        Sweep {total > 0 ? `(${rows.length} / ${total})` : ""}
+      </Typography>
+      <Button
+        label={running ? "Stop" : "Run sweep"}
+        disabled={!controller}
+        onClick={() =>
+          sendJsonMessage({ type: running ? "stop_sweep" : "sweep", data: {} })
+        }
+      />
+      <div>
+        {specs.map((spec, idx) => (
+          // Rows are copied, vega may modify them
+          <Vega key={idx} spec={spec} data={{ sweep: cloneDeep(rows) }} />
+        ))}
+      </div>
+    </GridCell>
+  );
+}
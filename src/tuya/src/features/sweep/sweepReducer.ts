@@ -0,0 +1,32 @@
+import { createSlice } from "@reduxjs/toolkit";
+
+// Results of a parameter sweep, one row per combination, see mesa_viz/Sweep.py
+export type SweepRow = { [field: string]: number | string | boolean };
+
+export const sweepSlice = createSlice({
+  name: "sweep",
+  initialState: {
+    params: [] as string[],
+    total: 0,
+    running: false,
+    rows: [] as SweepRow[],
+  },
+  reducers: {
+    started(state, action: { type: string; payload: any }) {
+      state.params = action.payload.params;
+      state.total = action.payload.total;
+      state.running = true;
+      state.rows = [];
+    },
+    resultsReceived(state, action: { type: string; payload: SweepRow[] }) {
+      state.rows.push(...action.payload);
+    },
+    finished(state) {
+      state.running = false;
+    },
+  },
+});
+
+export const { started, resultsReceived, finished } = sweepSlice.actions;
+
+export default sweepSlice.reducer;
@@ -0,0 +1,225 @@
+// Decoding of binary (columnar) frames, see mesa_viz/Serializer.py
+
+import { cloneDeep } from "lodash-es";
+import { AgentData } from "../modelStates/modelStatesReducer";
+
+// `data` is set while decoding, to a typed array on the frame or the values
+type Column = {
+  dtype?: string;
+  offset?: number;
+  width?: number;
+  categories?: string[];
+  values?: any[];
+  data?: ArrayLike<any>;
+};
+
+// Agents of a columnar frame, kept as columns until vega needs the records
+export type AgentColumns = {
+  length: number;
+  columns: { [name: string]: Column };
+};
+
+const AGENT_LISTS = ["agents", "added", "changed"];
+
+const ARRAY_TYPES = {
+  bool: Uint8Array,
+  uint8: Uint8Array,
+  int8: Int8Array,
+  uint16: Uint16Array,
+  int16: Int16Array,
+  uint32: Uint32Array,
+  int32: Int32Array,
+  float64: Float64Array,
+};
+
+function readColumns(
+  columns: AgentColumns,
+  buffer: ArrayBuffer,
+  start: number
+): AgentColumns {
+  for (const column of Object.values(columns.columns)) {
+    column.data =
+      column.values ??
+      new ARRAY_TYPES[column.dtype!](
+        buffer,
+        start + column.offset!,
+        columns.length * (column.width ?? 1)
+      );
+  }
+  return columns;
+}
+
+function valueAt(column: Column, i: number) {
+  const data = column.data!;
+  if (column.width !== undefined) {
+    const width = column.width;
+    return Array.from((data as any).subarray(i * width, (i + 1) * width));
+  }
+  if (column.categories !== undefined) {
+    return column.categories[data[i]];
+  }
+  if (column.dtype === "bool") {
+    return Boolean(data[i]);
+  }
+  return data[i];
+}
+
+export function isColumnar(agents: any): agents is AgentColumns {
+  return agents?.columns !== undefined;
+}
+
+// New records of the agents, so vega may modify them
+export function agentRecords<T = AgentData>(agents: T[] | AgentColumns): T[] {
+  if (!isColumnar(agents)) {
+    return cloneDeep(agents);
+  }
+  const records = Array.from({ length: agents.length }, () => ({}));
+  for (const [name, column] of Object.entries(agents.columns)) {
+    for (let i = 0; i < agents.length; i++) {
+      const value = valueAt(column, i);
+      if (value !== null) {
+        records[i][name] = value;
+      }
+    }
+  }
+  return records as T[];
+}
+
+// The rows of the combined tables, columns keep their type if the tables
+// agree on it (categories are merged) and fall back to plain values if not
+function takeRows(tables: AgentColumns[], rows: Int32Array): AgentColumns {
+  const source = new Uint8Array(rows.length);
+  const index = new Int32Array(rows.length);
+  rows.forEach((row, i) => {
+    while (row >= tables[source[i]].length) {
+      row -= tables[source[i]].length;
+      source[i]++;
+    }
+    index[i] = row;
+  });
+
+  const columns = {};
+  const names = new Set(tables.flatMap((table) => Object.keys(table.columns)));
+  for (const name of names) {
+    const used = tables
+      .filter((table) => table.length > 0)
+      .map((table) => table.columns[name]);
+    const [first] = used;
+    const typed =
+      used.length > 0 &&
+      used.every(
+        (column) =>
+          column?.dtype !== undefined &&
+          column.width === first.width &&
+          !column.categories === !first.categories &&
+          (column.dtype === "bool") === (first.dtype === "bool")
+      );
+    if (!typed) {
+      const values = Array.from(rows, (_, i) => {
+        const column = tables[source[i]].columns[name];
+        return column === undefined ? null : valueAt(column, index[i]);
+      });
+      columns[name] = { values, data: values };
+      continue;
+    }
+
+    const { width = 1, categories } = first;
+    const dtypes = new Set(used.map((column) => column.dtype!));
+    const dtype =
+      categories !== undefined
+        ? "int32"
+        : dtypes.size === 1
+        ? first.dtype!
+        : dtypes.has("float64") || dtypes.has("uint32")
+        ? "float64"
+        : "int32";
+    const data = new ARRAY_TYPES[dtype](rows.length * width);
+    // Codes of every table in the merged categories
+    const merged = new Map<string, number>();
+    const codes = tables.map((table) =>
+      table.columns[name]?.categories?.map((category) => {
+        if (!merged.has(category)) {
+          merged.set(category, merged.size);
+        }
+        return merged.get(category)!;
+      })
+    );
+    for (let i = 0; i < rows.length; i++) {
+      const values = tables[source[i]].columns[name].data!;
+      for (let j = 0; j < width; j++) {
+        const value = values[index[i] * width + j];
+        data[i * width + j] = codes[source[i]]?.[value] ?? value;
+      }
+    }
+    columns[name] = {
+      dtype,
+      width: first.width,
+      categories: categories && Array.from(merged.keys()),
+      data,
+    };
+  }
+  return { length: rows.length, columns };
+}
+
+// Applies a delta to columnar agents (see applyDelta), without records
+export function updateColumns(
+  previous: AgentColumns,
+  removed: (number | string)[],
+  changed: AgentColumns,
+  added: AgentColumns
+): AgentColumns {
+  // unique_id may be a position, so key agents by their JSON representation
+  const rows = new Map<string, number>();
+  const addRows = (table: AgentColumns, offset: number) => {
+    for (let i = 0; i < table.length; i++) {
+      const unique_id = valueAt(table.columns.unique_id, i);
+      rows.set(JSON.stringify(unique_id), offset + i);
+    }
+  };
+  addRows(previous, 0);
+  for (const unique_id of removed) {
+    rows.delete(JSON.stringify(unique_id));
+  }
+  addRows(changed, previous.length);
+  addRows(added, previous.length + changed.length);
+  return takeRows([previous, changed, added], Int32Array.from(rows.values()));
+}
+
+export function decodeFrame(buffer: ArrayBuffer) {
+  const headerLength = new DataView(buffer).getUint32(0, true);
+  const header = JSON.parse(
+    new TextDecoder().decode(new Uint8Array(buffer, 4, headerLength))
+  );
+  const start = 4 + headerLength;
+
+  // Batches of frames (see encode_batch)
+  if (header.frames !== undefined) {
+    let offset = start;
+    const payload = header.frames.map((length: number) => {
+      const frame = decodeFrame(buffer.slice(offset, offset + length));
+      offset += length + (-length & 7);
+      return frame;
+    });
+    return { type: header.type, payload };
+  }
+
+  const restore = (value: any) => {
+    if (Array.isArray(value)) {
+      return value.map(restore);
+    }
+    // Binary data, like the tiles of raster images
+    if (value?.$bytes !== undefined) {
+      return new Uint8Array(buffer, start + value.offset, value.$bytes);
+    }
+    if (value !== null && typeof value === "object") {
+      for (const [key, item] of Object.entries<any>(value)) {
+        value[key] =
+          AGENT_LISTS.includes(key) && item?.columns !== undefined
+            ? readColumns(item, buffer, start)
+            : restore(item);
+      }
+    }
+    return value;
+  };
+  return restore(header);
+}
@@ -1,25 +1,38 @@
 import React, { useEffect, useState, useRef, FunctionComponent } from "react";
 import useWebSocket from "react-use-websocket";
 import store from "../../store";
+import { decodeFrame } from "./frames";
 
 const socket_url =
   (window.location.protocol === "https:" ? "wss://" : "ws://") +
   window.location.host +
-  "/ws";
+  "/ws" +
+  window.location.search; // e.g. ?session=name to join a shared session
 
 export function SocketHandler({ children }: any) {
   const { sendJsonMessage } = useWebSocket(socket_url, {
     share: true,
+    onOpen: (e) => {
+      (e.target as WebSocket).binaryType = "arraybuffer";
+    },
     onMessage: (e) => {
       console.log(e);
-      const action = JSON.parse(e.data);
+      const action =
+        e.data instanceof ArrayBuffer
+          ? decodeFrame(e.data)
+          : JSON.parse(e.data);
       store.dispatch(action);
+      // Start the models, unless we joined a running session
+      if (
+        action.type === "session/joined" &&
+        action.payload.controller &&
+        !action.payload.started
+      ) {
+        sendJsonMessage({ type: "reset", data: {} });
+      }
     },
     retryOnError: true,
   });
-  useEffect(() => {
-    sendJsonMessage({ type: "reset", data: {} });
-  }, []);
   return children;
 }
 
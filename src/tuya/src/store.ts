@@ -1,15 +1,25 @@
 import { configureStore } from "@reduxjs/toolkit";
 import chartReducer from "./features/charts/chartReducer";
 import controllerReducer from "./features/controller/controllerReducer";
+import ensembleReducer from "./features/ensemble/ensembleReducer";
 import modelStatesReducer from "./features/modelStates/modelStatesReducer";
 import parameterReducer from "./features/parameters/parameterReducer";
+import seriesReducer from "./features/series/seriesReducer";
+import sessionReducer from "./features/session/sessionReducer";
+import spaceReducer from "./features/space/spaceReducer";
+import sweepReducer from "./features/sweep/sweepReducer";
 
 const store = configureStore({
   reducer: {
     controller: controllerReducer,
+    ensemble: ensembleReducer,
     modelStates: modelStatesReducer,
     chart: chartReducer,
     parameter: parameterReducer,
+    session: sessionReducer,
+    series: seriesReducer,
+    space: spaceReducer,
+    sweep: sweepReducer,
   },
   middleware: (getDefaultMiddleware) =>
     getDefaultMiddleware({
@@ -0,0 +1,68 @@
+import multiprocessing
+import os
+import signal
+import socket
+import time
+import urllib.request
+
+import pytest
+import tornado.web
+
+from mesa_viz.Serving import serve, session_worker
+from mesa_viz.VegaVisualization import VegaServer
+
+from test_simulation import Walk
+
+
+class PidHandler(tornado.web.RequestHandler):
+    def get(self):
+        self.write(str(os.getpid()))
+
+
+class PidServer(VegaServer):
+    handlers = [(r"/pid", PidHandler), *VegaServer.handlers]
+
+
+def unused_port():
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        return probe.getsockname()[1]
+
+
+def get_pid(port, session):
+    url = f"http://127.0.0.1:{port}/pid?session={session}"
+    with urllib.request.urlopen(url, timeout=5) as response:
+        return int(response.read())
+
+
+@pytest.mark.skipif(not hasattr(os, "fork"), reason="needs fork")
+def test_sessions_are_handed_to_their_worker():
+    port = unused_port()
+    server = PidServer(Walk, [], "Walk")
+    process = multiprocessing.get_context("fork").Process(
+        target=serve, args=(server, port, "127.0.0.1", 2, 1.0)
+    )
+    process.start()
+    try:
+        for _ in range(100):
+            try:
+                get_pid(port, "probe")
+                break
+            except OSError:
+                time.sleep(0.05)
+        # A session for each worker, so whichever worker accepts a connection
+        # has to hand some of them over
+        sessions = {}
+        for index in range(100):
+            sessions.setdefault(session_worker(f"s{index}", 2), f"s{index}")
+        pids = {
+            worker: {get_pid(port, session) for _ in range(20)}
+            for worker, session in sessions.items()
+        }
+        assert all(len(found) == 1 for found in pids.values())
+        assert pids[0] != pids[1]
+        assert process.pid not in set.union(*pids.values())
+    finally:
+        os.kill(process.pid, signal.SIGTERM)
+        process.join(10)
+    assert process.exitcode == 0
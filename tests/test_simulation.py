@@ -0,0 +1,102 @@
+import asyncio
+
+from mesa import Agent, Model
+from mesa.space import MultiGrid
+from mesa.time import RandomActivation
+
+from mesa_viz.Simulation import Simulation
+from mesa_viz.VegaSpec import GridChart
+from mesa_viz.VegaVisualization import ModelRunner, SocketHandler, VegaServer
+
+
+class Walker(Agent):
+    def step(self):
+        x, y = self.pos
+        dx, dy = self.random.choice((-1, 1)), self.random.choice((-1, 1))
+        self.model.grid.move_agent(self, ((x + dx) % 10, (y + dy) % 10))
+
+
+class Walk(Model):
+    def __init__(self, width=10, height=10):
+        super().__init__()
+        self.grid = MultiGrid(width, height, True)
+        self.schedule = RandomActivation(self)
+        self.clicks = 0
+        for i in range(20):
+            agent = Walker(i, self)
+            self.schedule.add(agent)
+            pos = (self.random.randrange(width), self.random.randrange(height))
+            self.grid.place_agent(agent, pos)
+
+    def step(self):
+        self.schedule.step()
+
+    def on_click(self, **data):
+        self.clicks += 1
+
+
+class FakeSocket:
+    """Collects the messages a runner sends instead of writing them."""
+
+    write_frame = SocketHandler.write_frame
+    frame_written = SocketHandler.frame_written
+    lagging = SocketHandler.lagging
+    stats = SocketHandler.stats
+    model_runner = None
+
+    def __init__(self, application):
+        self.application = application
+        self.sent = []
+        self.pending_bytes = self.pending_frames = 0
+        self.sent_frames = self.dropped_frames = 0
+        self.last_step = 0
+        self.skipped_step = None
+        self.catching_up = False
+        self.viewports = {}
+
+    def write_message(self, message, binary=False):
+        self.sent.append(message)
+        future = asyncio.get_event_loop().create_future()
+        future.set_result(None)
+        return future
+
+
+def make_server(**attributes):
+    server = VegaServer(Walk, [GridChart(color="clicks")], "Walk", {}, 2)
+    for name, value in attributes.items():
+        setattr(server, name, value)
+    return server
+
+
+def test_interaction_leaves_other_simulations_alone(monkeypatch):
+    restored = []
+    restore = Simulation.restore
+
+    def recording_restore(self, step):
+        if step != self.current_step:
+            restored.append(self)
+        return restore(self, step)
+
+    monkeypatch.setattr(Simulation, "restore", recording_restore)
+
+    async def main():
+        server = make_server(execution="inline", lookahead=3, checkpoint_interval=2)
+        socket = FakeSocket(server)
+        runner = ModelRunner(server, socket)
+        socket.model_runner = runner
+        await runner.reset()
+        for step in range(1, 6):
+            await runner.step(step)
+        await runner.looking_ahead
+        first, second = runner.simulations
+        ahead = second.current_step
+        assert ahead > runner.sent_step + 1
+
+        restored.clear()
+        await runner.interact(0, "on_click", {})
+        assert first in restored
+        assert second not in restored
+        assert second.current_step == ahead
+        runner.close()
+
+    asyncio.run(main())